@@ -0,0 +1,32 @@
+"""normalized results
+
+Revision ID: 50ab3f69aa71
+Revises: 5224ac0b32ba
+Create Date: 2026-10-17 12:45:03.512118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '50ab3f69aa71'
+down_revision = '5224ac0b32ba'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('result_bibcodes',
+                    sa.Column('user_id', sa.Integer, primary_key=True),
+                    sa.Column('query_key', sa.String(64), primary_key=True),
+                    sa.Column('bibcode', sa.String(64), primary_key=True),
+                    sa.Column('created', UTCDateTime),
+                    )
+
+    # The table is filled from the results table by `run.py --backfill-results`, in batches committed on their own,
+    # right before STATEFUL_RESULTS_NORMALIZED is turned on (see README)
+
+
+def downgrade():
+    op.drop_table('result_bibcodes')
@@ -0,0 +1,35 @@
+"""authors last sent indexes
+
+Revision ID: 8d3c2a9e41f7
+Revises: abf03dfedf8a
+Create Date: 2026-10-17 15:20:12.604418
+
+Indexes the last sent dates, used to select the users to process. The indexes are built concurrently, so the
+pipeline can keep writing to the authors table.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3c2a9e41f7'
+down_revision = 'abf03dfedf8a'
+branch_labels = None
+depends_on = None
+
+INDEXES = [('ix_authors_last_sent_daily', ['last_sent_daily']),
+           ('ix_authors_last_sent_weekly', ['last_sent_weekly'])]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    op.execute('COMMIT')
+    for name, columns in INDEXES:
+        op.create_index(name, 'authors', columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, columns in INDEXES:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
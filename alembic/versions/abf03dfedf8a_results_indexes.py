@@ -0,0 +1,35 @@
+"""results indexes
+
+Revision ID: abf03dfedf8a
+Revises: 50ab3f69aa71
+Create Date: 2026-10-17 13:02:41.280331
+
+Adds composite indexes matching the two lookup paths of get_recent_results. The indexes are built
+concurrently, so the pipeline can keep writing to the results table.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'abf03dfedf8a'
+down_revision = '50ab3f69aa71'
+branch_labels = None
+depends_on = None
+
+INDEXES = [('ix_results_user_id_qid_created', ['user_id', 'qid', 'created']),
+           ('ix_results_user_id_setup_id_created', ['user_id', 'setup_id', 'created'])]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    op.execute('COMMIT')
+    for name, columns in INDEXES:
+        op.create_index(name, 'results', columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, columns in INDEXES:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS {0}'.format(name))
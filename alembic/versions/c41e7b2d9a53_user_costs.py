@@ -0,0 +1,33 @@
+"""user costs
+
+Revision ID: c41e7b2d9a53
+Revises: 8d3c2a9e41f7
+Create Date: 2026-10-17 16:02:37.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7b2d9a53'
+down_revision = '8d3c2a9e41f7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_costs',
+                    sa.Column('user_id', sa.Integer, primary_key=True),
+                    sa.Column('frequency', sa.String(16), primary_key=True),
+                    sa.Column('num_queries', sa.Integer),
+                    sa.Column('num_rows', sa.Integer),
+                    sa.Column('render_seconds', sa.Float),
+                    sa.Column('wall_seconds', sa.Float),
+                    sa.Column('updated', UTCDateTime),
+                    )
+
+
+def downgrade():
+    op.drop_table('user_costs')
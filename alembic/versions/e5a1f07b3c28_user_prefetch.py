@@ -0,0 +1,32 @@
+"""user prefetch
+
+Revision ID: e5a1f07b3c28
+Revises: c41e7b2d9a53
+Create Date: 2026-10-17 18:21:44.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1f07b3c28'
+down_revision = 'c41e7b2d9a53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_prefetch',
+                    sa.Column('user_id', sa.Integer, primary_key=True),
+                    sa.Column('frequency', sa.String(16), primary_key=True),
+                    sa.Column('last_sent', UTCDateTime),
+                    sa.Column('setup', sa.Text),
+                    sa.Column('email', sa.String(255)),
+                    sa.Column('fetched', UTCDateTime),
+                    )
+
+
+def downgrade():
+    op.drop_table('user_prefetch')
@@ -0,0 +1,24 @@
+"""user cost retries
+
+Revision ID: f3b8d61c9e47
+Revises: e5a1f07b3c28
+Create Date: 2026-10-17 21:42:09.361527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d61c9e47'
+down_revision = 'e5a1f07b3c28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user_costs', sa.Column('retries', sa.Integer))
+
+
+def downgrade():
+    op.drop_column('user_costs', 'retries')
@@ -0,0 +1,234 @@
+"""
+Local stand-ins for the services used by the pipeline, for benchmarks: the vault, Solr and adsws endpoints of the API,
+served by a single HTTP server, and an SMTP server that accepts and discards every message
+"""
+from __future__ import print_function
+from builtins import object
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, ThreadingTCPServer, StreamRequestHandler
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, ThreadingTCPServer, StreamRequestHandler
+    from urlparse import urlparse, parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # connections kept alive by the pipeline are dropped when it exits
+        pass
+
+
+class _ThreadingTCPServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class FakeAPI(object):
+    """
+    Serves the API endpoints called by the pipeline, from a synthetic population:
+
+        /v1/vault/myads-users/<date>         users registered since the last run
+        /v1/vault/get-myads/<id>[/<date>]    myADS setup of a user
+        /v1/search/query                     Solr queries, and citation counts (stats=true)
+        /v1/user/<id>                        email address of a user
+
+    The number of results of a Solr query is taken from the population (num_found, by query), or derived from a hash
+    of the query; documents are generated deterministically from the query, so users sharing a query get the same
+    results.
+    """
+
+    def __init__(self, setups, new_users=None, num_found=None, latency=0., solr_latency=0.):
+        """
+        :param setups: dict; user ID -> myADS setup, as returned by vault
+        :param new_users: list of user IDs returned as registered since the last run
+        :param num_found: dict; Solr query (q) -> number of results
+        :param latency: float; seconds added to each vault and adsws response
+        :param solr_latency: float; seconds added to each Solr response
+        """
+        self.setups = setups
+        self.new_users = new_users or []
+        self.num_found = num_found or {}
+        self.latency = latency
+        self.solr_latency = solr_latency
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def _docs(self, q, rows):
+        seed = int(hashlib.md5(q.encode('utf-8')).hexdigest(), 16)
+        num_found = self.num_found.get(q, seed % 20)
+        rng = random.Random(seed)
+        docs = []
+        for i in range(min(num_found, rows)):
+            arxiv_id = '{0:04d}.{1:05d}'.format(2000 + rng.randint(1, 12), rng.randint(0, 99999))
+            bibcode = '2020arXiv{0}{1}'.format(arxiv_id.replace('.', ''), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[i % 26])
+            docs.append({'bibcode': bibcode,
+                         'title': ['Synthetic paper {0} for query {1:x}'.format(i, seed % 65536)],
+                         'author_norm': ['Author, {0}'.format(chr(65 + (seed + j) % 26))
+                                         for j in range(rng.randint(1, 8))],
+                         'identifier': [bibcode, 'arXiv:{0}'.format(arxiv_id)],
+                         'year': '2020',
+                         'bibstem': ['arXiv']})
+        return num_found, docs
+
+    def handle(self, path, params):
+        """
+        :param path: string; request path
+        :param params: dict; query string parameters, as lists of values
+        :return: tuple; (HTTP status, response object)
+        """
+        parts = [p for p in path.split('/') if p]
+        if parts[:3] == ['v1', 'search', 'query']:
+            self._count('solr')
+            time.sleep(self.solr_latency)
+            q = params.get('q', [''])[0]
+            if params.get('stats', [''])[0] == 'true':
+                seed = int(hashlib.md5(q.encode('utf-8')).hexdigest(), 16)
+                return 200, {'response': {'numFound': 1, 'docs': []},
+                             'stats': {'stats_fields': {'citation_count': {'sum': seed % 500}}}}
+            num_found, docs = self._docs(q, int(params.get('rows', ['10'])[0]))
+            return 200, {'response': {'numFound': num_found, 'start': 0, 'docs': docs}}
+
+        time.sleep(self.latency)
+        if parts[:3] == ['v1', 'vault', 'myads-users']:
+            self._count('vault_users')
+            return 200, {'users': self.new_users}
+        if parts[:3] == ['v1', 'vault', 'get-myads'] and len(parts) >= 4:
+            self._count('vault_setup')
+            setup = self.setups.get(int(parts[3]))
+            if setup is None:
+                return 404, {'error': 'no myADS setup for user {0}'.format(parts[3])}
+            return 200, setup
+        if parts[:2] == ['v1', 'user'] and len(parts) == 3:
+            self._count('adsws_user')
+            return 200, {'id': int(parts[2]), 'email': 'user{0}@example.org'.format(parts[2])}
+        self._count('unknown')
+        return 404, {'error': 'unknown endpoint {0}'.format(path)}
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Starts serving from a background thread
+
+        :return: string; base URL of the API (API_ENDPOINT)
+        """
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive, as the API does; headers and body are separate writes, which Nagle's
+            # algorithm would delay
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                status, response = api.handle(url.path, parse_qs(url.query))
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://{0}:{1}'.format(*self.server.server_address)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SMTPSink(object):
+    """
+    Minimal SMTP server that accepts every message and counts them; messages aren't stored
+    """
+
+    def __init__(self, latency=0.):
+        """
+        :param latency: float; seconds added to the response to each message
+        """
+        self.latency = latency
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Starts serving from a background thread
+
+        :return: tuple; (host, port)
+        """
+        sink = self
+
+        class Handler(StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def reply(self, line):
+                self.wfile.write((line + '\r\n').encode('ascii'))
+                self.wfile.flush()
+
+            def handle(self):
+                with sink._lock:
+                    sink.connections += 1
+                self.reply('220 localhost SMTP sink')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode('ascii', 'replace').strip().upper()
+                    if command.startswith('EHLO'):
+                        self.reply('250-localhost')
+                        self.reply('250 8BITMIME')
+                    elif command.startswith('DATA'):
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        size = 0
+                        while True:
+                            data = self.rfile.readline()
+                            if not data or data.rstrip(b'\r\n') == b'.':
+                                break
+                            size += len(data)
+                        time.sleep(sink.latency)
+                        with sink._lock:
+                            sink.messages += 1
+                            sink.bytes += size
+                        self.reply('250 OK: queued')
+                    elif command.startswith('QUIT'):
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        # HELO, MAIL, RCPT, RSET, NOOP
+                        self.reply('250 OK')
+
+        self.server = _ThreadingTCPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server.server_address
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
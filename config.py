@@ -26,17 +26,119 @@ ARXIV_URL = 'https://ui.adsabs.harvard.edu/link_gateway/{0}/EPRINT_HTML?utm_sour
 
 # For stateful results, number of days after which we will consider a result stale and no longer show it
 STATEFUL_RESULTS_DAYS = 7
+# Use the normalized, per-bibcode results store (result_bibcodes table) instead of the results table
+STATEFUL_RESULTS_NORMALIZED = False
+# Number of results rows copied per transaction by `run.py --backfill-results`, before turning on the normalized store
+BACKFILL_RESULTS_BATCH_SIZE = 10000
+# Number of users whose stored results older than STATEFUL_RESULTS_DAYS are compacted per transaction
+COMPACT_RESULTS_BATCH_SIZE = 500
 
 # Number of queries to switch from one to two column email format
 NUM_QUERIES_TWO_COL = 3
 MAX_NUM_ROWS_DAILY = 2000
 MAX_NUM_ROWS_WEEKLY = 5
 
+# Queues of the processing tasks of each frequency, and of their retries, so daily and weekly runs can have their own
+# workers; higher priorities are processed first within a queue. Empty by default: all tasks go to the process queue.
+# To split them, start workers on the new queues first (e.g. celery worker -Q process_daily,retry_daily), then set e.g.
+# MYADS_QUEUES = {'daily': 'process_daily', 'weekly': 'process_weekly'}
+# MYADS_RETRY_QUEUES = {'daily': 'retry_daily', 'weekly': 'retry_weekly'}
+MYADS_QUEUES = {}
+MYADS_RETRY_QUEUES = {}
+MYADS_QUEUE_PRIORITIES = {'daily': 9, 'weekly': 3}
+MYADS_MAX_PRIORITY = 10
+# With MYADS_QUEUES, users whose last run took at least HEAVY_USER_SECONDS, or whose queries returned at least
+# HEAVY_USER_ROWS rows, are dispatched, and retried, on their own queue, so they don't hold up the workers of typical
+# users (see the user_costs table)
+MYADS_HEAVY_QUEUE = 'process_heavy'
+HEAVY_USER_SECONDS = 30
+HEAVY_USER_ROWS = 10000
+# Store the processing cost of each user
+RECORD_USER_COSTS = True
+# Number of users processed at once by all the workers of a frequency's queue, and the processing time assumed for users
+# without a recorded cost; used to predict the processing time of a run
+DISPATCH_WORKER_SLOTS = 16
+USER_SECONDS_DEFAULT = 2.
+# Dispatch users longest processing time first (run.py --longest-first). The users are then sorted by the database
+# before the first one is dispatched, instead of being streamed
+DISPATCH_LONGEST_FIRST = False
+
+# Latency histograms of the processing stages (setup, solr_gate, query, dedup, dedup_batch, email_lookup, render, send,
+# user), per frequency and, for queries, per template, and counts of emails sent; dedup_batch is the dedup of all the
+# users of a task_process_myads_batch task at once. Each worker process exports them in the
+# Prometheus text format after every task: to METRICS_FILE_DIR/myads_<pid>.prom (at most every METRICS_WRITE_INTERVAL
+# seconds; e.g. the node exporter's textfile directory) and/or at http://<host>:METRICS_PORT/metrics
+METRICS_ENABLED = False
+METRICS_FILE_DIR = None
+METRICS_PORT = None
+METRICS_WRITE_INTERVAL = 15
+# upper bounds of the histogram buckets (units=seconds)
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
 # Reschedule sending if there's an error (units=seconds)
 MYADS_RESEND_WINDOW = 60*10
 # Reschedule sending if there's an error with Solr (units=seconds)
 MYADS_SOLR_RESEND_WINDOW = 60*15
 TOTAL_RETRIES = 3
+# Seconds for which a check that Solr serves the test bibcode of a run is shared by all tasks; tasks of users parked
+# by a failed check are rescheduled together, MYADS_SOLR_RESEND_WINDOW after it
+SOLR_READY_TTL = 60*5
+# Seconds to wait for Solr when a task checks the test bibcode; while one task checks it, the others use the last
+# stored check if it was ready, or are rescheduled SOLR_READY_PENDING_DELAY seconds later
+SOLR_READY_TIMEOUT = 10
+SOLR_READY_PENDING_DELAY = 30
+# With run.py --watch, the ingest files are checked on every change (with inotify if the inotify_simple package is
+# installed), and at least every INGEST_WATCH_POLL_INTERVAL seconds; a file is read once its writer closes it, or once
+# it's unchanged for INGEST_WATCH_POLL_INTERVAL seconds. Solr is queried right away, then with delays doubling from
+# INGEST_BACKOFF_START seconds, for what remains of the timeout after the wait for the file (units=seconds)
+INGEST_WATCH_POLL_INTERVAL = 10
+INGEST_BACKOFF_START = 5
+# While run.py waits for the ingest, fetch the myADS setups and email addresses of the due users, PREFETCH_BATCH_SIZE
+# users at a time, and store them (user_prefetch table) for the processing tasks; entries are used on the day they're
+# fetched, for up to PREFETCH_MAX_AGE seconds (units=seconds)
+PREFETCH_USERS = False
+PREFETCH_BATCH_SIZE = 100
+PREFETCH_MAX_AGE = 60*60*12
+
+# Run-scoped cache of Solr query results, shared by all workers so identical queries are executed once per run
+# possible values: None (disabled), 'memory' (per-process, for testing), 'redis' (requires the redis package)
+QUERY_CACHE_BACKEND = None
+QUERY_CACHE_REDIS_URL = 'redis://localhost:6379/0'
+# units=seconds
+QUERY_CACHE_TTL = 60*60*12
+# only used by the memory backend; least recently used entries are evicted first
+QUERY_CACHE_MAX_ENTRIES = 10000
+# Number of concurrent vault and Solr requests made by the query planner (run.py --plan) and the prefetch of users
+PLANNER_THREADS = 8
+
+# Number of users processed at once by task_process_myads_concurrent, task_process_myads_batch and run.py --local, and
+# for each of them, of setups queried at once, and for each of those, of Solr sub-queries sent at once (1 = sequential).
+# Each stage has a thread pool per process, shared by all its calls; MYADS_USER_CONCURRENCY * SETUP_QUERY_THREADS *
+# SOLR_QUERY_THREADS is the number of concurrent Solr requests, and shouldn't exceed MAX_CONNECTIONS_PER_HOST
+MYADS_USER_CONCURRENCY = 4
+SETUP_QUERY_THREADS = 2
+SOLR_QUERY_THREADS = 2
+# Number of users per task_process_myads_batch task dispatched by run.py; 1 dispatches one task_process_myads per user
+MYADS_BATCH_SIZE = 1
+# Bulk dispatch of the processing tasks by run.py: publishing pauses while more than DISPATCH_MAX_QUEUE_DEPTH messages
+# are waiting, checked every DISPATCH_CHECK_EVERY messages. The broker's confirms are waited for (at most
+# DISPATCH_CONFIRM_TIMEOUT seconds each) after every DISPATCH_CONFIRM_BATCH messages; batches that aren't confirmed are
+# published again with DISPATCH_RETRY_POLICY
+DISPATCH_MAX_QUEUE_DEPTH = 100000
+DISPATCH_CHECK_EVERY = 1000
+DISPATCH_MAX_DELAY = 30
+DISPATCH_RETRY_POLICY = {'max_retries': 10, 'interval_start': 0, 'interval_step': 1, 'interval_max': 10}
+DISPATCH_CONFIRM_BATCH = 1000
+DISPATCH_CONFIRM_TIMEOUT = 30
+# For sharded runs (run.py --shard i/N), publish each shard's tasks to its own queue, e.g. process_daily_shard<i>
+SHARD_QUEUES = False
+# Maximum number of concurrent connections per host (vault, Solr, adsws) from each process
+MAX_CONNECTIONS_PER_HOST = 16
+
+# Number of new users checked and inserted per statement when registering new myADS users
+USER_INSERT_BATCH_SIZE = 1000
+# Number of user IDs read per page (each in its own transaction) when streaming the users to process from the database
+USERS_YIELD_PER = 10000
 
 # Number of days back, from today, to check for new records
 ARXIV_TIMEDELTA_DAYS = 1
@@ -47,10 +149,19 @@ ARXIV_INCOMING_ABS_DIR = '/proj/ads/abstracts/sources/ArXiv/log'
 
 # Directory for incoming astronomy articles
 ASTRO_INCOMING_DIR = '/proj/ads/abstracts/ast/index/current/'
-ASTRO_SAMPLE_SIZE = 3
+# Number of bibcodes sampled from the astronomy ingest file, all checked in Solr by a single query, and fraction of
+# them that must be found for the ingest to be complete
+ASTRO_SAMPLE_SIZE = 20
+ASTRO_VISIBLE_FRACTION = 0.8
 
 MAIL_DEFAULT_SENDER = 'ads@cfa.harvard.edu'
 MAIL_PASSWORD = None
 MAIL_PORT = 25
 MAIL_SERVER = None
 MAIL_USERNAME = None
+# SMTP connections are kept open and reused across messages by each worker process
+MAIL_POOL_MAX_CONNECTIONS = 2
+# number of messages sent on a connection before it's replaced
+MAIL_POOL_MAX_MESSAGES = 100
+# connections idle for longer than this (units=seconds) are checked with NOOP before reuse
+MAIL_POOL_IDLE_CHECK = 30
@@ -1,9 +1,174 @@
 from adsputils import get_date, ADSCelery
-from .models import AuthorInfo, Results
+from .models import AuthorInfo, KeyValue, Results, ResultBibcode, UserCost, UserPrefetch
 
 from datetime import timedelta
-from sqlalchemy.sql.expression import and_
-from sqlalchemy.orm import exc as ormexc
+from sqlalchemy.sql.expression import text
+from sqlalchemy import func, literal, or_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+import hashlib
+import json
+import requests
+import time
+
+# Stored results older than ndays are removed from the input to get the output; output results not stored
+# yet are stored as a new row (empty results sets aren't stored)
+_RECENT_RESULTS_SQL = """
+WITH stored AS (
+    SELECT unnest(results) AS bibcode, created
+    FROM results
+    WHERE user_id = :user_id AND {key_filter}
+),
+input AS (
+    SELECT DISTINCT unnest(CAST(:input_results AS VARCHAR[])) AS bibcode
+),
+output AS (
+    SELECT bibcode FROM input
+    EXCEPT
+    SELECT bibcode FROM stored WHERE created < :ndays_date
+),
+inserted AS (
+    INSERT INTO results (user_id, qid, setup_id, results, created)
+    SELECT :user_id, CAST(:qid AS VARCHAR), CAST(:setup_id AS INTEGER), array_agg(bibcode), :now
+    FROM (SELECT bibcode FROM output EXCEPT SELECT bibcode FROM stored) AS new_results
+    HAVING count(*) > 0
+)
+SELECT bibcode FROM output
+"""
+
+# Same as above, for the normalized results store: bibcodes first seen before ndays are removed from the input
+# to get the output; input bibcodes not seen before are stored (inserts are idempotent)
+_RECENT_RESULTS_NORMALIZED_SQL = """
+WITH input AS (
+    SELECT DISTINCT unnest(CAST(:input_results AS VARCHAR[])) AS bibcode
+),
+inserted AS (
+    INSERT INTO result_bibcodes (user_id, query_key, bibcode, created)
+    SELECT :user_id, :query_key, bibcode, :now FROM input
+    ON CONFLICT (user_id, query_key, bibcode) DO NOTHING
+)
+SELECT input.bibcode FROM input
+WHERE NOT EXISTS (SELECT 1 FROM result_bibcodes AS seen
+                  WHERE seen.user_id = :user_id AND seen.query_key = :query_key
+                  AND seen.bibcode = input.bibcode AND seen.created < :ndays_date)
+"""
+
+
+# History of the given stateful queries of some users, limited to the bibcodes in their input: whether each was
+# stored before ndays, per user and query. Used to dedup all the stateful queries of the users at once
+_RECENT_RESULTS_BATCH_SQL = """
+SELECT user_id,
+       CASE WHEN qid IS NOT NULL THEN 'qid:' || qid ELSE 'setup:' || setup_id END AS query_key,
+       bibcode,
+       bool_or(created < :ndays_date) AS old
+FROM results, unnest(results.results) AS bibcode
+WHERE user_id = ANY(CAST(:user_ids AS INTEGER[]))
+AND (qid = ANY(CAST(:qids AS VARCHAR[])) OR setup_id = ANY(CAST(:setup_ids AS INTEGER[])))
+AND bibcode = ANY(CAST(:input_results AS VARCHAR[]))
+GROUP BY 1, 2, 3
+"""
+
+_RECENT_RESULTS_BATCH_NORMALIZED_SQL = """
+SELECT user_id, query_key, bibcode, created < :ndays_date AS old
+FROM result_bibcodes
+WHERE user_id = ANY(CAST(:user_ids AS INTEGER[]))
+AND query_key = ANY(CAST(:query_keys AS VARCHAR[]))
+AND bibcode = ANY(CAST(:input_results AS VARCHAR[]))
+"""
+
+# Copies the results rows in a range of IDs to the normalized store. Each bibcode keeps the earliest date it was stored
+# for its query, so copying the same rows again changes nothing
+_BACKFILL_RESULT_BIBCODES_SQL = """
+INSERT INTO result_bibcodes (user_id, query_key, bibcode, created)
+SELECT user_id,
+       CASE WHEN qid IS NOT NULL THEN 'qid:' || qid ELSE 'setup:' || setup_id END,
+       bibcode,
+       min(created)
+FROM results, unnest(results.results) AS bibcode
+WHERE results.id >= :start AND results.id < :end
+AND user_id IS NOT NULL AND (qid IS NOT NULL OR setup_id IS NOT NULL)
+GROUP BY 1, 2, 3
+ON CONFLICT (user_id, query_key, bibcode)
+DO UPDATE SET created = LEAST(result_bibcodes.created, EXCLUDED.created)
+"""
+
+# Merges the stored results rows older than ndays of the next batch_size users, after the last user of the previous
+# batch, into one row per (user, qid/setup_id) key, created at the newest of the merged dates. The users and their
+# rows are read from a user_id range of the results indexes, so each row is read by a single batch. The merged row
+# stays older than ndays, so the set of old and of stored bibcodes seen by _RECENT_RESULTS_SQL doesn't change
+_COMPACT_RESULTS_SQL = """
+WITH users AS (
+    SELECT DISTINCT user_id
+    FROM results
+    WHERE user_id > :last_user_id AND created < :ndays_date
+    ORDER BY user_id
+    LIMIT :batch_size
+),
+old AS (
+    SELECT id, user_id, qid, setup_id, results, created, size
+    FROM (SELECT results.id, results.user_id, results.qid, results.setup_id, results.results, results.created,
+                 pg_column_size(results.*) AS size,
+                 count(*) OVER (PARTITION BY results.user_id, results.qid, results.setup_id) AS num_rows
+          FROM results
+          WHERE results.user_id > :last_user_id AND results.user_id <= (SELECT max(user_id) FROM users)
+            AND results.created < :ndays_date) AS batch
+    WHERE num_rows > 1
+),
+deleted AS (
+    DELETE FROM results WHERE id IN (SELECT id FROM old)
+    RETURNING id
+),
+inserted AS (
+    INSERT INTO results (user_id, qid, setup_id, results, created)
+    SELECT user_id, qid, setup_id, array_agg(DISTINCT bibcode), max(created)
+    FROM old, unnest(old.results) AS bibcode
+    GROUP BY user_id, qid, setup_id
+    RETURNING pg_column_size(results.*) AS size
+)
+SELECT (SELECT max(user_id) FROM users) AS last_user_id,
+       (SELECT count(*) FROM inserted) AS num_keys,
+       (SELECT count(*) FROM deleted) AS num_deleted,
+       (SELECT count(*) FROM inserted) AS num_inserted,
+       (SELECT coalesce(sum(size), 0) FROM old) - (SELECT coalesce(sum(size), 0) FROM inserted) AS num_bytes
+"""
+
+
+def results_query_key(qid=None, setup_id=None):
+    """
+    Key of a stateful query in the normalized results store
+    :param qid: string; QID of the query
+    :param setup_id: int; ID from myADSsetup field, for templated queries
+    :return: string
+    """
+    if qid:
+        return 'qid:{0}'.format(qid)
+    return 'setup:{0}'.format(setup_id)
+
+
+def user_shard(user_id, num_shards):
+    """
+    Shard of a user when a run is split across nodes; stable across processes and hosts
+    :param user_id: int; ADSWS user ID
+    :param num_shards: int; number of shards
+    :return: int; shard index, from 0 to num_shards - 1
+    """
+    return int(hashlib.md5(str(user_id).encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+def searcher_key(test_bibcode):
+    """
+    Key of the Solr readiness gate of a test bibcode in the storage table
+    :param test_bibcode: string; bibcode (or arXiv ID) that must be visible in Solr
+    :return: string
+    """
+    return 'searcher.ready.{0}'.format(test_bibcode)
+
+
+def advisory_lock_id(key):
+    """
+    :param key: string; name of the lock
+    :return: int; ID of a Postgres advisory lock for the name (a positive 60-bit integer)
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:15], 16)
 
 
 class myADSCelery(ADSCelery):
@@ -14,38 +179,119 @@ class myADSCelery(ADSCelery):
         :param since: used to fetch new users who registered after this date
         :return: list of user_ids
         """
+        return list(self.iter_users(since=since, frequency=frequency))
+
+    def iter_users(self, since='1971-01-01T12:00:00Z', frequency=None, yield_per=None, shard=None, by_cost=False,
+                   longest_first=False):
+        """
+        Streaming version of get_users: existing users are read from the database a page at a time, each page in
+        its own short transaction starting where the previous one ended (keyset pagination), and yielded once it's
+        read, so memory use doesn't grow with the number of users and no transaction stays open while they're
+        dispatched (except for the new users from vault, which are registered first and yielded last)
+        :param since: used to fetch new users who registered after this date
+        :param frequency: 'daily' or 'weekly'
+        :param yield_per: int; number of user IDs read from the database per page (USERS_YIELD_PER)
+        :param shard: tuple; (shard index, number of shards), to only return the users of one shard (see user_shard)
+        :param by_cost: boolean; yield users with their processing time in their last run of the frequency (see
+            record_user_costs), as (user_id, seconds) tuples; seconds is None if it's not known
+        :param longest_first: boolean; with by_cost, yield existing users longest processing time first. The
+            database sorts all the users for each page
+        :return: generator of user_ids
+        """
         if frequency == 'daily':
             last_sent_field = AuthorInfo.last_sent_daily
         elif frequency == 'weekly':
             last_sent_field = AuthorInfo.last_sent_weekly
         else:
             raise RuntimeError('Must pass frequency')
+        if yield_per is None:
+            yield_per = self._config.get('USERS_YIELD_PER', 10000)
 
-        user_ids = set()
-        with self.session_scope() as session:
-            for q in session.query(AuthorInfo).filter(last_sent_field < get_date()).all():
-                user_ids.add(q.id)
-
+        start = time.time()
         r = self.client.get(self._config.get('API_VAULT_MYADS_USERS') % get_date(since).isoformat(),
                             headers={'Accept': 'application/json',
                                      'Authorization': 'Bearer {0}'.format(self._config.get('API_TOKEN'))}
                             )
 
+        num_new = 0
+        new_users = set()
         if r.status_code != 200:
             self.logger.warning('Error getting new myADS users from API')
         else:
-            new_users = r.json()['users']
-            for n in new_users:
-                try:
-                    q = session.query(AuthorInfo).filter_by(id=n).one()
-                except ormexc.NoResultFound:
-                    author = AuthorInfo(id=n, created=get_date(), last_sent_daily=None, last_sent_weekly=None)
-                    with self.session_scope() as session:
-                        session.add(author)
-                        session.commit()
-                user_ids.add(n)
+            new_users = set(u for u in r.json()['users'] if shard is None or user_shard(u, shard[1]) == shard[0])
+            num_new = self.add_users(sorted(new_users))
+
+        num_users = 0
+        now = get_date()
+        longest_first = by_cost and longest_first
+        # sort key of the pages: user ID, or processing time (descending, unknown last) then user ID
+        last = None
+        while True:
+            with self.session_scope() as session:
+                if by_cost:
+                    query = session.query(AuthorInfo.id, UserCost.wall_seconds).\
+                        outerjoin(UserCost, (UserCost.user_id == AuthorInfo.id) & (UserCost.frequency == frequency))
+                else:
+                    query = session.query(AuthorInfo.id)
+                query = query.filter(last_sent_field < now)
+                if longest_first:
+                    key = (-func.coalesce(UserCost.wall_seconds, -1.), AuthorInfo.id)
+                    # users whose cost was recorded since the first page were dispatched already, and could
+                    # otherwise come up again in a later page
+                    query = query.filter(or_(UserCost.updated.is_(None), UserCost.updated < now))
+                    if last is not None:
+                        query = query.filter(tuple_(*key) > tuple_(*[literal(k) for k in last]))
+                else:
+                    key = (AuthorInfo.id,)
+                    if last is not None:
+                        query = query.filter(AuthorInfo.id > last[0])
+                page = query.order_by(*key).limit(yield_per).all()
+            if not page:
+                break
+            q = page[-1]
+            last = (-(q.wall_seconds if q.wall_seconds is not None else -1.), q.id) if longest_first else (q.id,)
+
+            for q in page:
+                if q.id not in new_users and (shard is None or user_shard(q.id, shard[1]) == shard[0]):
+                    num_users += 1
+                    yield (q.id, q.wall_seconds) if by_cost else q.id
+        for user_id in sorted(new_users):
+            num_users += 1
+            yield (user_id, None) if by_cost else user_id
+
+        self.logger.info('Found {0} {1} myADS users ({2} newly registered){3} in {4:.2f}s'.
+                         format(num_users, frequency, num_new,
+                                ' in shard {0}/{1}'.format(*shard) if shard else '', time.time() - start))
+
+    def add_users(self, user_ids, batch_size=None):
+        """
+        Adds users that aren't in the authors table yet, in batches, in a single transaction
+        :param user_ids: list of user IDs
+        :param batch_size: int; number of users checked and inserted per statement
+        :return: int; number of users added
+        """
+        if batch_size is None:
+            batch_size = self._config.get('USER_INSERT_BATCH_SIZE', 1000)
+
+        num_added = 0
+        now = get_date()
+        with self.session_scope() as session:
+            for i in range(0, len(user_ids), batch_size):
+                batch = set(user_ids[i:i + batch_size])
+                existing = set(q.id for q in session.query(AuthorInfo.id).filter(AuthorInfo.id.in_(batch)))
+                missing = sorted(batch.difference(existing))
+                if not missing:
+                    continue
+                # a concurrent registration of the same user is not an error
+                stmt = insert(AuthorInfo.__table__).values([{'id': n,
+                                                             'created': now,
+                                                             'last_sent_daily': None,
+                                                             'last_sent_weekly': None} for n in missing])
+                session.execute(stmt.on_conflict_do_nothing(index_elements=['id']))
+                num_added += len(missing)
+            session.commit()
 
-        return list(user_ids)
+        return num_added
 
     def get_recent_results(self, user_id=None, qid=None, setup_id=None, input_results=None, ndays=7):
         """
@@ -66,51 +312,412 @@ class myADSCelery(ADSCelery):
             self.logger.warning('Must pass either qid or setup ID to get recent results. User: {0}'.format(user_id))
             return None
 
+        if self._config.get('STATEFUL_RESULTS_NORMALIZED', False):
+            return self._get_recent_results_normalized(user_id=user_id, qid=qid, setup_id=setup_id,
+                                                       input_results=input_results, ndays=ndays)
+
         now = get_date()
         ndays_date = now - timedelta(days=ndays)
-        old_results = set()
+        # the old/new split and the insert of new results are done server-side, in a single statement;
+        # only the bibcodes to return are sent back
+        if qid:
+            sql = _RECENT_RESULTS_SQL.format(key_filter='qid = :qid')
+        else:
+            sql = _RECENT_RESULTS_SQL.format(key_filter='setup_id = :setup_id')
         with self.session_scope() as session:
-            # get stored results older than ndays old
-            if qid:
-                q = session.query(Results).filter(and_(Results.qid == qid,
-                                                       Results.user_id == user_id,
-                                                       Results.created < ndays_date)).all()
-            else:
-                q = session.query(Results).filter(and_(Results.setup_id == setup_id,
-                                                       Results.user_id == user_id,
-                                                       Results.created < ndays_date)).all()
+            rows = session.execute(text(sql), {'user_id': user_id,
+                                               'qid': qid if qid else None,
+                                               'setup_id': None if qid else setup_id,
+                                               'input_results': list(input_results),
+                                               'ndays_date': ndays_date,
+                                               'now': now}).fetchall()
+            output_results = [row.bibcode for row in rows]
+            session.commit()
 
-            for res in q:
-                old_results.update(res.results)
+        # note that old results will be returned if the bibcode has changed; it's a feature not a bug
+        return list(output_results)
 
-            # remove results older than ndays old - this is returned
-            output_results = set(input_results).difference(old_results)
+    def _get_recent_results_normalized(self, user_id=None, qid=None, setup_id=None, input_results=None, ndays=7):
+        """
+        Version of get_recent_results that uses the normalized, per-bibcode results store
 
-            # now remove the rest of the stored results, so we're not storing any overlap
-            if qid:
-                r = session.query(Results).filter(and_(Results.qid == qid,
-                                                       Results.user_id == user_id,
-                                                       Results.created >= ndays_date))
-            else:
-                r = session.query(Results).filter(and_(Results.setup_id == setup_id,
-                                                       Results.user_id == user_id,
-                                                       Results.created >= ndays_date))
+        :param user_id: int; ADSWS user ID
+        :param qid: string; QID of the query (from vault "queries" table)
+        :param setup_id: int; ID from myADSsetup field (from vault myADS export); used for templated queries
+        :param input_results: list; all results from a given query, as returned from solr
+        :param ndays: int; number of days to automatically consider results new
 
-            for res in r.all():
-                old_results.update(res.results)
+        :return: list; new results
+        """
+        now = get_date()
+        with self.session_scope() as session:
+            rows = session.execute(text(_RECENT_RESULTS_NORMALIZED_SQL),
+                                   {'user_id': user_id,
+                                    'query_key': results_query_key(qid=qid, setup_id=setup_id),
+                                    'input_results': list(input_results),
+                                    'ndays_date': now - timedelta(days=ndays),
+                                    'now': now}).fetchall()
+            output_results = [row.bibcode for row in rows]
+            session.commit()
 
-            # remove all results currently stored for this query - this is stored
-            new_results = list(output_results.difference(old_results))
+        return output_results
+
+    def get_recent_results_batch(self, user_id=None, queries=None, ndays=7):
+        """
+        Batched version of get_recent_results, for all the stateful queries of a user: the stored results of
+        all queries are read with one query, and the new results of all queries are stored in one commit. A
+        query may appear more than once (e.g. the blocks of a templated query); the output is the same as
+        calling get_recent_results for each in turn.
+
+        :param user_id: int; ADSWS user ID
+        :param queries: list of (qid, setup_id, input_results) tuples; qid is None for templated queries
+        :param ndays: int; number of days to automatically consider results new
+
+        :return: list; new results of each query, in order (None if a query has neither qid nor setup ID)
+        """
+        return self.get_recent_results_users({user_id: queries}, ndays=ndays)[user_id]
+
+    def get_recent_results_users(self, user_queries=None, ndays=7):
+        """
+        Version of get_recent_results_batch for several users at once
+
+        :param user_queries: dict; ADSWS user ID: list of (qid, setup_id, input_results) tuples
+        :param ndays: int; number of days to automatically consider results new
+
+        :return: dict; ADSWS user ID: list of new results of each query, as returned by get_recent_results_batch
+        """
+        now = get_date()
+        ndays_date = now - timedelta(days=ndays)
+        normalized = self._config.get('STATEFUL_RESULTS_NORMALIZED', False)
+
+        keys = {}
+        all_input = set()
+        for user_id, queries in user_queries.items():
+            keys[user_id] = []
+            for qid, setup_id, input_results in queries:
+                if not qid and not setup_id:
+                    self.logger.warning('Must pass either qid or setup ID to get recent results. User: {0}'.
+                                        format(user_id))
+                    keys[user_id].append(None)
+                else:
+                    keys[user_id].append(results_query_key(qid=qid, setup_id=setup_id))
+                    all_input.update(input_results)
+        if not all_input:
+            return dict((user_id, [None if key is None else [] for key in user_keys])
+                        for user_id, user_keys in keys.items())
+
+        all_queries = [q for queries in user_queries.values() for q in queries]
+        with self.session_scope() as session:
+            if normalized:
+                rows = session.execute(text(_RECENT_RESULTS_BATCH_NORMALIZED_SQL),
+                                       {'user_ids': list(user_queries.keys()),
+                                        'query_keys': list(set(k for user_keys in keys.values()
+                                                               for k in user_keys if k)),
+                                        'input_results': list(all_input),
+                                        'ndays_date': ndays_date}).fetchall()
+            else:
+                rows = session.execute(text(_RECENT_RESULTS_BATCH_SQL),
+                                       {'user_ids': list(user_queries.keys()),
+                                        'qids': list(set(q[0] for q in all_queries if q[0])),
+                                        'setup_ids': list(set(q[1] for q in all_queries if not q[0] and q[1])),
+                                        'input_results': list(all_input),
+                                        'ndays_date': ndays_date}).fetchall()
+            stored = set((row.user_id, row.query_key, row.bibcode) for row in rows)
+            old = set((row.user_id, row.query_key, row.bibcode) for row in rows if row.old)
+
+            output = {}
+            new_results = {}
+            for user_id, queries in user_queries.items():
+                output[user_id] = []
+                for key, (qid, setup_id, input_results) in zip(keys[user_id], queries):
+                    if key is None:
+                        output[user_id].append(None)
+                        continue
+                    bibcodes = set(input_results)
+                    output[user_id].append([b for b in bibcodes if (user_id, key, b) not in old])
+                    # results stored by an earlier block of the same query are recent, not old
+                    new = [b for b in bibcodes if (user_id, key, b) not in stored]
+                    stored.update((user_id, key, b) for b in new)
+                    if new:
+                        new_results.setdefault((user_id, key), (qid, setup_id, []))[2].extend(new)
 
-            # don't store empty results sets
             if new_results:
-                if qid:
-                    results = Results(user_id=user_id, qid=qid, results=new_results, created=now)
+                if normalized:
+                    session.execute(insert(ResultBibcode.__table__).
+                                    values([{'user_id': user_id, 'query_key': key, 'bibcode': bibcode, 'created': now}
+                                            for (user_id, key), (qid, setup_id, new) in new_results.items()
+                                            for bibcode in new]).
+                                    on_conflict_do_nothing())
                 else:
-                    results = Results(user_id=user_id, setup_id=setup_id, results=new_results, created=now)
+                    session.execute(Results.__table__.insert(),
+                                    [{'user_id': user_id,
+                                      'qid': qid if qid else None,
+                                      'setup_id': None if qid else setup_id,
+                                      'results': new,
+                                      'created': now} for (user_id, key), (qid, setup_id, new) in new_results.items()])
+            session.commit()
+
+        return output
+
+    def record_user_costs(self, costs, frequency):
+        """
+        Stores the processing cost of users in this run, replacing that of their previous run of the frequency
+
+        :param costs: list of dicts, with user_id, queries, rows, render_seconds, wall_seconds and, optionally,
+            retries
+        :param frequency: 'daily' or 'weekly'
+        :return: no return
+        """
+        if not costs:
+            return
+        now = get_date()
+        stmt = insert(UserCost.__table__).values([{'user_id': c['user_id'],
+                                                    'frequency': frequency,
+                                                    'num_queries': c['queries'],
+                                                    'num_rows': c['rows'],
+                                                    'render_seconds': c['render_seconds'],
+                                                    'wall_seconds': c['wall_seconds'],
+                                                    'retries': c.get('retries', 0),
+                                                    'updated': now} for c in costs])
+        stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'frequency'],
+                                          set_={'num_queries': stmt.excluded.num_queries,
+                                                'num_rows': stmt.excluded.num_rows,
+                                                'render_seconds': stmt.excluded.render_seconds,
+                                                'wall_seconds': stmt.excluded.wall_seconds,
+                                                'retries': stmt.excluded.retries,
+                                                'updated': stmt.excluded.updated})
+        with self.session_scope() as session:
+            session.execute(stmt)
+            session.commit()
+
+    def get_heavy_users(self, frequency, max_seconds=None, max_rows=None):
+        """
+        Users whose last run of the frequency was over either threshold
+
+        :param frequency: 'daily' or 'weekly'
+        :param max_seconds: float; processing time threshold (HEAVY_USER_SECONDS)
+        :param max_rows: int; threshold of the number of rows returned by Solr (HEAVY_USER_ROWS)
+        :return: set of user IDs
+        """
+        if max_seconds is None:
+            max_seconds = self._config.get('HEAVY_USER_SECONDS', 30)
+        if max_rows is None:
+            max_rows = self._config.get('HEAVY_USER_ROWS', 10000)
+        with self.session_scope() as session:
+            return set(q.user_id for q in session.query(UserCost.user_id).
+                       filter(UserCost.frequency == frequency).
+                       filter((UserCost.wall_seconds >= max_seconds) | (UserCost.num_rows >= max_rows)))
 
-                session.add(results)
+    def store_prefetched(self, entries, frequency):
+        """
+        Stores the myADS setups and email addresses of users fetched ahead of a run, replacing previous ones
+
+        :param entries: list of dicts, with user_id, last_sent (datetime the setup was fetched for), setup (list, or
+            None if it couldn't be fetched) and email (or None)
+        :param frequency: 'daily' or 'weekly'
+        :return: no return
+        """
+        if not entries:
+            return
+        now = get_date()
+        stmt = insert(UserPrefetch.__table__).values([{'user_id': e['user_id'],
+                                                       'frequency': frequency,
+                                                       'last_sent': e['last_sent'],
+                                                       'setup': json.dumps(e['setup']) if e['setup'] is not None
+                                                       else None,
+                                                       'email': e['email'],
+                                                       'fetched': now} for e in entries])
+        stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'frequency'],
+                                          set_={'last_sent': stmt.excluded.last_sent,
+                                                'setup': stmt.excluded.setup,
+                                                'email': stmt.excluded.email,
+                                                'fetched': stmt.excluded.fetched})
+        with self.session_scope() as session:
+            session.execute(stmt)
+            session.commit()
+
+    def get_prefetched(self, last_sent, frequency, max_age=None):
+        """
+        myADS setups and email addresses of users fetched ahead of this run. Entries fetched on a previous day, or
+        more than max_age seconds ago, are ignored, as is a setup fetched for another last sent date.
+
+        :param last_sent: dict; user ID -> current last sent date of the user for the frequency
+        :param frequency: 'daily' or 'weekly'
+        :param max_age: int; seconds for which a fetched entry is valid (PREFETCH_MAX_AGE)
+        :return: dict; user ID -> dict with setup (list, or None) and email (or None)
+        """
+        if not last_sent:
+            return {}
+        if max_age is None:
+            max_age = self._config.get('PREFETCH_MAX_AGE', 43200)
+        now = get_date()
+        oldest = max(now - timedelta(seconds=max_age), now.replace(hour=0, minute=0, second=0, microsecond=0))
+        prefetched = {}
+        with self.session_scope() as session:
+            for q in session.query(UserPrefetch).filter(UserPrefetch.user_id.in_(list(last_sent.keys()))).\
+                    filter(UserPrefetch.frequency == frequency).filter(UserPrefetch.fetched >= oldest):
+                if q.user_id not in last_sent:
+                    continue
+                setup = None
+                if q.setup is not None and q.last_sent == last_sent[q.user_id]:
+                    setup = json.loads(q.setup)
+                prefetched[q.user_id] = {'setup': setup, 'email': q.email}
+        return prefetched
+
+    def compact_results(self, ndays=7, batch_size=None):
+        """
+        Merges the stored results older than ndays into a single row per (user, qid/setup_id), so the number of
+        rows read by get_recent_results stays bounded. Output of get_recent_results is unchanged for the same ndays.
+        Users are compacted in batches, in user ID order, each batch starting after the last user of the previous one
+        and committed on its own, so the table is read once overall.
+
+        :param ndays: int; number of days to automatically consider results new (STATEFUL_RESULTS_DAYS)
+        :param batch_size: int; number of users compacted per transaction (COMPACT_RESULTS_BATCH_SIZE)
+
+        :return: dict; number of keys compacted, rows removed, and bytes of row data reclaimed (space is
+            reused after the table is vacuumed)
+        """
+        stats = {'keys': 0, 'rows': 0, 'bytes': 0}
+        if self._config.get('STATEFUL_RESULTS_NORMALIZED', False):
+            self.logger.info('Normalized results store in use; nothing to compact')
+            return stats
+
+        if batch_size is None:
+            batch_size = self._config.get('COMPACT_RESULTS_BATCH_SIZE', 500)
+        ndays_date = get_date() - timedelta(days=ndays)
+
+        start = time.time()
+        last_user_id = -1
+        while True:
+            with self.session_scope() as session:
+                row = session.execute(text(_COMPACT_RESULTS_SQL), {'ndays_date': ndays_date,
+                                                                   'last_user_id': last_user_id,
+                                                                   'batch_size': batch_size}).fetchone()
                 session.commit()
+            if row.last_user_id is None:
+                break
+            last_user_id = row.last_user_id
+            stats['keys'] += row.num_keys
+            stats['rows'] += row.num_deleted - row.num_inserted
+            stats['bytes'] += row.num_bytes
 
-        # note that old results will be returned if the bibcode has changed; it's a feature not a bug
-        return list(output_results)
+        self.logger.info('Compacted stored results of {0} queries in {1:.1f} s: {2} rows, {3} bytes reclaimed'.
+                         format(stats['keys'], time.time() - start, stats['rows'], stats['bytes']))
+        return stats
+
+    def backfill_result_bibcodes(self, batch_size=None):
+        """
+        Copies the stored results to the normalized store (result_bibcodes), a range of results IDs at a time, each
+        range committed on its own, so locks are held briefly and an interrupted backfill can be run again. While
+        STATEFUL_RESULTS_NORMALIZED is off, new results are only stored in the results table: run the backfill right
+        before turning it on, and once more after, to copy the results stored in between.
+
+        :param batch_size: int; number of results rows copied per transaction (BACKFILL_RESULTS_BATCH_SIZE)
+        :return: int; number of results rows read
+        """
+        if batch_size is None:
+            batch_size = self._config.get('BACKFILL_RESULTS_BATCH_SIZE', 10000)
+
+        start = time.time()
+        with self.session_scope() as session:
+            bounds = session.query(func.min(Results.id), func.max(Results.id), func.count(Results.id)).one()
+        if bounds[1] is None:
+            return 0
+
+        for first in range(bounds[0], bounds[1] + 1, batch_size):
+            with self.session_scope() as session:
+                session.execute(text(_BACKFILL_RESULT_BIBCODES_SQL), {'start': first, 'end': first + batch_size})
+                session.commit()
+
+        self.logger.info('Copied {0} stored results rows to the normalized store in {1:.1f} s'.
+                         format(bounds[2], time.time() - start))
+        return bounds[2]
+
+    def set_searcher_ready(self, test_bibcode, ready, session=None):
+        """
+        Stores the result of a Solr readiness check, so tasks can read it instead of querying Solr
+
+        :param test_bibcode: string; bibcode (or arXiv ID) that must be visible in Solr
+        :param ready: boolean; whether it was found
+        :param session: session to store it in, within its transaction (default: a new session, committed)
+        :return: dict; the stored gate, with ready and checked (ISO date)
+        """
+        gate = {'ready': bool(ready), 'checked': get_date().isoformat()}
+        if session is None:
+            with self.session_scope() as session:
+                self.set_searcher_ready(test_bibcode, ready, session=session)
+                session.commit()
+            return gate
+        kv = session.query(KeyValue).filter_by(key=searcher_key(test_bibcode)).first()
+        if kv is None:
+            session.add(KeyValue(key=searcher_key(test_bibcode), value=json.dumps(gate)))
+        else:
+            kv.value = json.dumps(gate)
+        return gate
+
+    def searcher_ready(self, test_bibcode, ttl=None, timeout=None):
+        """
+        Run-level gate on the Solr searchers serving the test bibcode. The result of the last check is shared by all
+        workers through the storage table. Once it's older than ttl, the worker that gets the gate's advisory lock
+        queries Solr again; the others don't wait for it: they get the last stored check if it was ready, and a
+        pending gate otherwise.
+
+        :param test_bibcode: string; bibcode (or arXiv ID) that must be visible in Solr
+        :param ttl: int; seconds for which a check is valid (SOLR_READY_TTL)
+        :param timeout: float; seconds to wait for Solr (SOLR_READY_TIMEOUT)
+        :return: dict; ready (boolean) and checked (ISO date of the check); pending is set, and ready is False, if
+            the gate is being checked by another worker and its last check wasn't ready
+        """
+        if ttl is None:
+            ttl = self._config.get('SOLR_READY_TTL', 300)
+        if timeout is None:
+            timeout = self._config.get('SOLR_READY_TIMEOUT', 10)
+        key = searcher_key(test_bibcode)
+
+        def stored(session):
+            kv = session.query(KeyValue).filter_by(key=key).first()
+            if kv is None or not kv.value:
+                return None
+            return json.loads(kv.value)
+
+        def fresh(gate):
+            return gate is not None and (get_date() - get_date(gate['checked'])).total_seconds() < ttl
+
+        with self.session_scope() as session:
+            gate = stored(session)
+            if fresh(gate):
+                return gate
+
+        with self.session_scope() as session:
+            # the lock is released when the check is committed; the Solr query is bounded by the timeout
+            locked = session.execute(text('SELECT pg_try_advisory_xact_lock(:lock_id)'),
+                                     {'lock_id': advisory_lock_id(key)}).scalar()
+            if not locked:
+                # an expired failed check would reschedule the user right away: wait for the new one instead
+                if gate is None or not gate['ready']:
+                    return {'ready': False, 'checked': get_date().isoformat(), 'pending': True}
+                return gate
+
+            gate = stored(session)
+            if not fresh(gate):
+                try:
+                    r = self.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.
+                                        format(self._config.get('API_SOLR_QUERY_ENDPOINT'), test_bibcode),
+                                        headers={'Authorization': 'Bearer ' + self._config.get('API_TOKEN')},
+                                        timeout=timeout)
+                except requests.exceptions.RequestException as e:
+                    self.logger.warning('Error retrieving the test bibcode {0} from solr ({1})'.
+                                        format(test_bibcode, e))
+                    ready = False
+                else:
+                    if r.status_code != 200:
+                        self.logger.warning('Error retrieving the test bibcode {0} from solr ({1})'.
+                                            format(test_bibcode, r.status_code))
+                        ready = False
+                    else:
+                        ready = r.json()['response']['numFound'] > 0
+                        if not ready:
+                            self.logger.warning('Test bibcode {0} not found in solr'.format(test_bibcode))
+                gate = self.set_searcher_ready(test_bibcode, ready, session=session)
+            session.commit()
+        return gate
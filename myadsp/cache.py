@@ -0,0 +1,170 @@
+"""Run-scoped cache for Solr query results, shared across workers"""
+
+from builtins import object
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def normalize_query(params, fields=None, rows=None):
+    """
+    Builds a stable cache key for a Solr query, independent of parameter and field ordering
+    :param params: dict of Solr query parameters (q, sort, ...)
+    :param fields: basestring; comma-delimited list of fields (fl)
+    :param rows: int; number of rows requested
+    :return: basestring; hex digest identifying the query
+    """
+    normalized = {}
+    for k, v in params.items():
+        if isinstance(v, (list, tuple)):
+            normalized[k] = [u'{0}'.format(i).strip() for i in v]
+        else:
+            normalized[k] = u'{0}'.format(v).strip()
+    if fields:
+        normalized['fl'] = sorted(f.strip() for f in fields.split(',') if f.strip())
+    if rows is not None:
+        normalized['rows'] = int(rows)
+
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class QueryCache(object):
+    """
+    Base class for the query results cache; values are stored as JSON so each caller
+    gets its own copy of the results
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    def _key(self, run_id, key):
+        return u'myads:{0}:{1}'.format(run_id, key)
+
+    def get(self, run_id, key):
+        """
+        :param run_id: basestring; identifies the processing run the cached value belongs to
+        :param key: basestring; normalized query key
+        :return: cached value, or None if not present
+        """
+        value = self._get(self._key(run_id, key))
+        self._count(run_id, 'hits' if value is not None else 'misses')
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, run_id, key, value):
+        self._set(self._key(run_id, key), json.dumps(value))
+
+    def stats(self, run_id):
+        """
+        :param run_id: basestring
+        :return: dict of hit/miss counters for the given run
+        """
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+    def _count(self, run_id, counter):
+        raise NotImplementedError
+
+
+class MemoryCache(QueryCache):
+    """
+    In-process LRU cache; only shared between threads of a single worker, used for testing
+    """
+
+    def __init__(self, ttl=3600, max_entries=10000):
+        super(MemoryCache, self).__init__(ttl=ttl)
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            expires, value = self._data.pop(key)
+            if expires < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def _count(self, run_id, counter):
+        with self._lock:
+            run_counters = self._counters.setdefault(run_id, {'hits': 0, 'misses': 0})
+            run_counters[counter] += 1
+
+    def stats(self, run_id):
+        with self._lock:
+            return dict(self._counters.get(run_id, {'hits': 0, 'misses': 0}))
+
+
+class RedisCache(QueryCache):
+    """
+    Redis-backed cache, shared by all workers of a run; eviction is left to the TTL
+    and the server's maxmemory policy
+    """
+
+    def __init__(self, url, ttl=3600):
+        if redis is None:
+            raise RuntimeError('The redis package is required for the redis query cache backend')
+        super(RedisCache, self).__init__(ttl=ttl)
+        self._client = redis.StrictRedis.from_url(url)
+
+    def _get(self, key):
+        value = self._client.get(key)
+        if value is not None and isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
+
+    def _set(self, key, value):
+        self._client.setex(key, self.ttl, value)
+
+    def _count(self, run_id, counter):
+        key = self._key(run_id, counter)
+        pipe = self._client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def stats(self, run_id):
+        hits, misses = self._client.mget(self._key(run_id, 'hits'), self._key(run_id, 'misses'))
+        return {'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+
+def get_query_cache(config):
+    """
+    Creates the query cache configured by QUERY_CACHE_BACKEND
+    :param config: dict-like app config
+    :return: QueryCache, or None if caching is disabled
+    """
+    backend = config.get('QUERY_CACHE_BACKEND', None)
+    ttl = config.get('QUERY_CACHE_TTL', 3600)
+    if not backend:
+        return None
+    elif backend == 'memory':
+        return MemoryCache(ttl=ttl, max_entries=config.get('QUERY_CACHE_MAX_ENTRIES', 10000))
+    elif backend == 'redis':
+        return RedisCache(config.get('QUERY_CACHE_REDIS_URL'), ttl=ttl)
+    else:
+        raise RuntimeError('Unknown query cache backend: {0}'.format(backend))
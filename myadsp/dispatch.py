@@ -0,0 +1,276 @@
+"""
+Bulk publishing of task messages, through one broker connection, with publisher confirms waited for a batch of
+messages at a time, and throttling on the number of messages waiting in the destination queue
+"""
+from adsputils import setup_logging, load_config
+import heapq
+import itertools
+import os
+import socket
+import time
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                       level=config.get('LOGGING_LEVEL', 'INFO'),
+                       attach_stdout=config.get('LOG_STDOUT', False))
+
+
+def chunked(items, size):
+    """
+    Splits an iterable into lists of up to size items, without reading it all first
+
+    :param items: iterable
+    :param size: int; number of items per chunk
+    :return: generator of lists
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class MakespanEstimate(object):
+    """
+    Predicted time to process a stream of jobs with a fixed number of worker slots: each job, in the order it's
+    dispatched, goes to the slot that's free first, as happens when the workers consume a queue
+    """
+
+    def __init__(self, slots):
+        """
+        :param slots: int; number of jobs processed at once
+        """
+        self.loads = [0.] * slots
+        self.jobs = 0
+
+    def add(self, seconds):
+        """
+        :param seconds: float; processing time of the next job
+        :return: no return
+        """
+        heapq.heapreplace(self.loads, self.loads[0] + seconds)
+        self.jobs += 1
+
+    @property
+    def makespan(self):
+        """
+        :return: float; seconds until all jobs are done
+        """
+        return max(self.loads)
+
+
+class PublishNacked(Exception):
+    """The broker rejected (nacked) published messages"""
+
+
+class PublisherConfirms(object):
+    """
+    Publisher confirms of an AMQP channel, waited for after a batch of messages instead of after each message, so
+    publishing doesn't take a round trip to the broker per message
+    """
+
+    def __init__(self, connection, channel):
+        """
+        :param connection: kombu connection of the channel
+        :param channel: AMQP channel the messages are published on; confirms are enabled on it
+        """
+        self.connection = connection
+        self.channel = channel
+        self.delivery_tag = 0
+        # delivery tags of the messages not confirmed yet, and of those rejected
+        self.pending = set()
+        self.nacked = set()
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._on_ack)
+        channel.events['basic_nack'].add(self._on_nack)
+
+    def _confirm(self, delivery_tag, multiple):
+        if multiple:
+            confirmed = set(t for t in self.pending if t <= delivery_tag)
+        else:
+            confirmed = set([delivery_tag]) & self.pending
+        self.pending -= confirmed
+        return confirmed
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._confirm(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self.nacked |= self._confirm(delivery_tag, multiple)
+
+    def published(self):
+        """
+        Records a message published on the channel
+        :return: no return
+        """
+        self.delivery_tag += 1
+        self.pending.add(self.delivery_tag)
+
+    def wait(self, timeout):
+        """
+        Waits until the broker has confirmed all the messages published so far
+
+        :param timeout: float; maximum number of seconds to wait for each confirm
+        :return: no return
+        :raises socket.timeout: if the broker doesn't confirm in time
+        :raises PublishNacked: if the broker rejected any of the messages
+        """
+        while self.pending:
+            self.connection.drain_events(timeout=timeout)
+        if self.nacked:
+            nacked = len(self.nacked)
+            self.nacked = set()
+            raise PublishNacked('{0} messages rejected by the broker'.format(nacked))
+
+
+class Dispatcher(object):
+    """
+    Publishes the messages of a task through a single connection and producer. Messages are published in batches
+    of confirm_batch, and the broker's confirms of a batch are waited for before the next batch is published. If
+    the connection fails, or the broker rejects messages, before a batch is confirmed, the whole batch is published
+    again on a new connection, according to the retry policy (so a message may be published twice); a batch that
+    still fails raises, so a message is never dropped silently. Before every check_every messages, the depth of
+    the destination queue is checked: above max_queue_depth, publishing waits, with increasing delays, until the
+    queue has drained to half of it.
+    """
+
+    def __init__(self, app, max_queue_depth=None, check_every=None, max_delay=None, retry_policy=None,
+                 confirm=True, confirm_batch=None, confirm_timeout=None):
+        """
+        :param app: celery application
+        :param max_queue_depth: int; number of waiting messages above which publishing waits (DISPATCH_MAX_QUEUE_DEPTH)
+        :param check_every: int; number of messages published between queue depth checks (DISPATCH_CHECK_EVERY)
+        :param max_delay: float; maximum wait between queue depth checks, in seconds (DISPATCH_MAX_DELAY)
+        :param retry_policy: dict; kombu-style retry policy of each batch (DISPATCH_RETRY_POLICY)
+        :param confirm: boolean; wait for the broker to confirm the messages
+        :param confirm_batch: int; number of messages published between waits for confirms (DISPATCH_CONFIRM_BATCH)
+        :param confirm_timeout: float; maximum number of seconds to wait for a confirm (DISPATCH_CONFIRM_TIMEOUT)
+        """
+        self.app = app
+        self.max_queue_depth = max_queue_depth or app.conf.get('DISPATCH_MAX_QUEUE_DEPTH', 100000)
+        self.check_every = check_every or app.conf.get('DISPATCH_CHECK_EVERY', 1000)
+        self.max_delay = max_delay or app.conf.get('DISPATCH_MAX_DELAY', 30)
+        self.retry_policy = retry_policy or app.conf.get('DISPATCH_RETRY_POLICY', {'max_retries': 10,
+                                                                                     'interval_start': 0,
+                                                                                     'interval_step': 1,
+                                                                                     'interval_max': 10})
+        self.confirm = confirm
+        self.confirm_batch = confirm_batch or app.conf.get('DISPATCH_CONFIRM_BATCH', 1000)
+        self.confirm_timeout = confirm_timeout or app.conf.get('DISPATCH_CONFIRM_TIMEOUT', 30)
+
+    def queue_depth(self, connection, queue):
+        """
+        Number of messages waiting in a queue, from a passive declare
+
+        :param connection: kombu connection
+        :param queue: string; queue name
+        :return: int; number of messages, or None if the broker doesn't report it (or the queue doesn't exist yet)
+        """
+        channel = connection.channel()
+        try:
+            return channel.queue_declare(queue=queue, passive=True).message_count
+        except Exception as e:
+            logger.debug('Could not get the depth of queue {0}: {1}'.format(queue, e))
+            return None
+        finally:
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+    def throttle(self, connection, queue):
+        """
+        Waits until the queue is below max_queue_depth; once over it, until it's drained to half of it
+
+        :param connection: kombu connection
+        :param queue: string; queue name
+        :return: float; seconds waited
+        """
+        waited = 0.
+        delay = 0.5
+        limit = self.max_queue_depth
+        while True:
+            depth = self.queue_depth(connection, queue)
+            if depth is None or depth < limit:
+                return waited
+            logger.info('Queue {0} has {1} messages waiting; pausing dispatch for {2} s'.format(queue, depth, delay))
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, self.max_delay)
+            limit = self.max_queue_depth // 2
+
+    def _close(self, connection):
+        try:
+            connection.release()
+        except Exception as e:
+            logger.debug('Error closing the broker connection: {0}'.format(e))
+
+    def dispatch(self, task, messages, queue=None, priority=None):
+        """
+        Publishes one message of the task per item
+
+        :param task: celery task
+        :param messages: iterable; the argument of each message
+        :param queue: string; queue to publish to (default: the task's queue)
+        :param priority: int; priority of the messages (default: none)
+        :return: dict; number of messages published (and confirmed), seconds taken, messages per second, seconds
+            spent throttled
+        """
+        options = {'queue': queue} if queue else {}
+        if priority is not None:
+            options['priority'] = priority
+        queue = queue or getattr(task, 'queue', None) or 'celery'
+        stats = {'published': 0, 'seconds': 0., 'rate': 0., 'throttled': 0.}
+        start = time.time()
+        connection = producer = confirms = None
+        try:
+            for batch in chunked(messages, self.confirm_batch):
+                attempt = 0
+                while True:
+                    if connection is None:
+                        # connects on first use
+                        connection = self.app.connection_for_write()
+                        errors = connection.recoverable_connection_errors + \
+                            connection.recoverable_channel_errors + (socket.timeout, PublishNacked)
+                    try:
+                        if producer is None:
+                            producer = self.app.amqp.Producer(connection)
+                            confirms = PublisherConfirms(connection, producer.channel) if self.confirm else None
+                        for i, message in enumerate(batch):
+                            if (stats['published'] + i) % self.check_every == 0:
+                                stats['throttled'] += self.throttle(connection, queue)
+                            task.apply_async(args=(message,), producer=producer, **options)
+                            if confirms is not None:
+                                confirms.published()
+                        if confirms is not None:
+                            confirms.wait(self.confirm_timeout)
+                        break
+                    except errors as e:
+                        attempt += 1
+                        if attempt > self.retry_policy.get('max_retries', 3):
+                            raise
+                        interval = min(self.retry_policy.get('interval_start', 0) +
+                                       (attempt - 1) * self.retry_policy.get('interval_step', 1),
+                                       self.retry_policy.get('interval_max', 10))
+                        logger.warning('Batch of {0} messages not confirmed ({1}); publishing it again in {2} s. '
+                                       'Retry {3}'.format(len(batch), e, interval, attempt))
+                        self._close(connection)
+                        connection = producer = confirms = None
+                        time.sleep(interval)
+                stats['published'] += len(batch)
+        except Exception as e:
+            logger.error('Dispatch of {0} failed after {1} messages were published: {2}'.
+                         format(task.name, stats['published'], e))
+            raise
+        finally:
+            if connection is not None:
+                self._close(connection)
+            stats['seconds'] = time.time() - start
+            if stats['seconds'] > 0:
+                stats['rate'] = stats['published'] / stats['seconds']
+
+        logger.info('Published {0} {1} messages in {2:.1f} s ({3:.0f} messages/s); throttled for {4:.1f} s'.
+                    format(stats['published'], task.name, stats['seconds'], stats['rate'], stats['throttled']))
+        return stats
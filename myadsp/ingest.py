@@ -0,0 +1,241 @@
+"""
+Detection of the completion of the arXiv and astronomy ingests: the ingest files are watched for changes (with
+inotify if the inotify_simple package is installed, by polling otherwise), and Solr is probed with increasing delays
+"""
+from adsputils import setup_logging, load_config
+from builtins import object
+import math
+import os
+import random
+import threading
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                       level=config.get('LOGGING_LEVEL', 'INFO'),
+                       attach_stdout=config.get('LOG_STDOUT', False))
+
+# path -> (modification time, size, number of records, sample size, sample) of the last file sampled
+_samples = {}
+_samples_lock = threading.Lock()
+
+
+def backoff_delays(start, maximum, factor=2):
+    """
+    Exponentially increasing delays, capped at maximum
+
+    :param start: float; first delay, in seconds
+    :param maximum: float; maximum delay, in seconds
+    :param factor: float; growth factor of each delay
+    :return: infinite generator of floats
+    """
+    delay = start
+    while True:
+        yield min(delay, maximum)
+        delay = min(delay * factor, maximum)
+
+
+def file_mtime(path):
+    """
+    :param path: string; file path
+    :return: float; modification time of the file, as a timestamp, or None if it doesn't exist
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _records(flist):
+    """
+    :param flist: open ingest file
+    :return: generator of the first column of each non-empty line
+    """
+    for l in flist:
+        fields = l.split()
+        if fields:
+            yield fields[0]
+
+
+def sample_records(path, size, rng=None):
+    """
+    Counts the records of an ingest file and draws a uniform random sample of them (first column of each line), in
+    a single pass over the file with constant memory. The result is cached by modification time and size of the
+    file, so checks of an unchanged file don't read it again.
+
+    :param path: string; path of the ingest file
+    :param size: int; number of records to sample
+    :param rng: random.Random; source of randomness (default: the random module)
+    :return: tuple; (number of records, list of min(size, number of records) sampled records)
+    :raises IOError: if the file can't be read
+    """
+    rng = rng or random
+    with open(path, 'rt') as flist:
+        stat = os.fstat(flist.fileno())
+        with _samples_lock:
+            cached = _samples.get(path)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size) and cached[3] == size:
+            return cached[2], list(cached[4])
+
+        # reservoir sampling: the i-th record replaces a sampled one with probability size / i
+        count = 0
+        sample = []
+        for record in _records(flist):
+            count += 1
+            if len(sample) < size:
+                sample.append(record)
+            else:
+                j = rng.randint(0, count - 1)
+                if j < size:
+                    sample[j] = record
+
+    with _samples_lock:
+        _samples[path] = (stat.st_mtime, stat.st_size, count, size, list(sample))
+    return count, sample
+
+
+def max_record(path):
+    """
+    Greatest record of an ingest file (first column of each line), read in a single pass with constant memory
+
+    :param path: string; path of the ingest file
+    :return: string, or None if the file has no records
+    :raises IOError: if the file can't be read
+    """
+    greatest = None
+    with open(path, 'rt') as flist:
+        for record in _records(flist):
+            if greatest is None or record > greatest:
+                greatest = record
+    return greatest
+
+
+def visible_records(client, identifiers):
+    """
+    Finds which of a sample of ingested records are visible in Solr, with a single query OR'ing their identifiers
+
+    :param client: requests.Session
+    :param identifiers: list of strings; bibcodes (or other identifiers) of the records
+    :return: set of the identifiers found, or None if the query failed
+    """
+    q = 'identifier:({0})'.format(' OR '.join('"{0}"'.format(i.replace('\\', '\\\\').replace('"', '\\"'))
+                                              for i in identifiers))
+    r = client.get(config.get('API_SOLR_QUERY_ENDPOINT'),
+                   params={'q': q, 'fl': 'bibcode,identifier', 'rows': 2 * len(identifiers)},
+                   headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
+    if r.status_code != 200:
+        logger.error('Error retrieving the ingest sample from Solr ({0} {1})'.format(r.status_code, r.text))
+        return None
+
+    wanted = set(identifiers)
+    found = set()
+    for doc in r.json()['response']['docs']:
+        found.update(wanted.intersection([doc.get('bibcode')] + doc.get('identifier', [])))
+    return found
+
+
+class FileWatcher(object):
+    """
+    Waits for a file to be ready, checking it each time it, or the directory it's created in, changes. The file's
+    directory doesn't need to exist yet: the nearest existing ancestor is watched until it's created.
+    """
+
+    def __init__(self, path, poll_interval=None, use_inotify=True):
+        """
+        :param path: string; path of the watched file
+        :param poll_interval: float; seconds between checks when inotify isn't available, and maximum time between
+            checks with inotify, in case an event is missed (INGEST_WATCH_POLL_INTERVAL)
+        :param use_inotify: boolean; use inotify if the inotify_simple package is installed
+        """
+        self.path = path
+        self.poll_interval = poll_interval or config.get('INGEST_WATCH_POLL_INTERVAL', 10)
+        self.mode = 'inotify' if use_inotify and inotify_simple is not None else 'poll'
+
+    def _watched_dir(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        while not os.path.isdir(directory):
+            directory = os.path.dirname(directory)
+        return directory
+
+    def _signature(self):
+        """
+        :return: tuple; (modification time, size) of the file, or None if it doesn't exist
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def wait(self, ready, timeout, settle=False):
+        """
+        Checks immediately, then on every change, if the file is ready
+
+        :param ready: callable; receives the file path, returns True once the file is ready
+        :param timeout: float; maximum number of seconds to wait
+        :param settle: boolean; if True, the file is only ready once it's been closed after writing (as reported by
+            inotify), or once its size and modification time haven't changed for poll_interval seconds, so that a
+            file still being written isn't read
+        :return: float; seconds waited until the file was ready, or None if the timeout was reached
+        """
+        start = time.time()
+        # (modification time, size) of the file, and time it was first seen; True once the writer closed the file
+        seen = [None, None]
+        closed = [False]
+
+        def check():
+            """
+            :return: tuple; (True if the file is ready, maximum number of seconds to wait before the next check)
+            """
+            now = time.time()
+            delay = min(self.poll_interval, timeout - (now - start))
+            if not ready(self.path):
+                return False, delay
+            if not settle:
+                return True, delay
+            signature = self._signature()
+            if signature is not None and (closed[0] or (signature == seen[0] and now - seen[1] >= self.poll_interval)):
+                return True, delay
+            if signature != seen[0]:
+                seen[:] = [signature, now]
+            # checked again as soon as the file may have settled
+            return False, min(delay, seen[1] + self.poll_interval - now)
+
+        if self.mode == 'poll':
+            while True:
+                done, delay = check()
+                if done:
+                    return time.time() - start
+                if time.time() - start >= timeout:
+                    return None
+                time.sleep(delay)
+
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+        name = os.path.basename(self.path)
+        inotify = inotify_simple.INotify()
+        try:
+            directory = None
+            while True:
+                # the watch is in place before the check, so a change just after it isn't missed
+                if self._watched_dir() != directory:
+                    directory = self._watched_dir()
+                    inotify.add_watch(directory, mask)
+                    logger.debug('Watching {0} for changes to {1}'.format(directory, self.path))
+                done, delay = check()
+                if done:
+                    return time.time() - start
+                if time.time() - start >= timeout:
+                    return None
+                for event in inotify.read(timeout=int(math.ceil(max(delay, 0) * 1000))):
+                    if event.name == name and directory == os.path.dirname(os.path.abspath(self.path)):
+                        # a write after the file was closed means it's being written again
+                        closed[0] = bool(event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO))
+        finally:
+            inotify.close()
@@ -0,0 +1,186 @@
+"""Pool of persistent, authenticated SMTP connections, shared by all sends in a worker process"""
+
+from builtins import object
+from past.builtins import basestring
+import smtplib
+import socket
+import threading
+import time
+
+
+class SMTPPool(object):
+    """
+    Reuses SMTP sessions across messages. Idle connections are checked with NOOP before reuse, and each connection
+    is retired after max_messages sends. Opening a connection (connect and HELO) is retried once, and so is a message
+    whose connection is dropped before its DATA command (e.g. closed by the server while idle), on a fresh connection:
+    nothing has been delivered yet. A message whose send fails once DATA has begun isn't sent again, as the server may
+    have accepted it: the error is raised, and if the caller retries, the message is delivered at least once.
+    """
+
+    def __init__(self, host, port, use_tls=False, username=None, password=None, max_connections=2,
+                 max_messages=100, idle_check=30, factory=None):
+        """
+        :param host: basestring; SMTP server
+        :param port: int; SMTP port
+        :param use_tls: if True, STARTTLS is issued on each new connection
+        :param username: basestring; login username, if the server requires authentication
+        :param password: basestring; login password
+        :param max_connections: int; maximum number of open connections
+        :param max_messages: int; number of messages sent on a connection before it's closed and replaced
+        :param idle_check: int; connections idle longer than this (in seconds) are checked with NOOP before reuse
+        :param factory: callable returning a new SMTP connection (default smtplib.SMTP)
+        """
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.max_messages = max_messages
+        self.idle_check = idle_check
+        self.factory = factory
+        # idle connections, as [connection, messages sent, last used]
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._stats = {'connections_opened': 0,
+                       'connections_closed': 0,
+                       'reconnects': 0,
+                       'messages_sent': 0,
+                       'errors': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _connect(self):
+        factory = self.factory or smtplib.SMTP
+        try:
+            conn = factory(self.host, self.port)
+            conn.ehlo_or_helo_if_needed()
+        except (smtplib.SMTPConnectError, smtplib.SMTPHeloError, smtplib.SMTPServerDisconnected, socket.error):
+            # nothing has been sent yet; try again once
+            self._count('reconnects')
+            conn = factory(self.host, self.port)
+            conn.ehlo_or_helo_if_needed()
+        if self.use_tls:
+            conn.starttls()
+        if self.username and self.password:
+            conn.login(self.username, self.password)
+        self._count('connections_opened')
+        return [conn, 0, time.time()]
+
+    def _close(self, entry):
+        try:
+            entry[0].quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self._count('connections_closed')
+
+    def _is_alive(self, entry):
+        if time.time() - entry[2] < self.idle_check:
+            return True
+        try:
+            return entry[0].noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                return self._connect()
+            if self._is_alive(entry):
+                return entry
+            self._close(entry)
+            self._count('reconnects')
+
+    def _release(self, entry):
+        if entry[1] >= self.max_messages:
+            self._close(entry)
+            return
+        entry[2] = time.time()
+        with self._lock:
+            self._idle.append(entry)
+
+    def _envelope(self, conn, from_addr, to_addrs, size):
+        """
+        Starts a message, as smtplib.SMTP.sendmail does: MAIL FROM, then RCPT TO for each recipient
+
+        :raises smtplib.SMTPServerDisconnected: if the connection is dropped, or the server closes it (421)
+        """
+        to_addrs = [to_addrs] if isinstance(to_addrs, basestring) else list(to_addrs)
+        conn.ehlo_or_helo_if_needed()
+        options = ['size={0}'.format(size)] if conn.does_esmtp and conn.has_extn('size') else []
+        code, resp = conn.mail(from_addr, options)
+        if code == 421:
+            raise smtplib.SMTPServerDisconnected(resp)
+        if code != 250:
+            conn.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for addr in to_addrs:
+            code, resp = conn.rcpt(addr)
+            if code == 421:
+                raise smtplib.SMTPServerDisconnected(resp)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            conn.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Sends a message on a pooled connection
+        :param from_addr: basestring
+        :param to_addrs: basestring or list of recipients
+        :param msg: basestring; the full message
+        :return: no return; SMTP errors are raised to the caller, including a connection dropped once DATA has
+            begun, after which the message may or may not have been delivered
+        """
+        with self._slots:
+            entry = None
+            try:
+                entry = self._acquire()
+                try:
+                    self._envelope(entry[0], from_addr, to_addrs, len(msg))
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    # dropped before the message was sent, e.g. closed by the server while idle; send it on a fresh
+                    # connection
+                    self._close(entry)
+                    self._count('reconnects')
+                    entry = None
+                    entry = self._connect()
+                    self._envelope(entry[0], from_addr, to_addrs, len(msg))
+                code, resp = entry[0].data(msg)
+                if code != 250:
+                    raise smtplib.SMTPDataError(code, resp)
+            except Exception:
+                self._count('errors')
+                if entry is not None:
+                    self._close(entry)
+                raise
+            entry[1] += 1
+            self._count('messages_sent')
+            self._release(entry)
+
+    def health(self):
+        """
+        :return: dict of pool counters, plus the number of idle and in-use connections
+        """
+        with self._lock:
+            health = dict(self._stats)
+            health['idle'] = len(self._idle)
+        health['open'] = health['connections_opened'] - health['connections_closed']
+        health['in_use'] = health['open'] - health['idle']
+        return health
+
+    def close(self):
+        """
+        Closes all idle connections
+        :return: no return
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._close(entry)
@@ -0,0 +1,314 @@
+"""Latency histograms and counters of the processing stages, exported in the Prometheus text format"""
+
+from builtins import object
+from adsputils import setup_logging, load_config
+import bisect
+import errno
+import os
+import re
+import socket
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                       level=config.get('LOGGING_LEVEL', 'INFO'),
+                       attach_stdout=config.get('LOG_STDOUT', False))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = 'myads_stage_seconds'
+_FILE_NAME = re.compile(r'^myads_(\d+)\.prom$')
+_HELP = {STAGE_SECONDS: 'Time spent in each stage of myADS processing, in seconds',
+         'myads_emails_total': 'Outcome of the myADS emails of each user'}
+
+
+def _labels(labels):
+    """
+    :param labels: tuple of (name, value) pairs
+    :return: string; Prometheus label set
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.time() - self.start, **self.labels)
+        return False
+
+
+class Metrics(object):
+    """
+    Registry of the stage latency histograms and the counters of a process. When disabled, every method returns
+    right away, without recording anything.
+    """
+
+    def __init__(self, enabled=True, buckets=None, file_dir=None, port=None, write_interval=15):
+        """
+        :param enabled: boolean; record metrics
+        :param buckets: list of floats; upper bounds of the histogram buckets, in seconds
+        :param file_dir: string; directory the metrics of each process are written to, as <dir>/myads_<pid>.prom
+            (e.g. the textfile directory of the node exporter)
+        :param port: int; port of the HTTP endpoint serving the metrics at /metrics
+        :param write_interval: float; minimum number of seconds between writes of the metrics file
+        """
+        self.enabled = enabled
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+        self.file_dir = file_dir
+        self.port = port
+        self.write_interval = write_interval
+        self._lock = threading.Lock()
+        # (name, labels) -> [bucket counts, sum, count]
+        self._histograms = {}
+        # (name, labels) -> value
+        self._counters = {}
+        self._written = 0
+        self._server_pid = None
+        self._file_pid = None
+
+    def observe(self, stage, seconds, **labels):
+        """
+        Records the duration of a stage
+
+        :param stage: string; processing stage, e.g. setup, query, dedup (dedup_batch for the users of a batch task
+            at once), render, send
+        :param seconds: float; duration
+        :param labels: other labels, e.g. frequency, template
+        :return: no return
+        """
+        if not self.enabled:
+            return
+        key = (STAGE_SECONDS, tuple(sorted(dict(labels, stage=stage).items())))
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0., 0]
+            if i < len(self.buckets):
+                histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timer(self, stage, **labels):
+        """
+        Context manager recording the duration of its block as a stage
+
+        :param stage: string; processing stage
+        :param labels: other labels, e.g. frequency, template
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage, labels)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter
+
+        :param name: string; counter name, e.g. myads_emails_total
+        :param value: number to add
+        :param labels: labels of the counter
+        :return: no return
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self, pid=False):
+        """
+        :param pid: boolean; add the process ID as a label of every series, so the series of the worker processes
+            of a node don't collide
+        :return: string; all metrics, in the Prometheus text exposition format
+        """
+        process = (('pid', str(os.getpid())),) if pid else ()
+        with self._lock:
+            histograms = sorted(((name, process + labels), [list(v[0]), v[1], v[2]])
+                                for (name, labels), v in self._histograms.items())
+            counters = sorted(((name, process + labels), value) for (name, labels), value in self._counters.items())
+
+        lines = []
+        names = set()
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in names:
+                names.add(name)
+                lines.append('# HELP {0} {1}'.format(name, _HELP.get(name, name)))
+                lines.append('# TYPE {0} histogram'.format(name))
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels + (('le', repr(float(bound))),)),
+                                                         cumulative))
+            lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{0}_sum{1} {2!r}'.format(name, _labels(labels), total))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels), count))
+        for (name, labels), value in counters:
+            if name not in names:
+                names.add(name)
+                lines.append('# HELP {0} {1}'.format(name, _HELP.get(name, name)))
+                lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0}{1} {2}'.format(name, _labels(labels), value))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write(self, path):
+        """
+        Writes the metrics to a file, atomically, so a reader never sees a partial file
+
+        :param path: string; file path
+        :return: no return
+        """
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render(pid=True))
+        os.rename(tmp, path)
+
+    def file_path(self, pid=None):
+        """
+        :param pid: int; process ID (default: this process)
+        :return: string; path of the metrics file of the process, or None if METRICS_FILE_DIR isn't set
+        """
+        if not self.file_dir:
+            return None
+        return os.path.join(self.file_dir, 'myads_{0}.prom'.format(pid or os.getpid()))
+
+    def remove_file(self):
+        """
+        Removes the metrics file of this process, when it exits, so its series stop being exported
+        :return: no return
+        """
+        path = self.file_path()
+        if path and self._file_pid == os.getpid():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def remove_stale_files(self):
+        """
+        Removes the metrics files of processes that are gone without removing theirs (e.g. killed)
+        :return: list of the paths removed
+        """
+        removed = []
+        for name in os.listdir(self.file_dir):
+            match = _FILE_NAME.match(name)
+            if not match or _process_exists(int(match.group(1))):
+                continue
+            try:
+                os.remove(os.path.join(self.file_dir, name))
+                removed.append(os.path.join(self.file_dir, name))
+            except OSError:
+                pass
+        return removed
+
+    def start_http_server(self, port):
+        """
+        Serves the metrics at http://<host>:<port>/metrics from a background thread
+
+        :param port: int; port to listen on
+        :return: HTTPServer
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render(pid=True).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('', port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def export(self, force=False):
+        """
+        Exports the metrics as configured: writes the metrics file of this process, at most every write_interval
+        seconds, and starts the HTTP endpoint of this process if it's not running yet. Called after each task.
+
+        :param force: boolean; write the metrics file even if it was written less than write_interval seconds ago
+        :return: no return
+        """
+        if not self.enabled:
+            return
+        if self.port and self._server_pid != os.getpid():
+            # worker processes are forked: each starts its own endpoint, and only the first one gets the port
+            self._server_pid = os.getpid()
+            try:
+                self.start_http_server(self.port)
+            except socket.error as e:
+                logger.warning('Could not serve metrics on port {0} (process {1}): {2}'.
+                               format(self.port, os.getpid(), e))
+        if self.file_dir and (force or time.time() - self._written >= self.write_interval):
+            self._written = time.time()
+            try:
+                if self._file_pid != os.getpid():
+                    # first write of this process
+                    self._file_pid = os.getpid()
+                    self.remove_stale_files()
+                self.write(self.file_path())
+            except (IOError, OSError) as e:
+                logger.warning('Could not write metrics to {0}: {1}'.format(self.file_dir, e))
+
+
+def _process_exists(pid):
+    """
+    :param pid: int; process ID
+    :return: boolean; whether a process with this ID is running on this node
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_metrics(config):
+    """
+    Creates the metrics registry configured by METRICS_ENABLED
+    :param config: dict-like app config
+    :return: Metrics; disabled unless METRICS_ENABLED is set
+    """
+    return Metrics(enabled=config.get('METRICS_ENABLED', False),
+                   buckets=config.get('METRICS_BUCKETS', None),
+                   file_dir=config.get('METRICS_FILE_DIR', None),
+                   port=config.get('METRICS_PORT', None),
+                   write_interval=config.get('METRICS_WRITE_INTERVAL', 15))
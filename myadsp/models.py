@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import Column, Integer, ARRAY, String, Text
+from sqlalchemy import Column, Float, Index, Integer, ARRAY, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 import json
 from adsputils import get_date, UTCDateTime
@@ -26,6 +26,9 @@ class AuthorInfo(Base):
     last_sent_daily = Column(UTCDateTime)
     last_sent_weekly = Column(UTCDateTime)
 
+    __table_args__ = (Index('ix_authors_last_sent_daily', 'last_sent_daily'),
+                      Index('ix_authors_last_sent_weekly', 'last_sent_weekly'))
+
 
 class Results(Base):
     __tablename__ = 'results'
@@ -35,4 +38,50 @@ class Results(Base):
     qid = Column(String(32))
     setup_id = Column(Integer)
     results = Column(ARRAY(String))
-    created = Column(UTCDateTime)
\ No newline at end of file
+    created = Column(UTCDateTime)
+
+    # match the two lookup paths of get_recent_results
+    __table_args__ = (Index('ix_results_user_id_qid_created', 'user_id', 'qid', 'created'),
+                      Index('ix_results_user_id_setup_id_created', 'user_id', 'setup_id', 'created'))
+
+
+class ResultBibcode(Base):
+    """One row per bibcode seen by a stateful query; replaces Results if STATEFUL_RESULTS_NORMALIZED is set"""
+    __tablename__ = 'result_bibcodes'
+
+    user_id = Column(Integer, primary_key=True)
+    # 'qid:<qid>' for general queries, 'setup:<setup_id>' for templated queries
+    query_key = Column(String(64), primary_key=True)
+    bibcode = Column(String(64), primary_key=True)
+    # first time the bibcode was returned by the query
+    created = Column(UTCDateTime)
+
+
+class UserCost(Base):
+    """Processing cost of a user in the latest run of each frequency"""
+    __tablename__ = 'user_costs'
+
+    user_id = Column(Integer, primary_key=True)
+    frequency = Column(String(16), primary_key=True)
+    # number of Solr queries (result blocks) and rows returned
+    num_queries = Column(Integer)
+    num_rows = Column(Integer)
+    render_seconds = Column(Float)
+    wall_seconds = Column(Float)
+    # number of times the user was rescheduled in the run, on errors
+    retries = Column(Integer)
+    updated = Column(UTCDateTime)
+
+
+class UserPrefetch(Base):
+    """myADS setup and email address of a user, fetched ahead of a run of the frequency"""
+    __tablename__ = 'user_prefetch'
+
+    user_id = Column(Integer, primary_key=True)
+    frequency = Column(String(16), primary_key=True)
+    # last sent date of the user when the setup was fetched: the queries of the setup start the day after it
+    last_sent = Column(UTCDateTime)
+    # JSON, as returned by vault
+    setup = Column(Text)
+    email = Column(String(255))
+    fetched = Column(UTCDateTime)
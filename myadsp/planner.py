@@ -0,0 +1,134 @@
+"""Run-level query planner: deduplicates the queries of all due users before the per-user tasks are dispatched"""
+
+from builtins import object
+from adsputils import setup_logging, load_config
+from collections import OrderedDict
+import datetime
+import os
+import time
+
+from .cache import normalize_query
+from .models import AuthorInfo
+from myadsp import utils
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                       level=config.get('LOGGING_LEVEL', 'INFO'),
+                       attach_stdout=config.get('LOG_STDOUT', False))
+
+
+class QueryPlan(object):
+    """
+    Global table of the distinct queries of a run, and the users subscribed to each
+    """
+
+    def __init__(self, run_id, frequency):
+        self.run_id = run_id
+        self.frequency = frequency
+        # user ID -> myADS setup, as fetched from vault
+        self.setups = {}
+        # normalized query key -> query params and subscribed users
+        self.queries = OrderedDict()
+        # normalized citations query key -> citations query and subscribed users
+        self.citations = OrderedDict()
+        self.num_user_queries = 0
+
+    def add_user(self, userid, setup):
+        """
+        Adds the queries of a user's setup to the plan
+        :param userid: adsws user ID
+        :param setup: list of myADS setups, as returned by vault
+        :return: no return
+        """
+        self.setups[userid] = setup
+        for s in setup:
+            if s.get('frequency') != self.frequency or not s.get('query'):
+                continue
+            utils.set_query_options(s)
+            for params in s['query']:
+                key = normalize_query(params, fields=s['fields'], rows=s['rows'])
+                entry = self.queries.setdefault(key, {'params': params,
+                                                      'fields': s['fields'],
+                                                      'rows': s['rows'],
+                                                      'users': set()})
+                entry['users'].add(userid)
+                self.num_user_queries += 1
+            if s.get('template') == 'citations':
+                key = normalize_query({'q': s['data'], 'stats.field': 'citation_count'})
+                entry = self.citations.setdefault(key, {'data': s['data'], 'users': set()})
+                entry['users'].add(userid)
+
+    def execute(self, threads=8):
+        """
+        Runs each distinct query once, with bounded parallelism, storing the results in the query cache
+        :param threads: int; maximum number of concurrent Solr requests
+        :return: int; number of queries that failed (they will be retried by the per-user tasks)
+        """
+        def run_query(entry):
+            try:
+                if 'data' in entry:
+                    utils.get_citation_count(entry['data'], run_id=self.run_id)
+                else:
+                    utils.get_query_docs(entry['params'], entry['fields'], entry['rows'], run_id=self.run_id)
+            except Exception as e:
+                logger.warning('Planned query {0} failed for run {1}: {2}'.format(entry, self.run_id, e))
+                return False
+            return True
+
+        entries = list(self.queries.values()) + list(self.citations.values())
+        results = utils.map_concurrent(run_query, entries, threads=threads, stage='planner')
+
+        return results.count(False)
+
+
+def plan_run(app, user_ids, frequency, run_id, threads=8):
+    """
+    Fetches the setups of every due user, builds the table of distinct queries, and executes each one once,
+    so the per-user tasks only read precomputed results from the query cache
+
+    :param app: myADSCelery app
+    :param user_ids: list of adsws user IDs due for processing
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param run_id: basestring; ID of the processing run
+    :param threads: int; maximum number of concurrent vault and Solr requests
+    :return: QueryPlan, or None if there's no shared query cache to store the results in
+    """
+    if utils.query_cache is None:
+        logger.warning('Query planning requires a query cache (QUERY_CACHE_BACKEND); skipping planning phase')
+        return None
+
+    start = time.time()
+    plan = QueryPlan(run_id, frequency)
+
+    last_sent = {}
+    with app.session_scope() as session:
+        for q in session.query(AuthorInfo).filter(AuthorInfo.id.in_(user_ids)).all():
+            if frequency == 'daily':
+                last_sent[q.id] = q.last_sent_daily
+            else:
+                last_sent[q.id] = q.last_sent_weekly
+
+    def fetch_setup(userid):
+        if last_sent.get(userid):
+            # the start date should be one day after the last sent date, so the results don't overlap
+            start_date = last_sent[userid] + datetime.timedelta(days=1)
+            return userid, utils.get_myads_setup(userid=userid, start_date=start_date)
+        return userid, utils.get_myads_setup(userid=userid)
+
+    setups = utils.map_concurrent(fetch_setup, user_ids, threads=threads, stage='planner')
+
+    for userid, setup in setups:
+        # users whose setup couldn't be fetched are left to their own task, which retries the fetch
+        if setup is not None:
+            plan.add_user(userid, setup)
+
+    plan_time = time.time() - start
+    failed = plan.execute(threads=threads)
+
+    logger.info('Query plan for run {0}: {1} users, {2} user queries, {3} distinct queries, {4} distinct citation '
+                'queries, {5} failed. Planning took {6:.1f}s, execution {7:.1f}s'.
+                format(run_id, len(plan.setups), plan.num_user_queries, len(plan.queries), len(plan.citations),
+                       failed, plan_time, time.time() - start - plan_time))
+
+    return plan
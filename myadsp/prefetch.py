@@ -0,0 +1,66 @@
+"""Prefetch of the myADS setups and email addresses of due users, while a run waits for the ingest to complete"""
+
+from adsputils import setup_logging, load_config
+import datetime
+import os
+import time
+
+from .dispatch import chunked
+from .models import AuthorInfo
+from myadsp import utils
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                       level=config.get('LOGGING_LEVEL', 'INFO'),
+                       attach_stdout=config.get('LOG_STDOUT', False))
+
+
+def prefetch_users(app, user_ids, frequency, threads=8, batch_size=100, stop=None):
+    """
+    Fetches the myADS setups and email addresses of users ahead of a run, and stores them, a batch of users at a
+    time, so the processing tasks don't have to fetch them
+
+    :param app: myADSCelery app
+    :param user_ids: iterable of adsws user IDs due for processing
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param threads: int; maximum number of concurrent vault and adsws requests
+    :param batch_size: int; number of users fetched and stored at a time
+    :param stop: threading.Event; once set, prefetching stops after the current batch
+    :return: dict; number of users, and of setups and email addresses fetched
+    """
+    stats = {'users': 0, 'setups': 0, 'emails': 0}
+    start = time.time()
+
+    for chunk in chunked(user_ids, batch_size):
+        if stop is not None and stop.is_set():
+            logger.info('Stopping prefetch of {0} users'.format(frequency))
+            break
+
+        last_sent = {}
+        with app.session_scope() as session:
+            for q in session.query(AuthorInfo).filter(AuthorInfo.id.in_(chunk)).all():
+                if frequency == 'daily':
+                    last_sent[q.id] = q.last_sent_daily
+                else:
+                    last_sent[q.id] = q.last_sent_weekly
+
+        def fetch(userid):
+            sent = last_sent.get(userid)
+            if sent:
+                # the start date should be one day after the last sent date, so the results don't overlap
+                setup = utils.get_myads_setup(userid=userid, start_date=sent + datetime.timedelta(days=1))
+            else:
+                setup = utils.get_myads_setup(userid=userid)
+            return {'user_id': userid, 'last_sent': sent, 'setup': setup, 'email': utils.get_user_email(userid=userid)}
+
+        entries = utils.map_concurrent(fetch, chunk, threads=threads, stage='planner')
+        app.store_prefetched(entries, frequency)
+
+        stats['users'] += len(entries)
+        stats['setups'] += len([e for e in entries if e['setup'] is not None])
+        stats['emails'] += len([e for e in entries if e['email'] is not None])
+
+    logger.info('Prefetched {0} setups and {1} email addresses of {2} {3} users in {4:.1f}s'.
+                format(stats['setups'], stats['emails'], stats['users'], frequency, time.time() - start))
+    return stats
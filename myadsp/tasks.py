@@ -4,12 +4,15 @@ from myadsp import app as app_module
 from myadsp import utils
 from .models import AuthorInfo
 from .emails import myADSTemplate
+from .metrics import get_metrics
 
 #from flask import current_app
 from kombu import Queue
+from celery.signals import task_postrun, worker_process_shutdown, worker_shutdown
 import os
 import json
 import datetime
+import time
 from sqlalchemy.orm import exc as ormexc
 
 # ============================= INITIALIZATION ==================================== #
@@ -20,128 +23,191 @@ logger = app.logger
 
 app.conf.CELERY_QUEUES = (
     Queue('process', app.exchange, routing_key='process'),
-)
+) + tuple(Queue(name, app.exchange, routing_key=name, max_priority=app.conf.get('MYADS_MAX_PRIORITY', 10))
+          for name in sorted(set(list(app.conf.get('MYADS_QUEUES', {}).values()) +
+                                 list(app.conf.get('MYADS_RETRY_QUEUES', {}).values()) +
+                                 ([app.conf.get('MYADS_HEAVY_QUEUE', 'process_heavy')]
+                                  if app.conf.get('MYADS_QUEUES', {}) else []))))
 
-# ============================= TASKS ============================================= #
+utils.limit_host_connections(app.client, app.conf.get('MAX_CONNECTIONS_PER_HOST', 16))
 
-@app.task(queue='process')
-def task_process_myads(message):
+# stage latencies and email outcomes of this worker process; no-op unless METRICS_ENABLED
+metrics = get_metrics(app.conf)
+
+# ============================= FUNCTIONS ========================================= #
+
+def task_options(frequency, retry=False, heavy=False):
     """
-    Process the myADS notifications for a given user
+    Queue and priority of the processing tasks of a frequency, so daily and weekly runs get their own workers
 
-    :param message: contains the message inside the packet
-        {
-         'userid': adsws user ID,
-         'frequency': 'daily' or 'weekly',
-         'force': Boolean (if present, we'll reprocess myADS notifications for the user,
-            even if they were already processed today)
-         'test_send_to': email address to send output to, if not that of the user (for testing)
-         'retries': number of retries attempted
-        }
+    :param frequency: 'daily' or 'weekly'
+    :param retry: boolean; options for a retry, which goes to the frequency's retry queue
+    :param heavy: boolean; options for a user that's expensive to process, which goes to the heavy users queue,
+        retries included
+    :return: dict; apply_async options (empty if there's no queue configured for the frequency: the task goes to
+        the process queue)
+    """
+    if frequency not in app.conf.get('MYADS_QUEUES', {}):
+        return {}
+    queues = app.conf.get('MYADS_RETRY_QUEUES', {}) if retry else app.conf.get('MYADS_QUEUES', {})
+    if heavy:
+        queue = app.conf.get('MYADS_HEAVY_QUEUE', 'process_heavy')
+    elif frequency in queues:
+        queue = queues[frequency]
+    else:
+        return {}
+    return {'queue': queue, 'priority': app.conf.get('MYADS_QUEUE_PRIORITIES', {}).get(frequency, 0)}
+
+
+def retry_later(message, countdown):
+    """
+    Enqueues a user again, after countdown seconds, on the retry queue of its frequency, or on the heavy users queue
+    if it was dispatched there
+
+    :param message: message of task_process_myads
+    :param countdown: int; seconds
     :return: no return
     """
+    task_process_myads.apply_async(args=(message,), countdown=countdown,
+                                   **task_options(message.get('frequency', None), retry=True,
+                                                  heavy=message.get('heavy', False)))
 
-    if 'userid' not in message:
-        logger.error('No user ID received for {0}'.format(message))
-        return
-    if 'frequency' not in message:
-        logger.error('No frequency received for {0}'.format(message))
+
+def process_users_concurrently(messages):
+    """
+    Processes the myADS notifications for many users concurrently within this process, MYADS_USER_CONCURRENCY at a
+    time; each user goes through task_process_myads, so dedup, retries, and last sent dates behave identically
+
+    :param messages: list of task_process_myads messages
+    :return: int; number of users whose processing raised an exception
+    """
+    def process(message):
+        try:
+            task_process_myads(message)
+        except Exception as e:
+            logger.exception('Error processing myADS notifications for {0}: {1}'.format(message.get('userid'), e))
+            return False
+        return True
+
+    results = utils.map_concurrent(process, messages, stage='users')
+    return results.count(False)
+
+
+def _already_sent(message, last_sent):
+    """
+    Checks if the user's email of this frequency was already sent today
+
+    :param message: message of task_process_myads
+    :param last_sent: datetime; last sent date of the user for this frequency
+    :return: True if the email was sent today and processing isn't forced
+    """
+    if last_sent and last_sent.date() == adsputils.get_date().date():
+        # already sent email today
+        if not message['force']:
+            logger.warning('Email for user {0} already sent today'.format(message['userid']))
+            return True
+        else:
+            logger.info('Email for user {0} already sent today, but force mode is on'.format(message['userid']))
+    return False
+
+
+def _use_prefetched(messages, last_sent):
+    """
+    Adds the myADS setups and email addresses fetched ahead of the run to the messages of users, if PREFETCH_USERS
+    is set, so they aren't fetched again
+
+    :param messages: list of task_process_myads messages
+    :param last_sent: dict; user ID -> last sent date of the user for the frequency of its message
+    :return: no return
+    """
+    if not app.conf.get('PREFETCH_USERS', False):
         return
+    for frequency in set(message['frequency'] for message in messages):
+        selected = [message for message in messages if message['frequency'] == frequency]
+        prefetched = app.get_prefetched(dict((message['userid'], last_sent.get(message['userid']))
+                                             for message in selected), frequency)
+        for message in selected:
+            entry = prefetched.get(message['userid'])
+            if entry is None:
+                continue
+            if message.get('setup', None) is None and entry['setup'] is not None:
+                message['setup'] = entry['setup']
+            if message.get('email', None) is None and entry['email'] is not None:
+                message['email'] = entry['email']
+
 
+def _get_query_results(message, last_sent):
+    """
+    Fetches the myADS setup of a user and executes the queries of this frequency; the user is rescheduled on errors
+
+    :param message: message of task_process_myads
+    :param last_sent: datetime; last sent date of the user for this frequency
+    :return: list of (setup, query type, raw results block) tuples, or None if processing stopped
+    """
     userid = message['userid']
-    with app.session_scope() as session:
-        try:
-            q = session.query(AuthorInfo).filter_by(id=userid).one()
-            if message['frequency'] == 'daily':
-                last_sent = q.last_sent_daily
-            else:
-                last_sent = q.last_sent_weekly
-        except ormexc.NoResultFound:
-            author = AuthorInfo(id=userid, created=adsputils.get_date(), last_sent_daily=None, last_sent_weekly=None)
-            session.add(author)
-            session.flush()
-            last_sent = None
-            session.commit()
-        if last_sent and last_sent.date() == adsputils.get_date().date():
-            # already sent email today
-            if not message['force']:
-                logger.warning('Email for user {0} already sent today'.format(userid))
-                return
-            else:
-                logger.info('Email for user {0} already sent today, but force mode is on'.format(userid))
+    frequency = message['frequency']
 
-    # first fetch the myADS setup from /vault/get-myads
-    if last_sent:
+    # first fetch the myADS setup from /vault/get-myads, unless the planner or the prefetch already fetched it
+    if message.get('setup', None) is not None:
+        setup = message['setup']
+    elif last_sent:
         # the start date should be one day after the last sent date, so the results don't overlap
         start_date = last_sent + datetime.timedelta(days=1)
-        r = app.client.get(app.conf.get('API_VAULT_MYADS_SETUP_DATE') % (userid, start_date),
-                           headers={'Accept': 'application/json',
-                                    'Authorization': 'Bearer {0}'.format(app.conf.get('API_TOKEN'))})
+        with metrics.timer('setup', frequency=frequency):
+            setup = utils.get_myads_setup(userid=userid, start_date=start_date)
     else:
-        r = app.client.get(app.conf.get('API_VAULT_MYADS_SETUP') % userid,
-                           headers={'Accept': 'application/json',
-                                    'Authorization': 'Bearer {0}'.format(app.conf.get('API_TOKEN'))})
+        with metrics.timer('setup', frequency=frequency):
+            setup = utils.get_myads_setup(userid=userid)
 
-    if r.status_code != 200:
+    if setup is None:
         if message.get('retries', None):
             retries = message['retries']
         else:
             retries = 0
         if retries < app.conf.get('TOTAL_RETRIES', 3):
             message['retries'] = retries + 1
-            task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_RESEND_WINDOW', 3600))
+            retry_later(message, app.conf.get('MYADS_RESEND_WINDOW', 3600))
             logger.warning('Failed getting myADS setup for {0}; will try again later. Retry {1}'.format(userid, retries))
-            return
+            return None
         else:
             logger.warning('Maximum number of retries attempted for {0}. myADS processing failed.'.format(userid))
-            return
+            return None
 
     if message.get('test_bibcode', None):
-        # check that the solr searcher we're getting is still ok by querying for the test bibcode
-        q = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(app.conf.get('API_SOLR_QUERY_ENDPOINT'),
-                                                                                          message.get('test_bibcode')),
-                           headers={'Authorization': 'Bearer ' + app.conf.get('API_TOKEN')})
-
-        fail = True
-        if q.status_code != 200:
-            logger.warning('Error retrieving the test bibcode {0} from solr while processing for user {1}. Retrying'.
-                           format(message.get('test_bibcode'), userid))
-        elif q.json()['response']['numFound'] == 0:
-            logger.warning('Test bibcode {0} not found in solr while processing for user {1}. Retrying'.
-                           format(message.get('test_bibcode'), userid))
-        else:
-            fail = False
-
-        if fail:
+        # check that the solr searcher we're getting is still ok; the check is shared by all the tasks of the run
+        with metrics.timer('solr_gate', frequency=frequency):
+            gate = app.searcher_ready(message.get('test_bibcode'))
+        if gate.get('pending'):
+            # another worker is checking Solr for the first time: try again shortly, without counting a retry
+            retry_later(message, app.conf.get('SOLR_READY_PENDING_DELAY', 30))
+            logger.info('Solr searchers being checked while processing myADS email for user {0}; rerunning'.
+                        format(userid))
+            return None
+        if not gate['ready']:
             if message.get('solr_retries', None):
                 retries = message['solr_retries']
             else:
                 retries = 0
             if retries < app.conf.get('TOTAL_RETRIES', 3):
                 message['solr_retries'] = retries + 1
-                task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_SOLR_RESEND_WINDOW', 3600))
-                logger.warning('Solr error occurred while processing myADS email for user {0}; rerunning. Retry {1}'.
-                               format(userid, retries))
-                return
+                # all the users parked by the same check are woken up together, once it's due again
+                checked = adsputils.get_date(gate['checked'])
+                countdown = app.conf.get('MYADS_SOLR_RESEND_WINDOW', 3600) - \
+                    (adsputils.get_date() - checked).total_seconds()
+                retry_later(message, max(int(countdown), 0))
+                logger.warning('Solr searchers not updated while processing myADS email for user {0}; rerunning. '
+                               'Retry {1}'.format(userid, retries))
+                return None
             else:
                 logger.warning('Maximum number of retries attempted for {0}. myADS processing failed: '
                                'solr searchers were not updated.'.format(userid))
-                return
+                return None
 
-    # then execute each qid /vault/execute-query/qid
-    setup = r.json()
-    payload = []
-    has_results = 0
+    # select the setups to process in this round
+    setups = []
     for s in setup:
         if s['frequency'] == message['frequency']:
-            # only return 5 results, unless it's the daily arXiv posting, then return max
-            # TODO should all stateful queries return all results or will this be overwhelming for some? well-cited
-            # users can get 40+ new cites in one weekly astro update
-            if s['frequency'] == 'daily':
-                s['rows'] = app.conf.get('MAX_NUM_ROWS_DAILY', 2000)
-            else:
-                s['rows'] = app.conf.get('MAX_NUM_ROWS_WEEKLY', 5)
-            s['fields'] = 'bibcode,title,author_norm,identifier,year,bibstem'
+            utils.set_query_options(s)
             if s['type'] == 'query':
                 qtype = 'general'
             elif s['type'] == 'template':
@@ -149,108 +215,398 @@ def task_process_myads(message):
             else:
                 logger.warning('Wrong query type passed for query {0}, user {1}'.format(s, userid))
                 continue
-
-            try:
-                raw_results = utils.get_template_query_results(s)
-            except RuntimeError:
-                if message.get('query_retries', None):
-                    retries = message['query_retries']
-                else:
-                    retries = 0
-                if retries < app.conf.get('TOTAL_RETRIES', 3):
-                    message['query_retries'] = retries + 1
-                    logger.warning('Error getting template query results for user {0}. Retrying. '
-                                   'Retry:'.format(userid, retries))
-                    task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_RESEND_WINDOW', 3600))
-                    return
-                else:
-                    logger.warning('Maximum number of query retries attempted for user {0}; myADS processing '
-                                   'failed due to retrieving query results failures.'.format(userid))
-                    continue
-
-            for r in raw_results:
-                # for stateful queries, remove previously seen results, store new results
-                if s['stateful']:
-                    docs = r['results']
-                    bibcodes = [doc['bibcode'] for doc in docs]
-                    if s.get('qid', None):
-                        good_bibc = app.get_recent_results(user_id=userid,
-                                                           qid=s['qid'],
-                                                           input_results=bibcodes,
-                                                           ndays=app.conf.get('STATEFUL_RESULTS_DAYS', 7))
-                    else:
-                        good_bibc = app.get_recent_results(user_id=userid,
-                                                           setup_id=s['id'],
-                                                           input_results=bibcodes,
-                                                           ndays=app.conf.get('STATEFUL_RESULTS_DAYS', 7))
-                    results = [doc for doc in docs if doc['bibcode'] in good_bibc]
-                else:
-                    results = r['results']
-
-                # keep track of queries that have returned results
-                if results:
-                    has_results += 1
-
-                # even if a query doesn't have results, still include it in the email for completeness
-                payload.append({'name': r['name'],
-                                'query_url': r['query_url'],
-                                'results': results,
-                                'query': r['query'],
-                                'qtype': qtype,
-                                'id': s['id']})
+            setups.append((s, qtype))
         else:
             # wrong frequency for this round of processing
             continue
 
+    def get_results(item):
+        s, qtype = item
+        try:
+            with metrics.timer('query', frequency=frequency, template=qtype):
+                return utils.get_template_query_results(s, run_id=message.get('run_id', None)), None
+        except RuntimeError as e:
+            return None, e
+
+    # then execute each qid /vault/execute-query/qid; all setups are queried concurrently
+    all_results = utils.map_concurrent(get_results, setups, stage='setups')
+
+    blocks = []
+    for (s, qtype), (raw_results, error) in zip(setups, all_results):
+        if error is not None:
+            if message.get('query_retries', None):
+                retries = message['query_retries']
+            else:
+                retries = 0
+            if retries < app.conf.get('TOTAL_RETRIES', 3):
+                message['query_retries'] = retries + 1
+                logger.warning('Error getting template query results for user {0}. Retrying. '
+                               'Retry:'.format(userid, retries))
+                retry_later(message, app.conf.get('MYADS_RESEND_WINDOW', 3600))
+                return None
+            else:
+                logger.warning('Maximum number of query retries attempted for user {0}; myADS processing '
+                               'failed due to retrieving query results failures.'.format(userid))
+                continue
+
+        for r in raw_results:
+            blocks.append((s, qtype, r))
+
+    return blocks
+
+
+def _stateful_queries(blocks):
+    """
+    :param blocks: list of (setup, query type, raw results block) tuples
+    :return: list of (qid, setup ID, bibcodes) of the stateful blocks, as taken by get_recent_results_batch
+    """
+    return [(s.get('qid', None), s['id'], [doc['bibcode'] for doc in r['results']])
+            for s, qtype, r in blocks if s['stateful']]
+
+
+def _retries(message):
+    """
+    :param message: message of task_process_myads
+    :return: int; number of times the user was rescheduled in this run, on any error
+    """
+    return sum(message.get(k, None) or 0 for k in ('retries', 'solr_retries', 'query_retries', 'send_retries',
+                                                    'batch_retries'))
+
+
+def _user_cost(message, blocks):
+    """
+    :param message: message of task_process_myads
+    :param blocks: list of (setup, query type, raw results block) tuples
+    :return: dict; processing cost of the user, as stored by record_user_costs (times are filled in later)
+    """
+    return {'user_id': message['userid'],
+            'queries': len(blocks),
+            'rows': sum(len(r['results']) for s, qtype, r in blocks),
+            'render_seconds': 0.,
+            'wall_seconds': 0.,
+            'retries': _retries(message)}
+
+
+def _send_notification(message, blocks, new_bibcodes, cost=None):
+    """
+    Builds the payload of a user from the query results and emails it; sending is rescheduled on errors
+
+    :param message: message of task_process_myads
+    :param blocks: list of (setup, query type, raw results block) tuples
+    :param new_bibcodes: list; new results of each stateful block, as returned by get_recent_results_batch
+    :param cost: dict; if given, the time taken to render the email is added to its render_seconds
+    :return: True if the email was sent
+    """
+    userid = message['userid']
+    new_bibcodes = iter(new_bibcodes)
+
+    payload = []
+    has_results = 0
+    for s, qtype, r in blocks:
+        if s['stateful']:
+            good_bibc = set(next(new_bibcodes) or [])
+            results = [doc for doc in r['results'] if doc['bibcode'] in good_bibc]
+        else:
+            results = r['results']
+
+        # keep track of queries that have returned results
+        if results:
+            has_results += 1
+
+        # even if a query doesn't have results, still include it in the email for completeness
+        payload.append({'name': r['name'],
+                        'query_url': r['query_url'],
+                        'results': results,
+                        'query': r['query'],
+                        'qtype': qtype,
+                        'id': s['id']})
+
     # don't send the email if there are no matching queries or if all matching queries return no results
     if len(payload) == 0 or has_results == 0:
         logger.info('No payload for user {0} for the {1} email. No email was sent.'.format(userid, message['frequency']))
-        return
+        metrics.inc('myads_emails_total', frequency=message['frequency'], outcome='empty')
+        return False
 
-    # if test email address provided, send there; otherwise fetch user email address
+    # if test email address provided, send there; otherwise fetch user email address, unless it was prefetched
     if message.get('test_send_to', None):
         email = message.get('test_send_to')
+    elif message.get('email', None):
+        email = message['email']
     else:
-        email = utils.get_user_email(userid=userid)
+        with metrics.timer('email_lookup', frequency=message['frequency']):
+            email = utils.get_user_email(userid=userid)
 
     if message['frequency'] == 'daily':
         subject = 'Daily myADS Notification'
     else:
         subject = 'Weekly myADS Notification'
 
+    start = time.time()
     payload_plain = utils.payload_to_plain(payload)
     if len(payload) < app.conf.get('NUM_QUERIES_TWO_COL', 3):
         payload_html = utils.payload_to_html(payload, col=1, frequency=message['frequency'], email_address=email)
     else:
         payload_html = utils.payload_to_html(payload, col=2, frequency=message['frequency'], email_address=email)
-    msg = utils.send_email(email_addr=email,
-                           email_template=myADSTemplate,
-                           payload_plain=payload_plain,
-                           payload_html=payload_html,
-                           subject=subject)
+    render_seconds = time.time() - start
+    metrics.observe('render', render_seconds, frequency=message['frequency'])
+    if cost is not None:
+        cost['render_seconds'] += render_seconds
+    with metrics.timer('send', frequency=message['frequency']):
+        msg = utils.send_email(email_addr=email,
+                               email_template=myADSTemplate,
+                               payload_plain=payload_plain,
+                               payload_html=payload_html,
+                               subject=subject)
 
     if msg:
-        # update author table w/ last sent datetime
-        with app.session_scope() as session:
+        metrics.inc('myads_emails_total', frequency=message['frequency'], outcome='sent')
+        return True
+
+    metrics.inc('myads_emails_total', frequency=message['frequency'], outcome='failed')
+
+    if message.get('send_retries', None):
+        retries = message['send_retries']
+    else:
+        retries = 0
+    if retries < app.conf.get('TOTAL_RETRIES', 3):
+        message['send_retries'] = retries + 1
+        retry_later(message, app.conf.get('MYADS_RESEND_WINDOW', 3600))
+        logger.warning('Error sending myADS email for user {0}, email {1}; rerunning. Retry {2}'.format(userid, email, retries))
+    else:
+        logger.warning('Maximum number of retries attempted for {0}. myADS processing failed at sending the email.'.format(userid))
+    return False
+
+
+def _set_last_sent(userids, frequency):
+    """
+    Updates the last sent date of the given users for this frequency
+
+    :param userids: list of user IDs
+    :param frequency: 'daily' or 'weekly'
+    :return: no return
+    """
+    if not userids:
+        return
+    column = AuthorInfo.last_sent_daily if frequency == 'daily' else AuthorInfo.last_sent_weekly
+    with app.session_scope() as session:
+        session.query(AuthorInfo).filter(AuthorInfo.id.in_(userids)).\
+            update({column: adsputils.get_date()}, synchronize_session=False)
+        session.commit()
+
+
+# ============================= TASKS ============================================= #
+
+@app.task(queue='process')
+def task_process_myads(message):
+    """
+    Process the myADS notifications for a given user
+
+    :param message: contains the message inside the packet
+        {
+         'userid': adsws user ID,
+         'frequency': 'daily' or 'weekly',
+         'force': Boolean (if present, we'll reprocess myADS notifications for the user,
+            even if they were already processed today)
+         'test_send_to': email address to send output to, if not that of the user (for testing)
+         'retries': number of retries attempted
+         'run_id': ID of the processing run; Solr results are shared between users of the same run
+         'setup': myADS setup of the user, if it was already fetched from vault by the query planner or prefetched
+         'email': email address of the user, if it was prefetched
+        }
+    :return: no return
+    """
+
+    if 'userid' not in message:
+        logger.error('No user ID received for {0}'.format(message))
+        return
+    if 'frequency' not in message:
+        logger.error('No frequency received for {0}'.format(message))
+        return
+
+    userid = message['userid']
+    with app.session_scope() as session:
+        try:
             q = session.query(AuthorInfo).filter_by(id=userid).one()
             if message['frequency'] == 'daily':
-                q.last_sent_daily = adsputils.get_date()
+                last_sent = q.last_sent_daily
             else:
-                q.last_sent_weekly = adsputils.get_date()
-
+                last_sent = q.last_sent_weekly
+        except ormexc.NoResultFound:
+            author = AuthorInfo(id=userid, created=adsputils.get_date(), last_sent_daily=None, last_sent_weekly=None)
+            session.add(author)
+            session.flush()
+            last_sent = None
             session.commit()
+    if _already_sent(message, last_sent):
+        return
+    _use_prefetched([message], {userid: last_sent})
 
-    else:
-        if message.get('send_retries', None):
-            retries = message['send_retries']
-        else:
-            retries = 0
-        if retries < app.conf.get('TOTAL_RETRIES', 3):
-            message['send_retries'] = retries + 1
-            task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_RESEND_WINDOW', 3600))
-            logger.warning('Error sending myADS email for user {0}, email {1}; rerunning. Retry {2}'.format(userid, email, retries))
-            return
+    start = time.time()
+    blocks = _get_query_results(message, last_sent)
+    if blocks is None:
+        return
+    cost = _user_cost(message, blocks)
+
+    # for stateful queries, remove previously seen results, store new results; all queries are done at once
+    stateful = _stateful_queries(blocks)
+    new_bibcodes = []
+    if stateful:
+        with metrics.timer('dedup', frequency=message['frequency']):
+            new_bibcodes = app.get_recent_results_batch(user_id=userid,
+                                                        queries=stateful,
+                                                        ndays=app.conf.get('STATEFUL_RESULTS_DAYS', 7))
+
+    if utils.query_cache is not None and message.get('run_id', None):
+        logger.debug('Query cache stats for run {0}: {1}'.format(message['run_id'],
+                                                                utils.query_cache.stats(message['run_id'])))
+
+    if _send_notification(message, blocks, new_bibcodes, cost=cost):
+        # update author table w/ last sent datetime
+        _set_last_sent([userid], message['frequency'])
+
+    cost['wall_seconds'] = time.time() - start
+    metrics.observe('user', cost['wall_seconds'], frequency=message['frequency'])
+    if app.conf.get('RECORD_USER_COSTS', True):
+        app.record_user_costs([cost], message['frequency'])
+
+
+@app.task(queue='process')
+def task_process_myads_concurrent(messages):
+    """
+    Process the myADS notifications for several users concurrently in one worker
+
+    :param messages: list of messages, each as accepted by task_process_myads
+    :return: no return
+    """
+    failed = process_users_concurrently(messages)
+    if failed:
+        logger.warning('myADS processing failed for {0} of {1} users in concurrent batch'.format(failed, len(messages)))
+
+
+
+@app.task(queue='process')
+def task_process_myads_batch(messages):
+    """
+    Process the myADS notifications for a chunk of users in one task. Author info and stateful results history
+    are read for the whole chunk at once, and the users share this worker's HTTP, SMTP and database connections.
+    Retries are per user, as in task_process_myads; a user whose processing fails unexpectedly is re-enqueued on
+    its own.
+
+    :param messages: list of messages, each as accepted by task_process_myads
+    :return: no return
+    """
+    valid = []
+    for message in messages:
+        if 'userid' not in message:
+            logger.error('No user ID received for {0}'.format(message))
+        elif 'frequency' not in message:
+            logger.error('No frequency received for {0}'.format(message))
         else:
-            logger.warning('Maximum number of retries attempted for {0}. myADS processing failed at sending the email.'.format(userid))
-            return
+            valid.append(message)
+    if not valid:
+        return
+
+    userids = [message['userid'] for message in valid]
+    last_sent = {}
+    with app.session_scope() as session:
+        for q in session.query(AuthorInfo).filter(AuthorInfo.id.in_(userids)).all():
+            last_sent[q.id] = (q.last_sent_daily, q.last_sent_weekly)
+    app.add_users([userid for userid in userids if userid not in last_sent])
+    if app.conf.get('PREFETCH_USERS', False):
+        sent_dates = {}
+        for message in valid:
+            sent = last_sent.get(message['userid'], (None, None))
+            sent_dates[message['userid']] = sent[0] if message['frequency'] == 'daily' else sent[1]
+        _use_prefetched(valid, sent_dates)
+
+    def requeue(message, e):
+        logger.exception('Error processing myADS notifications for {0} in batch: {1}; '
+                         'processing the user on its own'.format(message['userid'], e))
+        message['batch_retries'] = (message.get('batch_retries', None) or 0) + 1
+        retry_later(message, app.conf.get('MYADS_RESEND_WINDOW', 3600))
+
+    def fetch(message):
+        try:
+            sent = last_sent.get(message['userid'], (None, None))
+            sent = sent[0] if message['frequency'] == 'daily' else sent[1]
+            if _already_sent(message, sent):
+                return None
+            start = time.time()
+            blocks = _get_query_results(message, sent)
+            if blocks is None:
+                return None
+            cost = _user_cost(message, blocks)
+            cost['wall_seconds'] = time.time() - start
+            return blocks, cost
+        except Exception as e:
+            requeue(message, e)
+            return None
+
+    fetched = [(message, result[0], result[1]) for message, result in zip(valid, utils.map_concurrent(fetch, valid,
+                                                                                                      stage='users'))
+               if result is not None]
+
+    # for stateful queries, remove previously seen results, store new results; all users are done at once
+    user_queries = dict((message['userid'], _stateful_queries(blocks)) for message, blocks, cost in fetched)
+    try:
+        with metrics.timer('dedup_batch', frequency=valid[0]['frequency']):
+            new_bibcodes = app.get_recent_results_users(dict((userid, queries) for userid, queries
+                                                             in user_queries.items() if queries),
+                                                        ndays=app.conf.get('STATEFUL_RESULTS_DAYS', 7))
+    except Exception as e:
+        for message, blocks, cost in fetched:
+            requeue(message, e)
+        return
+
+    def send(item):
+        message, blocks, cost = item
+        start = time.time()
+        try:
+            return _send_notification(message, blocks, new_bibcodes.get(message['userid'], []), cost=cost)
+        except Exception as e:
+            requeue(message, e)
+            return False
+        finally:
+            cost['wall_seconds'] += time.time() - start
+            metrics.observe('user', cost['wall_seconds'], frequency=message['frequency'])
+
+    sent = utils.map_concurrent(send, fetched, stage='users')
+    for frequency in ('daily', 'weekly'):
+        _set_last_sent([message['userid'] for (message, blocks, cost), s in zip(fetched, sent)
+                        if s and message['frequency'] == frequency], frequency)
+        if app.conf.get('RECORD_USER_COSTS', True):
+            app.record_user_costs([cost for message, blocks, cost in fetched if message['frequency'] == frequency],
+                                  frequency)
+
+    if utils.query_cache is not None and valid[0].get('run_id', None):
+        logger.debug('Query cache stats for run {0}: {1}'.format(valid[0]['run_id'],
+                                                                utils.query_cache.stats(valid[0]['run_id'])))
+    logger.info('Processed myADS notifications for a batch of {0} users; {1} emails sent'.
+                format(len(valid), sent.count(True)))
 
+
+@task_postrun.connect
+def export_metrics(**kwargs):
+    """
+    Exports the metrics of this worker process after each task
+    """
+    metrics.export()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def remove_metrics_file(**kwargs):
+    """
+    Removes the metrics file of this worker process when it exits (e.g. recycled after max tasks per child)
+    """
+    metrics.remove_file()
+
+
+@app.task(queue='process')
+def task_compact_results():
+    """
+    Compact the stored results of stateful queries; meant to be scheduled with celery beat, e.g. daily
+
+    :return: dict; number of keys compacted, rows and bytes reclaimed
+    """
+    return app.compact_results(ndays=app.conf.get('STATEFUL_RESULTS_DAYS', 7))
@@ -1,12 +1,16 @@
 import unittest
 import os
 import httpretty
-from sqlalchemy.sql.expression import and_
+import requests
+from sqlalchemy.sql.expression import and_, text
 from datetime import timedelta
 
 import adsputils as utils
 from myadsp import app
-from myadsp.models import AuthorInfo, Results, Base
+from myadsp.app import user_shard, advisory_lock_id
+import json
+from myadsp.models import AuthorInfo, KeyValue, Results, ResultBibcode, UserCost, Base
+from mock import patch
 
 
 class TestmyADSCelery(unittest.TestCase):
@@ -79,6 +83,107 @@ class TestmyADSCelery(unittest.TestCase):
         users = app.get_users(since=since, frequency='daily')
         self.assertEqual([1,2,3], users)
 
+        # new users are registered, without last sent dates
+        with self.app.session_scope() as session:
+            authors = session.query(AuthorInfo).order_by(AuthorInfo.id).all()
+            self.assertEqual([a.id for a in authors], [1, 2, 3])
+            self.assertIsNone(authors[1].last_sent_daily)
+            self.assertIsNone(authors[2].last_sent_weekly)
+
+        # existing users are left alone when registering in batches
+        self.assertEqual(app.add_users([1, 2, 3, 4, 5], batch_size=2), 2)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(AuthorInfo).count(), 5)
+            self.assertEqual(session.query(AuthorInfo).filter_by(id=1).one().last_sent_daily, since)
+
+    @httpretty.activate
+    def test_iter_users(self):
+        app = self.app
+        since = utils.get_date('2000-01-02')
+
+        with self.app.session_scope() as session:
+            for i in range(1, 6):
+                session.add(AuthorInfo(id=i, created=since, last_sent_daily=since, last_sent_weekly=None))
+            session.commit()
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_VAULT_MYADS_USERS'] % since.isoformat(),
+            content_type='application/json',
+            status=200,
+            body='{"users":[5,7,6]}'
+        )
+
+        # existing users are streamed first, then the new users; each user once. Each page of users is read in its
+        # own transaction (after the one registering the new users)
+        with patch.object(app, 'session_scope', wraps=app.session_scope) as session_scope:
+            users = app.iter_users(since=since, frequency='daily', yield_per=2)
+            self.assertFalse(isinstance(users, list))
+            users = list(users)
+        self.assertEqual(sorted(users[:4]), [1, 2, 3, 4])
+        self.assertEqual(users[4:], [5, 6, 7])
+        self.assertEqual(session_scope.call_count, 1 + 4)
+
+        # new users are registered; weekly users without a last sent date are only the new ones
+        self.assertEqual(list(app.iter_users(since=since, frequency='weekly')), [5, 6, 7])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(AuthorInfo).count(), 7)
+
+        with self.assertRaises(RuntimeError):
+            list(app.iter_users(since=since))
+
+        # shards partition the users
+        shards = [list(app.iter_users(since=since, frequency='daily', shard=(i, 3))) for i in range(3)]
+        self.assertEqual(sorted(sum(shards, [])), [1, 2, 3, 4, 5, 6, 7])
+        for i, users in enumerate(shards):
+            self.assertTrue(all(user_shard(u, 3) == i for u in users))
+
+    @httpretty.activate
+    def test_iter_users_by_cost(self):
+        app = self.app
+        since = utils.get_date('2000-01-02')
+
+        with self.app.session_scope() as session:
+            for i in range(1, 5):
+                session.add(AuthorInfo(id=i, created=since, last_sent_daily=since, last_sent_weekly=since))
+            session.commit()
+        app.record_user_costs([{'user_id': 1, 'queries': 1, 'rows': 1, 'render_seconds': 0., 'wall_seconds': 2.},
+                               {'user_id': 3, 'queries': 1, 'rows': 1, 'render_seconds': 0., 'wall_seconds': 9.},
+                               {'user_id': 4, 'queries': 1, 'rows': 1, 'render_seconds': 0., 'wall_seconds': 5.}],
+                              'daily')
+        app.record_user_costs([{'user_id': 2, 'queries': 1, 'rows': 1, 'render_seconds': 0., 'wall_seconds': 50.}],
+                              'weekly')
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_VAULT_MYADS_USERS'] % since.isoformat(),
+            content_type='application/json',
+            status=200,
+            body='{"users":[6]}'
+        )
+
+        # in no particular order, new users last
+        users = list(app.iter_users(since=since, frequency='daily', by_cost=True))
+        self.assertEqual(sorted(users[:4]), [(1, 2.), (2, None), (3, 9.), (4, 5.)])
+        self.assertEqual(users[4], (6, None))
+
+        # longest first, then users without a cost for this frequency
+        self.assertEqual(list(app.iter_users(since=since, frequency='daily', by_cost=True, longest_first=True)),
+                         [(3, 9.), (4, 5.), (1, 2.), (2, None), (6, None)])
+
+        # a user processed while the next pages are read isn't read again with its new cost
+        users = app.iter_users(since=since, frequency='daily', by_cost=True, longest_first=True, yield_per=1)
+        self.assertEqual(next(users), (3, 9.))
+        app.record_user_costs([{'user_id': 3, 'queries': 1, 'rows': 1, 'render_seconds': 0., 'wall_seconds': 1.}],
+                              'daily')
+        self.assertEqual(list(users), [(4, 5.), (1, 2.), (2, None), (6, None)])
+
+    def test_user_shard(self):
+        shards = [user_shard(u, 4) for u in range(1000)]
+        self.assertEqual(shards, [user_shard(u, 4) for u in range(1000)])
+        self.assertEqual(set(shards), set([0, 1, 2, 3]))
+        # roughly balanced
+        self.assertTrue(all(shards.count(i) > 200 for i in range(4)))
+        self.assertEqual(user_shard(12345, 1), 0)
+
     def test_get_recent_results(self):
         app = self.app
         created_1 = utils.get_date('2019-01-01')
@@ -140,6 +245,282 @@ class TestmyADSCelery(unittest.TestCase):
         # new results are stored, excluding results more recent than STATEFUL_RESULTS_DAYS
         self.assertEqual(new_bibc, ['bib5'])
 
+        # nothing new to store, and no results at all
+        new_res = app.get_recent_results(user_id=2, setup_id=123, input_results=['bib1', 'bib5'], ndays=self.app.conf['STATEFUL_RESULTS_DAYS'])
+        self.assertEqual(new_res, ['bib5'])
+        new_res = app.get_recent_results(user_id=2, setup_id=123, input_results=[], ndays=self.app.conf['STATEFUL_RESULTS_DAYS'])
+        self.assertEqual(new_res, [])
+
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Results).filter_by(setup_id=123).count(), 4)
+
+
+    def test_get_recent_results_normalized(self):
+        app = self.app
+        created_1 = utils.get_date('2019-01-01')
+        today = utils.get_date()
+        created_2 = today - timedelta(self.app.conf['STATEFUL_RESULTS_DAYS'] - 1)
+
+        with self.app.session_scope() as session:
+            session.add(ResultBibcode(user_id=2, query_key='qid:1234567890abcdefghijklmnopqrstuv', bibcode='bib1', created=created_1))
+            session.add(ResultBibcode(user_id=2, query_key='qid:1234567890abcdefghijklmnopqrstuv', bibcode='bib2', created=created_2))
+            session.add(ResultBibcode(user_id=2, query_key='setup:123', bibcode='bib3', created=created_1))
+            session.commit()
+
+        with patch.dict(self.app._config, {'STATEFUL_RESULTS_NORMALIZED': True}):
+            input_res = ['bib1', 'bib2', 'bib3', 'bib3']
+            new_res = app.get_recent_results(user_id=2, qid='1234567890abcdefghijklmnopqrstuv', input_results=input_res, ndays=self.app.conf['STATEFUL_RESULTS_DAYS'])
+
+            # only new results are returned, including results more recent than STATEFUL_RESULTS_DAYS
+            self.assertEqual(set(new_res), set(['bib2', 'bib3']))
+
+            new_res = app.get_recent_results(user_id=2, setup_id=123, input_results=input_res, ndays=self.app.conf['STATEFUL_RESULTS_DAYS'])
+            self.assertEqual(set(new_res), set(['bib1', 'bib2']))
+
+            # running the same query again returns the same results, since they're recent
+            new_res = app.get_recent_results(user_id=2, setup_id=123, input_results=input_res, ndays=self.app.conf['STATEFUL_RESULTS_DAYS'])
+            self.assertEqual(set(new_res), set(['bib1', 'bib2']))
+
+        with self.app.session_scope() as session:
+            stored = session.query(ResultBibcode).filter_by(user_id=2, query_key='qid:1234567890abcdefghijklmnopqrstuv').order_by(ResultBibcode.bibcode).all()
+            self.assertEqual(dict((r.bibcode, r.created) for r in stored),
+                             {'bib1': created_1, 'bib2': created_2, 'bib3': stored[-1].created})
+            self.assertTrue(stored[-1].created >= today)
+            self.assertEqual(session.query(ResultBibcode).filter_by(user_id=2, query_key='setup:123').count(), 3)
+
+            # the old results table isn't used
+            self.assertEqual(session.query(Results).count(), 0)
+
+    def test_get_recent_results_batch(self):
+        app = self.app
+        ndays = self.app.conf['STATEFUL_RESULTS_DAYS']
+        created_1 = utils.get_date('2019-01-01')
+        created_2 = utils.get_date() - timedelta(ndays - 1)
+        qid = '1234567890abcdefghijklmnopqrstuv'
+        queries = [(qid, 1, ['bib1', 'bib2', 'bib3', 'bib3']),
+                   (None, 123, ['bib1', 'bib4']),
+                   (None, 123, ['bib4', 'bib5']),
+                   (None, None, ['bib6'])]
+
+        with self.app.session_scope() as session:
+            session.add(Results(user_id=2, qid=qid, results=['bib1'], created=created_1))
+            session.add(Results(user_id=2, qid=qid, results=['bib2'], created=created_2))
+            session.add(Results(user_id=2, setup_id=123, results=['bib5'], created=created_1))
+            session.add(Results(user_id=3, setup_id=123, results=['bib1'], created=created_1))
+            session.commit()
+
+        new_res = app.get_recent_results_batch(user_id=2, queries=queries, ndays=ndays)
+        self.assertEqual([set(r) if r is not None else r for r in new_res],
+                         [set(['bib2', 'bib3']), set(['bib1', 'bib4']), set(['bib4']), None])
+
+        with self.app.session_scope() as session:
+            # one new row per query
+            stored = session.query(Results).filter_by(user_id=2, qid=qid).order_by(Results.created).all()
+            self.assertEqual(len(stored), 3)
+            self.assertEqual(set(stored[-1].results), set(['bib3']))
+            stored = session.query(Results).filter_by(user_id=2, setup_id=123).order_by(Results.created).all()
+            self.assertEqual(len(stored), 2)
+            self.assertEqual(set(stored[-1].results), set(['bib1', 'bib4']))
+
+        # same output as one query at a time
+        for (qid, setup_id, input_results), batch_res in zip(queries[:2], new_res):
+            self.assertEqual(set(app.get_recent_results(user_id=2, qid=qid, setup_id=setup_id,
+                                                        input_results=input_results, ndays=ndays)),
+                             set(batch_res))
+
+        with patch.dict(self.app._config, {'STATEFUL_RESULTS_NORMALIZED': True}):
+            with self.app.session_scope() as session:
+                session.add(ResultBibcode(user_id=2, query_key='setup:123', bibcode='bib5', created=created_1))
+                session.commit()
+            new_res = app.get_recent_results_batch(user_id=2, queries=queries, ndays=ndays)
+            self.assertEqual([set(r) if r is not None else r for r in new_res],
+                             [set(['bib1', 'bib2', 'bib3']), set(['bib1', 'bib4']), set(['bib4']), None])
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(ResultBibcode).filter_by(user_id=2).count(), 6)
+
+        self.assertEqual(app.get_recent_results_batch(user_id=2, queries=[(queries[0][0], None, [])], ndays=ndays), [[]])
+
+        # several users at once; user 3 has its own history
+        new_res = app.get_recent_results_users({2: [(None, 123, ['bib1', 'bib7'])], 3: [(None, 123, ['bib1', 'bib7'])]},
+                                               ndays=ndays)
+        self.assertEqual(dict((u, [set(r) for r in res]) for u, res in new_res.items()),
+                         {2: [set(['bib1', 'bib7'])], 3: [set(['bib7'])]})
+
+    def test_user_costs(self):
+        app = self.app
+        app.record_user_costs([{'user_id': 1, 'queries': 2, 'rows': 40, 'render_seconds': 0.1, 'wall_seconds': 2.},
+                               {'user_id': 2, 'queries': 30, 'rows': 12000, 'render_seconds': 1., 'wall_seconds': 10.},
+                               {'user_id': 3, 'queries': 5, 'rows': 100, 'render_seconds': 0.2, 'wall_seconds': 45.}],
+                              'daily')
+        app.record_user_costs([{'user_id': 1, 'queries': 2, 'rows': 40, 'render_seconds': 0.1, 'wall_seconds': 60.}],
+                              'weekly')
+        self.assertEqual(app.get_heavy_users('daily'), set([2, 3]))
+        self.assertEqual(app.get_heavy_users('daily', max_seconds=100, max_rows=100000), set())
+        self.assertEqual(app.get_heavy_users('weekly'), set([1]))
+
+        # the latest run replaces the previous one
+        app.record_user_costs([{'user_id': 3, 'queries': 5, 'rows': 100, 'render_seconds': 0.2, 'wall_seconds': 3.,
+                                'retries': 1}], 'daily')
+        self.assertEqual(app.get_heavy_users('daily'), set([2]))
+        with self.app.session_scope() as session:
+            cost = session.query(UserCost).filter_by(user_id=3, frequency='daily').one()
+            self.assertEqual((cost.num_queries, cost.num_rows, cost.wall_seconds, cost.retries), (5, 100, 3., 1))
+
+    @httpretty.activate
+    def test_searcher_ready(self):
+        app = self.app
+        responses = [(503, '{}'),
+                     (200, '{"response": {"numFound": 1}}')]
+        num_requests = [0]
+
+        def solr(request, uri, headers):
+            status, body = responses[num_requests[0]]
+            num_requests[0] += 1
+            return status, headers, body
+
+        httpretty.register_uri(httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'], body=solr)
+
+        # Solr is queried once, then the check is read from the storage table until it expires
+        gate = app.searcher_ready('2019A&A...632A..94J')
+        self.assertFalse(gate['ready'])
+        self.assertFalse(app.searcher_ready('2019A&A...632A..94J')['ready'])
+        self.assertEqual(num_requests[0], 1)
+
+        gate = app.searcher_ready('2019A&A...632A..94J', ttl=0)
+        self.assertTrue(gate['ready'])
+        self.assertEqual(num_requests[0], 2)
+        with self.app.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='searcher.ready.2019A&A...632A..94J').one()
+            self.assertEqual(json.loads(kv.value), gate)
+
+        # a check stored by the ingest check of the run is read without querying Solr
+        app.set_searcher_ready('2012.14424', True)
+        self.assertTrue(app.searcher_ready('2012.14424')['ready'])
+        self.assertEqual(num_requests[0], 2)
+
+    @httpretty.activate
+    def test_searcher_ready_locked(self):
+        app = self.app
+        httpretty.register_uri(httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+                               body='{"response": {"numFound": 1}}')
+        key = 'searcher.ready.2012.14424'
+
+        # while another worker holds the gate's lock, Solr isn't queried: the gate is pending until a ready check is
+        # stored, then the last stored check is used even if it expired
+        other = self.app._engine.connect()
+        with other.begin() as transaction:
+            other.execute(text('SELECT pg_advisory_xact_lock(:lock_id)'), lock_id=advisory_lock_id(key))
+            gate = app.searcher_ready('2012.14424')
+            self.assertTrue(gate['pending'])
+            self.assertFalse(gate['ready'])
+
+            app.set_searcher_ready('2012.14424', False)
+            self.assertTrue(app.searcher_ready('2012.14424', ttl=0)['pending'])
+            app.set_searcher_ready('2012.14424', True)
+            gate = app.searcher_ready('2012.14424', ttl=0)
+            self.assertTrue(gate['ready'])
+            self.assertNotIn('pending', gate)
+            self.assertFalse(httpretty.has_request())
+            transaction.rollback()
+        other.close()
+
+        # once the lock is released, the expired check is renewed
+        app.set_searcher_ready('2012.14424', False)
+        self.assertTrue(app.searcher_ready('2012.14424', ttl=0)['ready'])
+
+        # Solr errors, including timeouts, are failed checks
+        with patch.object(app.client, 'get', side_effect=requests.exceptions.Timeout('timed out')) as get:
+            self.assertFalse(app.searcher_ready('2012.14424', ttl=0, timeout=2)['ready'])
+        self.assertEqual(get.call_args[1]['timeout'], 2)
+
+    def test_compact_results(self):
+        app = self.app
+        ndays = self.app.conf['STATEFUL_RESULTS_DAYS']
+        today = utils.get_date()
+        created_1 = utils.get_date('2019-01-01')
+        created_2 = utils.get_date('2019-02-01')
+        created_3 = today - timedelta(ndays - 1)
+        qid = '1234567890abcdefghijklmnopqrstuv'
+
+        with self.app.session_scope() as session:
+            session.add(Results(user_id=2, qid=qid, results=['bib1', 'bib2'], created=created_1))
+            session.add(Results(user_id=2, qid=qid, results=['bib2', 'bib3'], created=created_2))
+            session.add(Results(user_id=2, qid=qid, results=['bib4'], created=created_3))
+            session.add(Results(user_id=2, setup_id=123, results=['bib1'], created=created_1))
+            session.add(Results(user_id=2, setup_id=123, results=['bib5'], created=created_2))
+            session.add(Results(user_id=3, setup_id=123, results=['bib1'], created=created_1))
+            session.add(Results(user_id=4, setup_id=456, results=['bib1'], created=created_1))
+            session.add(Results(user_id=4, setup_id=456, results=['bib2'], created=created_2))
+            session.commit()
+
+        input_res = ['bib1', 'bib2', 'bib3', 'bib4', 'bib5', 'bib6']
+        with patch('myadsp.app.get_date', return_value=today):
+            before = [app.get_recent_results(user_id=2, qid=qid, input_results=input_res, ndays=ndays),
+                      app.get_recent_results(user_id=2, setup_id=123, input_results=input_res, ndays=ndays)]
+
+        # one batch per user with old results, then one that finds none; the single old row of user 3 is left alone
+        with patch.object(app, 'session_scope', wraps=app.session_scope) as session_scope:
+            stats = app.compact_results(ndays=ndays, batch_size=1)
+        self.assertEqual(session_scope.call_count, 4)
+        self.assertEqual(stats['keys'], 3)
+        self.assertEqual(stats['rows'], 3)
+        self.assertTrue(stats['bytes'] > 0)
+
+        with self.app.session_scope() as session:
+            old = session.query(Results).filter_by(user_id=2, qid=qid).order_by(Results.created).all()
+            self.assertEqual(len(old), 3)
+            self.assertEqual(set(old[0].results), set(['bib1', 'bib2', 'bib3']))
+            self.assertEqual(old[0].created, created_2)
+            self.assertEqual(session.query(Results).filter_by(user_id=2, setup_id=123).count(), 2)
+            self.assertEqual(session.query(Results).filter_by(user_id=3, setup_id=123).count(), 1)
+            self.assertEqual(session.query(Results).filter_by(user_id=4, setup_id=456).one().results, ['bib1', 'bib2'])
+
+        # compaction doesn't change the output
+        with patch('myadsp.app.get_date', return_value=today):
+            after = [app.get_recent_results(user_id=2, qid=qid, input_results=input_res, ndays=ndays),
+                     app.get_recent_results(user_id=2, setup_id=123, input_results=input_res, ndays=ndays)]
+        self.assertEqual([set(r) for r in after], [set(r) for r in before])
+        self.assertEqual(set(after[0]), set(['bib4', 'bib5', 'bib6']))
+
+        # nothing left to compact
+        self.assertEqual(app.compact_results(ndays=ndays)['keys'], 0)
+
+        with patch.dict(self.app._config, {'STATEFUL_RESULTS_NORMALIZED': True}):
+            self.assertEqual(app.compact_results(ndays=ndays), {'keys': 0, 'rows': 0, 'bytes': 0})
+
+    def test_backfill_result_bibcodes(self):
+        app = self.app
+        created_1 = utils.get_date('2019-01-01')
+        created_2 = utils.get_date('2019-02-01')
+        qid = '1234567890abcdefghijklmnopqrstuv'
+
+        self.assertEqual(app.backfill_result_bibcodes(), 0)
+
+        with self.app.session_scope() as session:
+            session.add(Results(user_id=2, qid=qid, results=['bib1', 'bib2'], created=created_2))
+            session.add(Results(user_id=2, qid=qid, results=['bib2', 'bib3'], created=created_1))
+            session.add(Results(user_id=2, setup_id=123, results=['bib1'], created=created_1))
+            session.commit()
+
+        # one row per transaction; each bibcode keeps the earliest date it was stored
+        self.assertEqual(app.backfill_result_bibcodes(batch_size=1), 3)
+        with self.app.session_scope() as session:
+            stored = [(r.query_key, r.bibcode, r.created) for r in
+                      session.query(ResultBibcode).order_by(ResultBibcode.query_key, ResultBibcode.bibcode).all()]
+        self.assertEqual(stored, [('qid:' + qid, 'bib1', created_2),
+                                  ('qid:' + qid, 'bib2', created_1),
+                                  ('qid:' + qid, 'bib3', created_1),
+                                  ('setup:123', 'bib1', created_1)])
+
+        # running it again, with the results stored in between, only adds those
+        with self.app.session_scope() as session:
+            session.add(Results(user_id=2, setup_id=123, results=['bib1', 'bib4'], created=utils.get_date()))
+            session.commit()
+        app.backfill_result_bibcodes()
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(ResultBibcode).count(), 5)
+            self.assertEqual(session.query(ResultBibcode).filter_by(query_key='setup:123', bibcode='bib1').one().created,
+                             created_1)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
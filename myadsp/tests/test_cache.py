@@ -0,0 +1,55 @@
+import unittest
+from mock import patch
+
+from myadsp import cache
+
+
+class TestQueryCache(unittest.TestCase):
+    """
+    Tests the query results cache
+    """
+
+    def test_normalize_query(self):
+        key1 = cache.normalize_query({'q': 'star', 'sort': 'score desc'}, fields='bibcode,title', rows=5)
+        key2 = cache.normalize_query({'sort': 'score desc', 'q': 'star '}, fields='title, bibcode', rows='5')
+        self.assertEqual(key1, key2)
+
+        # any change to the query, fields, rows, or sort is a different query
+        self.assertNotEqual(key1, cache.normalize_query({'q': 'star', 'sort': 'date desc'}, fields='bibcode,title', rows=5))
+        self.assertNotEqual(key1, cache.normalize_query({'q': 'star', 'sort': 'score desc'}, fields='bibcode', rows=5))
+        self.assertNotEqual(key1, cache.normalize_query({'q': 'star', 'sort': 'score desc'}, fields='bibcode,title', rows=10))
+
+    def test_memory_cache(self):
+        query_cache = cache.MemoryCache(ttl=60, max_entries=2)
+
+        self.assertIsNone(query_cache.get('run1', 'key1'))
+        query_cache.set('run1', 'key1', [{'bibcode': 'bib1'}])
+        self.assertEqual(query_cache.get('run1', 'key1'), [{'bibcode': 'bib1'}])
+
+        # results are scoped to the run
+        self.assertIsNone(query_cache.get('run2', 'key1'))
+        self.assertEqual(query_cache.stats('run1'), {'hits': 1, 'misses': 1})
+        self.assertEqual(query_cache.stats('run2'), {'hits': 0, 'misses': 1})
+
+        # each caller gets its own copy
+        docs = query_cache.get('run1', 'key1')
+        docs[0]['bibcode'] = 'changed'
+        self.assertEqual(query_cache.get('run1', 'key1'), [{'bibcode': 'bib1'}])
+
+        # least recently used entry is evicted
+        query_cache.set('run1', 'key2', [])
+        query_cache.get('run1', 'key1')
+        query_cache.set('run1', 'key3', [])
+        self.assertIsNone(query_cache.get('run1', 'key2'))
+        self.assertEqual(query_cache.get('run1', 'key1'), [{'bibcode': 'bib1'}])
+
+        # expired entries aren't returned
+        with patch('time.time', return_value=10 ** 12):
+            self.assertIsNone(query_cache.get('run1', 'key1'))
+
+    def test_get_query_cache(self):
+        self.assertIsNone(cache.get_query_cache({}))
+        self.assertTrue(isinstance(cache.get_query_cache({'QUERY_CACHE_BACKEND': 'memory'}), cache.MemoryCache))
+        with self.assertRaises(RuntimeError):
+            cache.get_query_cache({'QUERY_CACHE_BACKEND': 'other'})
+
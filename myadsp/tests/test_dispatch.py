@@ -0,0 +1,162 @@
+import socket
+import unittest
+from collections import defaultdict, namedtuple
+from mock import patch, MagicMock
+
+from myadsp import dispatch
+
+queue_declare_ok_t = namedtuple('queue_declare_ok_t', ('queue', 'message_count', 'consumer_count'))
+
+
+class FakeChannel(object):
+
+    def __init__(self, depths):
+        self.depths = depths
+
+    def queue_declare(self, queue, passive=False):
+        if not self.depths:
+            raise Exception('NOT_FOUND - no queue {0}'.format(queue))
+        return queue_declare_ok_t(queue, self.depths.pop(0), 1)
+
+    def close(self):
+        pass
+
+
+class FakeConfirmChannel(object):
+    """Publishing channel; the broker confirms its messages when the connection's events are drained"""
+
+    def __init__(self):
+        self.events = defaultdict(set)
+        self.confirm_selected = False
+        self.published = 0
+
+    def confirm_select(self):
+        self.confirm_selected = True
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    Tests the bulk task dispatcher
+    """
+
+    def setUp(self):
+        self.depths = []
+        self.connection = MagicMock()
+        self.connection.channel.side_effect = lambda: FakeChannel(self.depths)
+        self.connection.recoverable_connection_errors = (IOError,)
+        self.connection.recoverable_channel_errors = ()
+        self.connection.drain_events.side_effect = self.drain_events
+        self.app = MagicMock()
+        self.app.conf = {}
+        self.app.connection_for_write.return_value = self.connection
+        # one producer, and publishing channel, per connection
+        self.producers = []
+        self.app.amqp.Producer.side_effect = self.producer
+        # the broker's answer to the messages of each wait for confirms: ack or nack
+        self.answers = []
+        self.task = MagicMock()
+        self.task.name = 'myadsp.tasks.task_process_myads'
+        self.task.queue = 'process'
+        self.task.apply_async.side_effect = self.publish
+
+    def producer(self, connection):
+        producer = MagicMock()
+        producer.channel = FakeConfirmChannel()
+        self.producers.append(producer)
+        return producer
+
+    def publish(self, args, producer, **options):
+        producer.channel.published += 1
+
+    def drain_events(self, timeout=None):
+        channel = self.producers[-1].channel
+        event = self.answers.pop(0) if self.answers else 'basic_ack'
+        for callback in list(channel.events[event]):
+            callback(channel.published, True)
+
+    def test_dispatch(self):
+        # queue is full at the second check: publishing waits until it's drained to half
+        self.depths.extend([0, 10, 8, 4])
+        dispatcher = dispatch.Dispatcher(self.app, max_queue_depth=10, check_every=3, retry_policy={'max_retries': 1})
+
+        with patch.object(dispatch.time, 'sleep') as sleep:
+            stats = dispatcher.dispatch(self.task, ({'userid': u} for u in range(7)))
+
+        self.assertEqual(stats['published'], 7)
+        self.assertEqual([c[1]['args'][0]['userid'] for c in self.task.apply_async.call_args_list], list(range(7)))
+        # every publish goes through the same producer, on a channel with confirms, waited for once
+        self.assertEqual(len(self.producers), 1)
+        for c in self.task.apply_async.call_args_list:
+            self.assertIs(c[1]['producer'], self.producers[0])
+        self.assertTrue(self.producers[0].channel.confirm_selected)
+        self.assertEqual(self.connection.drain_events.call_count, 1)
+
+        # waits double until the queue is below half of the maximum depth
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1.0])
+        self.assertEqual(stats['throttled'], 1.5)
+
+        # the depth can't be read once the queue is gone: not throttled
+        self.assertEqual(dispatcher.throttle(self.connection, 'process'), 0)
+
+    def test_dispatch_queue(self):
+        dispatcher = dispatch.Dispatcher(self.app)
+        dispatcher.dispatch(self.task, [{'userid': 1}], queue='process_shard1')
+        self.assertEqual(self.task.apply_async.call_args[1]['queue'], 'process_shard1')
+
+    def test_dispatch_confirm_batches(self):
+        # confirms are waited for after each batch
+        dispatcher = dispatch.Dispatcher(self.app, confirm_batch=3)
+        stats = dispatcher.dispatch(self.task, [{'userid': u} for u in range(7)])
+        self.assertEqual(stats['published'], 7)
+        self.assertEqual(self.connection.drain_events.call_count, 3)
+        self.assertEqual(self.connection.drain_events.call_args[1]['timeout'], 30)
+
+    def test_dispatch_error(self):
+        dispatcher = dispatch.Dispatcher(self.app, confirm_batch=3, retry_policy={'max_retries': 1,
+                                                                                  'interval_start': 0})
+        published = [0]
+
+        def publish(args, producer, **options):
+            published[0] += 1
+            if published[0] == 5:
+                raise IOError('connection lost')
+            producer.channel.published += 1
+        self.task.apply_async.side_effect = publish
+
+        # the batch that wasn't confirmed is published again, in full, on a new connection
+        with patch.object(dispatch.time, 'sleep'):
+            stats = dispatcher.dispatch(self.task, [{'userid': u} for u in range(5)])
+        self.assertEqual(stats['published'], 5)
+        self.assertEqual([c[1]['args'][0]['userid'] for c in self.task.apply_async.call_args_list],
+                         [0, 1, 2, 3, 4, 3, 4])
+        self.assertEqual(len(self.producers), 2)
+        self.assertEqual(self.app.connection_for_write.call_count, 2)
+        self.assertEqual(self.connection.release.call_count, 2)
+
+        # rejected messages, and confirms that don't arrive, are retried too; a batch that still fails isn't skipped
+        self.task.apply_async.side_effect = self.publish
+        self.answers.extend(['basic_nack', 'basic_nack'])
+        with patch.object(dispatch.time, 'sleep'), self.assertRaises(dispatch.PublishNacked):
+            dispatcher.dispatch(self.task, [{'userid': u} for u in range(2)])
+
+        self.connection.drain_events.side_effect = socket.timeout('timed out')
+        with patch.object(dispatch.time, 'sleep'), self.assertRaises(socket.timeout):
+            dispatcher.dispatch(self.task, [{'userid': 1}])
+
+    def test_chunked(self):
+        self.assertEqual(list(dispatch.chunked((i for i in range(7)), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(dispatch.chunked([], 3)), [])
+
+    def test_makespan_estimate(self):
+        # longest first on two slots: 5 | 4, then 3 on the second slot, 2 and 2 on the first
+        estimate = dispatch.MakespanEstimate(2)
+        for seconds in [5, 4, 3, 2, 2]:
+            estimate.add(seconds)
+        self.assertEqual(estimate.jobs, 5)
+        self.assertEqual(estimate.makespan, 9)
+
+        # shortest first leaves the longest job at the tail
+        estimate = dispatch.MakespanEstimate(2)
+        for seconds in [2, 2, 3, 4, 5]:
+            estimate.add(seconds)
+        self.assertEqual(estimate.makespan, 10)
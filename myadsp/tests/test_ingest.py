@@ -0,0 +1,181 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import json
+import httpretty
+import requests
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+from mock import patch
+
+from myadsp import ingest
+
+
+class TestIngest(unittest.TestCase):
+    """
+    Tests the detection of ingest completion
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_backoff_delays(self):
+        delays = ingest.backoff_delays(5, 60)
+        self.assertEqual([next(delays) for i in range(6)], [5, 10, 20, 40, 60, 60])
+
+    def test_file_mtime(self):
+        path = os.path.join(self.tmpdir, 'matches.input')
+        self.assertIsNone(ingest.file_mtime(path))
+        open(path, 'w').close()
+        self.assertEqual(ingest.file_mtime(path), os.path.getmtime(path))
+
+    def _write(self, name, records):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            for r in records:
+                f.write('{0}\tK58-37447\n'.format(r) if r else '\n')
+        return path
+
+    def test_sample_records(self):
+        path = self._write('matches.input', ['bib{0}'.format(i) for i in range(100)] + [''])
+        count, sample = ingest.sample_records(path, 3, rng=random.Random(1))
+        self.assertEqual(count, 100)
+        self.assertEqual(len(set(sample)), 3)
+        self.assertTrue(set(sample) <= set('bib{0}'.format(i) for i in range(100)))
+
+        # an unchanged file isn't read again
+        with patch.object(ingest, '_records') as records:
+            self.assertEqual(ingest.sample_records(path, 3), (count, sample))
+            self.assertFalse(records.called)
+
+        # all records are sampled when there are fewer than the sample size
+        path = self._write('matches.input', ['bib1', 'bib2'])
+        self.assertEqual(ingest.sample_records(path, 3), (2, ['bib1', 'bib2']))
+
+        # each record is sampled with the same probability
+        path = self._write('uniform.input', ['bib{0}'.format(i) for i in range(10)])
+        rng = random.Random(2)
+        counts = dict(('bib{0}'.format(i), 0) for i in range(10))
+        for n in range(2000):
+            ingest._samples.clear()
+            for r in ingest.sample_records(path, 3, rng=rng)[1]:
+                counts[r] += 1
+        for r in counts:
+            self.assertTrue(500 < counts[r] < 700, counts)
+
+        with self.assertRaises(IOError):
+            ingest.sample_records(os.path.join(self.tmpdir, 'missing'), 3)
+
+    def test_max_record(self):
+        path = self._write('new_records.tsv', ['2012.14424', '2012.14425', '2012.00001'])
+        self.assertEqual(ingest.max_record(path), '2012.14425')
+        self.assertIsNone(ingest.max_record(self._write('empty.tsv', [])))
+        with self.assertRaises(IOError):
+            ingest.max_record(os.path.join(self.tmpdir, 'missing'))
+
+    @httpretty.activate
+    def test_visible_records(self):
+        queries = []
+
+        def solr(request, uri, headers):
+            queries.append(parse_qs(urlparse(request.path).query))
+            return 200, headers, json.dumps({'response': {'numFound': 2, 'docs': [
+                {'bibcode': '2019A&A...632A..94J', 'identifier': ['2019A&A...632A..94J', 'arXiv:1911.00001']},
+                {'bibcode': '2019ApJ...880...50K', 'identifier': ['2019ApJ...880...50K', '2019arXiv190700001K']}]}})
+
+        httpretty.register_uri(httpretty.GET, ingest.config.get('API_SOLR_QUERY_ENDPOINT'), body=solr)
+
+        sample = ['2019A&A...632A..94J', '2019arXiv190700001K', '2019MNRAS.490..1S']
+        self.assertEqual(ingest.visible_records(requests.Session(), sample),
+                         set(['2019A&A...632A..94J', '2019arXiv190700001K']))
+        # one query for the whole sample
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(queries[0]['q'], ['identifier:("2019A&A...632A..94J" OR "2019arXiv190700001K" OR '
+                                           '"2019MNRAS.490..1S")'])
+
+        httpretty.register_uri(httpretty.GET, ingest.config.get('API_SOLR_QUERY_ENDPOINT'), status=503, body='')
+        self.assertIsNone(ingest.visible_records(requests.Session(), sample))
+
+    def test_file_watcher(self):
+        # the directory of the file is created by the ingest
+        path = os.path.join(self.tmpdir, '2020-01-01', 'new_records.tsv')
+        watcher = ingest.FileWatcher(path, poll_interval=1, use_inotify=False)
+        self.assertEqual(watcher.mode, 'poll')
+        self.assertEqual(watcher._watched_dir(), self.tmpdir)
+
+        checks = []
+
+        def ready(p):
+            checks.append(p)
+            if len(checks) == 3:
+                os.mkdir(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    f.write('2012.14424\toai/arXiv.org/2012/14424\n')
+            return ingest.file_mtime(p) is not None
+
+        # checked right away, then polled
+        with patch.object(ingest.time, 'sleep') as sleep:
+            self.assertIsNotNone(watcher.wait(ready, 100))
+        self.assertEqual(len(checks), 3)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 1])
+        self.assertEqual(watcher._watched_dir(), os.path.dirname(path))
+
+        with patch.object(ingest.time, 'sleep'):
+            self.assertIsNone(watcher.wait(lambda p: False, 0))
+
+    def test_file_watcher_settle(self):
+        path = self._write('new_records.tsv', ['2012.14424'])
+        watcher = ingest.FileWatcher(path, poll_interval=10, use_inotify=False)
+        clock = [1000.]
+
+        def sleep(seconds):
+            clock[0] += seconds
+            # the ingest is still writing the file at the first check
+            if clock[0] <= 1010:
+                with open(path, 'a') as f:
+                    f.write('2012.14425\toai/arXiv.org/2012/14425\n')
+
+        # the file is ready once its size and modification time are unchanged for a poll interval
+        with patch.object(ingest.time, 'time', side_effect=lambda: clock[0]), \
+                patch.object(ingest.time, 'sleep', side_effect=sleep):
+            self.assertEqual(watcher.wait(lambda p: True, 100, settle=True), 20)
+            self.assertEqual(ingest.max_record(path), '2012.14425')
+
+            # or not ready, if it keeps changing
+            clock[0] = 1000.
+            self.assertIsNone(watcher.wait(lambda p: True, 5, settle=True))
+
+    def test_file_watcher_inotify(self):
+        path = self._write('new_records.tsv', ['2012.14424'])
+        flags = type('flags', (object,), {'CREATE': 1, 'MODIFY': 2, 'CLOSE_WRITE': 4, 'MOVED_TO': 8})
+        events = [[(1, 2, 0, 'new_records.tsv'), (1, 2, 0, 'matches.input')],
+                  [(1, 4, 0, 'new_records.tsv')]]
+
+        class INotify(object):
+            def add_watch(self, directory, mask):
+                self.directory = directory
+
+            def read(self, timeout):
+                reads.append(timeout)
+                return [type('event', (object,), dict(zip(('wd', 'mask', 'cookie', 'name'), e)))
+                        for e in events.pop(0)]
+
+            def close(self):
+                pass
+
+        reads = []
+        inotify_simple = type('inotify_simple', (object,), {'flags': flags, 'INotify': INotify})
+        with patch.object(ingest, 'inotify_simple', inotify_simple):
+            watcher = ingest.FileWatcher(path, poll_interval=10)
+            self.assertEqual(watcher.mode, 'inotify')
+            # the file is ready once the ingest closes it, without waiting for the poll interval
+            self.assertIsNotNone(watcher.wait(lambda p: True, 100, settle=True))
+        self.assertEqual(len(reads), 2)
+        self.assertFalse(events)
@@ -0,0 +1,234 @@
+import unittest
+import smtplib
+import threading
+import time
+from mock import patch
+try:
+    import asyncore
+    import smtpd
+except ImportError:
+    # removed in Python 3.12
+    smtpd = None
+
+from myadsp.mailer import SMTPPool
+
+
+class FakeSMTP(object):
+    """
+    Stand-in for smtplib.SMTP that records the messages sent on each connection
+    """
+
+    connections = []
+    does_esmtp = False
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sent = []
+        self.recipients = []
+        self.alive = True
+        self.logged_in = False
+        FakeSMTP.connections.append(self)
+
+    def _check(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def login(self, username, password):
+        self.logged_in = True
+
+    def starttls(self):
+        pass
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return (250, b'OK')
+
+    def mail(self, from_addr, options=()):
+        self._check()
+        self.recipients = []
+        return (250, b'OK')
+
+    def rcpt(self, addr):
+        self._check()
+        self.recipients.append(addr)
+        return (250, b'OK')
+
+    def data(self, msg):
+        self._check()
+        self.sent.append(self.recipients)
+        return (250, b'OK')
+
+    def rset(self):
+        self._check()
+
+    def quit(self):
+        self.alive = False
+
+
+class TestSMTPPool(unittest.TestCase):
+    """
+    Tests the SMTP connection pool
+    """
+
+    def setUp(self):
+        FakeSMTP.connections = []
+
+    def test_reuse(self):
+        pool = SMTPPool('localhost', 25, username='user', password='pass', max_messages=3, factory=FakeSMTP)
+
+        for i in range(5):
+            pool.sendmail('from@test.com', 'to{0}@test.com'.format(i), 'message')
+
+        # a connection is reused until the message cap, then replaced
+        self.assertEqual(len(FakeSMTP.connections), 2)
+        self.assertEqual(len(FakeSMTP.connections[0].sent), 3)
+        self.assertEqual(len(FakeSMTP.connections[1].sent), 2)
+        self.assertTrue(FakeSMTP.connections[0].logged_in)
+
+        health = pool.health()
+        self.assertEqual(health['messages_sent'], 5)
+        self.assertEqual(health['connections_opened'], 2)
+        self.assertEqual(health['open'], 1)
+        self.assertEqual(health['in_use'], 0)
+
+        pool.close()
+        self.assertEqual(pool.health()['open'], 0)
+
+    def test_reconnect(self):
+        pool = SMTPPool('localhost', 25, idle_check=0, factory=FakeSMTP)
+
+        pool.sendmail('from@test.com', 'to@test.com', 'message')
+        # connection dropped by the server while idle is detected before reuse
+        FakeSMTP.connections[0].alive = False
+        pool.sendmail('from@test.com', 'to@test.com', 'message')
+        self.assertEqual(len(FakeSMTP.connections), 2)
+        self.assertEqual(len(FakeSMTP.connections[1].sent), 1)
+
+        # connection dropped between the check and the message: nothing was sent, so it's sent on a new connection
+        with patch.object(FakeSMTP, 'noop', return_value=(250, b'OK')):
+            FakeSMTP.connections[1].alive = False
+            pool.sendmail('from@test.com', 'to@test.com', 'message')
+        self.assertEqual(len(FakeSMTP.connections), 3)
+        self.assertEqual(FakeSMTP.connections[2].sent, [['to@test.com']])
+
+        # connection dropped once DATA has begun: the server may have accepted the message, so it isn't sent again
+        with patch.object(FakeSMTP, 'data', side_effect=smtplib.SMTPServerDisconnected('closed')):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                pool.sendmail('from@test.com', 'to@test.com', 'message')
+        self.assertEqual(len(FakeSMTP.connections), 3)
+        self.assertEqual(pool.health()['reconnects'], 2)
+        self.assertEqual(pool.health()['errors'], 1)
+
+        # connect and HELO failures are retried once
+        with patch.object(FakeSMTP, 'ehlo_or_helo_if_needed', side_effect=[smtplib.SMTPServerDisconnected('closed'),
+                                                                            None, None]):
+            pool.sendmail('from@test.com', 'to@test.com', 'message')
+        self.assertEqual(len(FakeSMTP.connections), 5)
+        self.assertEqual(len(FakeSMTP.connections[4].sent), 1)
+        self.assertEqual(pool.health()['reconnects'], 3)
+
+        pool.close()
+        with patch.object(FakeSMTP, 'ehlo_or_helo_if_needed', side_effect=smtplib.SMTPHeloError(421, b'busy')):
+            with self.assertRaises(smtplib.SMTPHeloError):
+                pool.sendmail('from@test.com', 'to@test.com', 'message')
+        self.assertEqual(pool.health()['errors'], 2)
+
+    def test_error(self):
+        pool = SMTPPool('localhost', 25, factory=FakeSMTP)
+
+        with patch.object(FakeSMTP, 'rcpt', return_value=(550, b'User unknown')):
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                pool.sendmail('from@test.com', 'to@test.com', 'message')
+
+        # the failed connection isn't reused
+        self.assertEqual(pool.health()['errors'], 1)
+        self.assertEqual(pool.health()['open'], 0)
+
+
+if smtpd is not None:
+    class RecordingSMTPServer(smtpd.SMTPServer):
+        """
+        Local SMTP server that records the messages it receives
+        """
+
+        def __init__(self):
+            smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+            self.port = self.socket.getsockname()[1]
+            self.messages = []
+            self.running = True
+            # set to have the server close its open connections; cleared once they're closed
+            self.drop = threading.Event()
+            self.thread = threading.Thread(target=self.serve)
+            self.thread.daemon = True
+            self.thread.start()
+
+        def serve(self):
+            while self.running:
+                asyncore.loop(timeout=0.05, count=1)
+                if self.drop.is_set():
+                    for channel in list(asyncore.socket_map.values()):
+                        if isinstance(channel, smtpd.SMTPChannel):
+                            channel.close()
+                    self.drop.clear()
+
+        def drop_connections(self):
+            self.drop.set()
+            while self.drop.is_set():
+                time.sleep(0.01)
+
+        def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+            self.messages.append((mailfrom, rcpttos, data))
+
+        def stop(self):
+            self.running = False
+            self.thread.join()
+            asyncore.close_all()
+
+
+@unittest.skipIf(smtpd is None, 'smtpd is not available')
+class TestSMTPPoolServer(unittest.TestCase):
+    """
+    Tests the SMTP connection pool against a local SMTP server
+    """
+
+    def setUp(self):
+        self.server = RecordingSMTPServer()
+        self.addCleanup(self.server.stop)
+
+    def test_sendmail(self):
+        pool = SMTPPool('127.0.0.1', self.server.port, max_messages=2, idle_check=0)
+
+        for i in range(3):
+            pool.sendmail('from@test.com', ['to{0}@test.com'.format(i)], 'Subject: test {0}\r\n\r\nmessage {0}'.format(i))
+        pool.close()
+
+        self.assertEqual([(m[0], m[1]) for m in self.server.messages],
+                         [('from@test.com', ['to{0}@test.com'.format(i)]) for i in range(3)])
+        self.assertIn(b'message 2', self.server.messages[2][2])
+        # idle connections were checked with NOOP, and replaced after max_messages
+        health = pool.health()
+        self.assertEqual(health['messages_sent'], 3)
+        self.assertEqual(health['connections_opened'], 2)
+        self.assertEqual(health['reconnects'], 0)
+        self.assertEqual(health['open'], 0)
+
+    def test_server_closes_idle_connection(self):
+        pool = SMTPPool('127.0.0.1', self.server.port)
+
+        pool.sendmail('from@test.com', ['to1@test.com'], 'Subject: test\r\n\r\nmessage 1')
+        # closed by the server while idle, before the next NOOP check: the message is sent on a new connection
+        self.server.drop_connections()
+        pool.sendmail('from@test.com', ['to2@test.com'], 'Subject: test\r\n\r\nmessage 2')
+        pool.close()
+
+        self.assertEqual([m[1] for m in self.server.messages], [['to1@test.com'], ['to2@test.com']])
+        health = pool.health()
+        self.assertEqual(health['messages_sent'], 2)
+        self.assertEqual(health['connections_opened'], 2)
+        self.assertEqual(health['reconnects'], 1)
+        self.assertEqual(health['errors'], 0)
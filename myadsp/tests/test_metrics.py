@@ -0,0 +1,111 @@
+import unittest
+import os
+import shutil
+import tempfile
+import requests
+from mock import patch
+
+from myadsp import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests the stage metrics registry
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_render(self):
+        registry = metrics.Metrics(buckets=[0.1, 1])
+        registry.observe('query', 0.05, frequency='daily', template='arxiv')
+        registry.observe('query', 0.5, frequency='daily', template='arxiv')
+        registry.observe('query', 5, frequency='daily', template='arxiv')
+        with patch.object(metrics.time, 'time', side_effect=[10., 10.25]):
+            with registry.timer('send', frequency='weekly'):
+                pass
+        registry.inc('myads_emails_total', frequency='daily', outcome='sent')
+        registry.inc('myads_emails_total', frequency='daily', outcome='sent')
+
+        self.assertEqual(registry.render().split('\n'), [
+            '# HELP myads_stage_seconds Time spent in each stage of myADS processing, in seconds',
+            '# TYPE myads_stage_seconds histogram',
+            'myads_stage_seconds_bucket{frequency="daily",stage="query",template="arxiv",le="0.1"} 1',
+            'myads_stage_seconds_bucket{frequency="daily",stage="query",template="arxiv",le="1.0"} 2',
+            'myads_stage_seconds_bucket{frequency="daily",stage="query",template="arxiv",le="+Inf"} 3',
+            'myads_stage_seconds_sum{frequency="daily",stage="query",template="arxiv"} 5.55',
+            'myads_stage_seconds_count{frequency="daily",stage="query",template="arxiv"} 3',
+            'myads_stage_seconds_bucket{frequency="weekly",stage="send",le="0.1"} 0',
+            'myads_stage_seconds_bucket{frequency="weekly",stage="send",le="1.0"} 1',
+            'myads_stage_seconds_bucket{frequency="weekly",stage="send",le="+Inf"} 1',
+            'myads_stage_seconds_sum{frequency="weekly",stage="send"} 0.25',
+            'myads_stage_seconds_count{frequency="weekly",stage="send"} 1',
+            '# HELP myads_emails_total Outcome of the myADS emails of each user',
+            '# TYPE myads_emails_total counter',
+            'myads_emails_total{frequency="daily",outcome="sent"} 2',
+            ''])
+
+    def test_disabled(self):
+        registry = metrics.get_metrics({'METRICS_FILE_DIR': self.tmpdir})
+        self.assertFalse(registry.enabled)
+        self.assertIs(registry.timer('query', template='arxiv'), metrics._NULL_TIMER)
+        registry.observe('query', 1.)
+        registry.inc('myads_emails_total', outcome='sent')
+        registry.export(force=True)
+        self.assertEqual(registry.render(), '')
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_export(self):
+        registry = metrics.get_metrics({'METRICS_ENABLED': True, 'METRICS_FILE_DIR': self.tmpdir})
+        registry.inc('myads_emails_total', outcome='sent')
+        registry.export()
+        path = os.path.join(self.tmpdir, 'myads_{0}.prom'.format(os.getpid()))
+        with open(path) as f:
+            self.assertEqual(f.read(), registry.render(pid=True))
+
+        # not written again within the write interval, unless forced
+        registry.inc('myads_emails_total', outcome='sent')
+        registry.export()
+        with open(path) as f:
+            self.assertIn('outcome="sent"} 1', f.read())
+        registry.export(force=True)
+        with open(path) as f:
+            self.assertIn('outcome="sent"} 2', f.read())
+        self.assertEqual(os.listdir(self.tmpdir), ['myads_{0}.prom'.format(os.getpid())])
+
+        # the file is removed when the process exits
+        registry.remove_file()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_export_processes(self):
+        # the series of each process are labelled with its ID, so the files of a node can be merged
+        registry = metrics.get_metrics({'METRICS_ENABLED': True, 'METRICS_FILE_DIR': self.tmpdir})
+        registry.inc('myads_emails_total', outcome='sent')
+        self.assertEqual(registry.render(pid=True).split('\n')[2],
+                         'myads_emails_total{{pid="{0}",outcome="sent"}} 1'.format(os.getpid()))
+
+        # the files of processes that are gone are removed by the first export of a process
+        for name in ['myads_1.prom', 'myads_4000000.prom', 'other.prom']:
+            open(os.path.join(self.tmpdir, name), 'w').close()
+        with patch.object(metrics, '_process_exists', side_effect=lambda pid: pid == 1):
+            registry.export()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted(['myads_1.prom', 'myads_{0}.prom'.format(os.getpid()), 'other.prom']))
+        with open(registry.file_path()) as f:
+            self.assertIn('pid="{0}"'.format(os.getpid()), f.read())
+        self.assertTrue(metrics._process_exists(os.getpid()))
+
+    def test_http_server(self):
+        registry = metrics.Metrics()
+        registry.inc('myads_emails_total', outcome='failed')
+        server = registry.start_http_server(0)
+        try:
+            r = requests.get('http://127.0.0.1:{0}/metrics'.format(server.server_address[1]))
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.text, registry.render(pid=True))
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,101 @@
+import unittest
+import os
+import json
+import httpretty
+from mock import patch
+
+from myadsp import app, utils, planner
+from myadsp.cache import MemoryCache
+from myadsp.models import Base
+
+
+class TestQueryPlanner(unittest.TestCase):
+    """
+    Tests the run-level query planner
+    """
+
+    postgresql_url_dict = {
+        'port': 5432,
+        'host': '127.0.0.1',
+        'user': 'postgres',
+        'database': 'test_myadspipeline'
+    }
+    postgresql_url = 'postgresql://{user}:{user}@{host}:{port}/{database}' \
+        .format(user=postgresql_url_dict['user'],
+                host=postgresql_url_dict['host'],
+                port=postgresql_url_dict['port'],
+                database=postgresql_url_dict['database']
+                )
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.myADSCelery('test', local_config={'SQLALCHEMY_URL': self.postgresql_url,
+                                                         'SQLALCHEMY_ECHO': False,
+                                                         'PROJ_HOME': proj_home,
+                                                         'TEST_DIR': os.path.join(proj_home, 'myadsp/tests'),
+                                                         })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def _setup(self, qid, q):
+        return {'id': qid,
+                'name': 'Query {0}'.format(qid),
+                'qid': None,
+                'active': True,
+                'stateful': False,
+                'frequency': 'daily',
+                'type': 'query',
+                'template': None,
+                'query': [{'q': q, 'sort': 'score desc, bibcode desc'}]}
+
+    @httpretty.activate
+    def test_plan_run(self):
+        for userid in [1, 2]:
+            httpretty.register_uri(
+                httpretty.GET, self.app.conf['API_VAULT_MYADS_SETUP'] % userid,
+                content_type='application/json',
+                status=200,
+                body=json.dumps([self._setup(1, 'author:Kurtz'), self._setup(2, 'title:"user {0}"'.format(userid))])
+            )
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_VAULT_MYADS_SETUP'] % 3,
+            content_type='application/json',
+            status=500
+        )
+
+        solr_requests = []
+
+        def solr_response(request, uri, response_headers):
+            solr_requests.append(uri)
+            return [200, response_headers, json.dumps({'response': {'numFound': 0, 'start': 0, 'docs': []}})]
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            content_type='application/json',
+            body=solr_response
+        )
+
+        # planning needs a shared cache to store the results in
+        with patch.object(utils, 'query_cache', None):
+            self.assertIsNone(planner.plan_run(self.app, [1, 2, 3], 'daily', 'daily:run1', threads=2))
+
+        with patch.object(utils, 'query_cache', MemoryCache()):
+            plan = planner.plan_run(self.app, [1, 2, 3], 'daily', 'daily:run1', threads=2)
+
+            # the shared query is only executed once
+            self.assertEqual(sorted(plan.setups.keys()), [1, 2])
+            self.assertEqual(plan.num_user_queries, 4)
+            self.assertEqual(len(plan.queries), 3)
+            self.assertEqual(len(solr_requests), 3)
+            shared = [q for q in plan.queries.values() if q['params']['q'] == 'author:Kurtz'][0]
+            self.assertEqual(shared['users'], set([1, 2]))
+
+            # the per-user processing reads the precomputed results
+            utils.get_template_query_results(plan.setups[1][0], run_id='daily:run1')
+            self.assertEqual(len(solr_requests), 3)
@@ -0,0 +1,96 @@
+import unittest
+import os
+import json
+import threading
+import httpretty
+from datetime import timedelta
+
+import adsputils
+from myadsp import app, prefetch
+from myadsp.models import Base, AuthorInfo, UserPrefetch
+
+
+class TestPrefetch(unittest.TestCase):
+    """
+    Tests the prefetch of setups and email addresses during the ingest wait
+    """
+
+    postgresql_url_dict = {
+        'port': 5432,
+        'host': '127.0.0.1',
+        'user': 'postgres',
+        'database': 'test_myadspipeline'
+    }
+    postgresql_url = 'postgresql://{user}:{user}@{host}:{port}/{database}' \
+        .format(user=postgresql_url_dict['user'],
+                host=postgresql_url_dict['host'],
+                port=postgresql_url_dict['port'],
+                database=postgresql_url_dict['database']
+                )
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.myADSCelery('test', local_config={'SQLALCHEMY_URL': self.postgresql_url,
+                                                         'SQLALCHEMY_ECHO': False,
+                                                         'PROJ_HOME': proj_home,
+                                                         'TEST_DIR': os.path.join(proj_home, 'myadsp/tests'),
+                                                         })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    @httpretty.activate
+    def test_prefetch_users(self):
+        sent = adsputils.get_date('2020-01-01')
+        with self.app.session_scope() as session:
+            session.add(AuthorInfo(id=1, created=sent, last_sent_daily=sent, last_sent_weekly=None))
+            session.add(AuthorInfo(id=2, created=sent, last_sent_daily=None, last_sent_weekly=None))
+            session.commit()
+
+        # the setup of a user that was sent before starts the day after
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_VAULT_MYADS_SETUP_DATE'] % (1, sent + timedelta(days=1)),
+            content_type='application/json',
+            status=200,
+            body=json.dumps([{'id': 1, 'frequency': 'daily'}])
+        )
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_VAULT_MYADS_SETUP'] % 2,
+            content_type='application/json',
+            status=500
+        )
+        for userid in [1, 2]:
+            httpretty.register_uri(
+                httpretty.GET, self.app.conf['API_ADSWS_USER_EMAIL'] % userid,
+                content_type='application/json',
+                status=200,
+                body=json.dumps({'id': userid, 'email': 'user{0}@example.com'.format(userid)})
+            )
+
+        stats = prefetch.prefetch_users(self.app, iter([1, 2]), 'daily', threads=2, batch_size=1)
+        self.assertEqual(stats, {'users': 2, 'setups': 1, 'emails': 2})
+
+        prefetched = self.app.get_prefetched({1: sent, 2: None}, 'daily')
+        self.assertEqual(prefetched, {1: {'setup': [{'id': 1, 'frequency': 'daily'}], 'email': 'user1@example.com'},
+                                      2: {'setup': None, 'email': 'user2@example.com'}})
+
+        # a setup fetched for another last sent date isn't used
+        self.assertIsNone(self.app.get_prefetched({1: sent + timedelta(days=1)}, 'daily')[1]['setup'])
+        self.assertEqual(self.app.get_prefetched({1: sent}, 'weekly'), {})
+
+        # nor are entries fetched on a previous day
+        with self.app.session_scope() as session:
+            session.query(UserPrefetch).filter_by(user_id=1).update({'fetched': adsputils.get_date() -
+                                                                                timedelta(days=1)})
+            session.commit()
+        self.assertEqual(list(self.app.get_prefetched({1: sent, 2: None}, 'daily').keys()), [2])
+
+        # nothing is fetched once stopped
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(prefetch.prefetch_users(self.app, [1, 2], 'daily', stop=stop)['users'], 0)
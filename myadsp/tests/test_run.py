@@ -0,0 +1,169 @@
+import unittest
+import os
+import shutil
+import tempfile
+import json
+import datetime
+from mock import patch, MagicMock
+
+import adsputils
+import run
+from myadsp import tasks
+from myadsp.models import Base, KeyValue, UserCost
+
+
+class TestRun(unittest.TestCase):
+    """
+    Tests the dispatch of a processing run by run.py
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        Base.metadata.bind = run.app._session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+
+    def _get_value(self, key):
+        with run.app.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key=key).first()
+            return json.loads(kv.value) if kv is not None else None
+
+    def _dispatch(self):
+        """
+        Runs a daily dispatch of three users, the second of them heavy
+
+        :return: list of (user IDs, apply_async options) of each dispatch
+        """
+        dispatched = []
+
+        def dispatch(task, messages, **options):
+            messages = list(messages)
+            dispatched.append(([m['userid'] for m in messages], options))
+            return {'published': len(messages), 'seconds': 1., 'rate': len(messages), 'throttled': 0.}
+
+        with patch.object(run.app, 'iter_users', return_value=[(1, 5.), (2, 50.), (3, None)]), \
+                patch.object(run.app, 'get_heavy_users', return_value=set([2])), \
+                patch.object(run.dispatch.Dispatcher, 'dispatch', side_effect=dispatch), \
+                patch.object(run, 'report_makespan'):
+            run.process_myads(frequency='daily', batch_size=1)
+        return dispatched
+
+    def test_heavy_users(self):
+        # without a heavy users queue, heavy users stay in the main stream, and in the predicted processing time
+        self.assertEqual(self._dispatch(), [([1, 2, 3], {})])
+        makespan = self._get_value('run.makespan.daily')
+        self.assertEqual(makespan['users'], 3)
+        self.assertEqual(makespan['heavy_users'], [])
+
+        # with it, they're dispatched last, to their queue
+        queues = dict((k, tasks.app.conf.get(k)) for k in ('MYADS_QUEUES', 'MYADS_RETRY_QUEUES'))
+        self.addCleanup(tasks.app.conf.update, queues)
+        tasks.app.conf['MYADS_QUEUES'] = {'daily': 'process_daily', 'weekly': 'process_weekly'}
+        dispatched = self._dispatch()
+        self.assertEqual([d[0] for d in dispatched], [[1, 3], [2]])
+        self.assertEqual(dispatched[0][1]['queue'], 'process_daily')
+        self.assertEqual(dispatched[1][1]['queue'], tasks.app.conf.get('MYADS_HEAVY_QUEUE'))
+        makespan = self._get_value('run.makespan.daily')
+        self.assertEqual(makespan['users'], 2)
+        self.assertEqual(makespan['heavy_users'], [2])
+
+    def test_report_makespan(self):
+        self.assertIsNone(run.report_makespan('daily'))
+
+        # 16 worker slots: the 50s user takes the longest
+        self._dispatch()
+        makespan = self._get_value('run.makespan.daily')
+        self.assertEqual(makespan['predicted_seconds'], 50)
+
+        # users 1 and 2 are processed in the predicted time; user 3 fails once, and is processed again after the
+        # resend window. User 4 was processed in the previous run
+        started = adsputils.get_date(makespan['started'])
+        with run.app.session_scope() as session:
+            for user_id, seconds, retries in ((1, 5, 0), (2, 52, 0), (3, 602, 1), (4, -86400, 0)):
+                session.add(UserCost(user_id=user_id, frequency='daily', num_queries=1, num_rows=1, retries=retries,
+                                     updated=started + datetime.timedelta(seconds=seconds)))
+            session.commit()
+
+        record = run.report_makespan('daily')
+        self.assertEqual((record['completed'], record['retried']), (2, 1))
+        self.assertEqual(record['actual_seconds'], 52)
+        self.assertAlmostEqual(record['actual_seconds'] / record['predicted_seconds'], 1.04)
+        self.assertEqual(self._get_value('run.makespan.daily'), record)
+
+    def test_arxiv_ingest_timeout(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        os.mkdir(os.path.join(tmpdir, '2020-01-01'))
+        with open(os.path.join(tmpdir, '2020-01-01', 'new_records.tsv'), 'w') as f:
+            f.write('2012.14424\toai/arXiv.org/2012/14424\n')
+
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'response': {'numFound': 0}}
+        # the wait for the file takes most of the timeout: Solr is only polled for the rest of it (delays of 5, 10, 20,
+        # 40 and 60s)
+        with patch.dict(run.config, {'ARXIV_INCOMING_ABS_DIR': tmpdir, 'INGEST_BACKOFF_START': 5}), \
+                patch.object(run.ingest.FileWatcher, 'wait', return_value=7100) as wait, \
+                patch.object(run.app.client, 'get', return_value=response) as get, \
+                patch.object(run.time, 'sleep'):
+            self.assertIsNone(run._arxiv_ingest_complete(date='2020-01-01', sleep_delay=60, sleep_timeout=7200,
+                                                         watch=True))
+        self.assertEqual(wait.call_args[0][1], 7200)
+        self.assertTrue(wait.call_args[1]['settle'])
+        self.assertEqual(get.call_count, 5)
+
+    def _run_shard(self, shard, now, fail=False):
+        """
+        Runs a daily dispatch of one shard, at a given time
+
+        :param shard: tuple; (shard index, number of shards)
+        :param now: basestring; time of the run
+        :param fail: boolean; if True, the dispatch fails
+        :return: basestring; since date the users of the shard were read with
+        """
+        def dispatch(task, messages, **options):
+            if fail:
+                raise IOError('broker unreachable')
+            messages = list(messages)
+            return {'published': len(messages), 'seconds': 1., 'rate': len(messages), 'throttled': 0.}
+
+        with patch.object(run, 'get_date', side_effect=lambda *a: adsputils.get_date(*a or [now])), \
+                patch.object(run.app, 'iter_users', return_value=[(shard[0] + 1, 5.)]) as iter_users, \
+                patch.object(run.dispatch.Dispatcher, 'dispatch', side_effect=dispatch), \
+                patch.object(run, 'report_makespan'):
+            try:
+                run.process_myads(frequency='daily', batch_size=1, shard=shard)
+            except IOError:
+                pass
+        return iter_users.call_args[0][0]
+
+    def test_shard_watermarks(self):
+        with run.app.session_scope() as session:
+            run._set_value(session, run._watermark_key('daily'), '2020-01-01T12:00:00+00:00')
+            session.commit()
+        self.assertEqual(run._watermark_key('daily', (1, 2)), 'last.process.daily.shard.1/2')
+
+        # the first sharded run starts from the last unsharded one
+        self.assertEqual(self._run_shard((0, 2), '2020-01-02T12:00:00Z'), '2020-01-01T12:00:00+00:00')
+        self.assertEqual(self._get_value('run.summary.daily.shard.0/2')['users'], 1)
+        self.assertEqual(run._last_process_date('daily', (0, 2)), '2020-01-02T12:00:00+00:00')
+
+        # while a shard hasn't finished, the global last processing date doesn't advance, and the shard starts from it
+        self._run_shard((1, 2), '2020-01-02T12:05:00Z', fail=True)
+        self.assertEqual(run._last_process_date('daily'), '2020-01-01T12:00:00+00:00')
+        self.assertEqual(run._last_process_date('daily', (1, 2)), '2020-01-01T12:00:00+00:00')
+        self.assertIsNone(self._get_value('run.summary.daily'))
+
+        # once all shards of the run are done, it advances to the earliest of theirs
+        self.assertEqual(self._run_shard((1, 2), '2020-01-02T12:10:00Z'), '2020-01-01T12:00:00+00:00')
+        self.assertEqual(run._last_process_date('daily'), '2020-01-02T12:00:00+00:00')
+        merged = self._get_value('run.summary.daily')
+        self.assertEqual((merged['shards'], merged['users'], merged['published']), (2, 2, 2))
+        self.assertEqual(merged['seconds'], 600)
+
+        # a shard that finished on another day isn't merged with them
+        self._run_shard((0, 2), '2020-01-03T12:00:00Z')
+        self.assertEqual(run._last_process_date('daily'), '2020-01-02T12:00:00+00:00')
+        self.assertIsNone(run.merge_shard_summaries('daily', (1, 2), {'date': '2020-01-04', 'users': 1}))
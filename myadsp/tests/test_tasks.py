@@ -12,8 +12,9 @@ except ImportError:
 
 import adsputils
 from myadsp import app, utils, tasks
-from myadsp.models import Base, AuthorInfo
+from myadsp.models import Base, AuthorInfo, UserCost
 from ..emails import myADSTemplate
+from ..metrics import Metrics
 
 class TestmyADSCelery(unittest.TestCase):
     """
@@ -173,14 +174,15 @@ class TestmyADSCelery(unittest.TestCase):
                                status=401
                                )
 
-        with patch.object(self.app, 'get_recent_results') as get_recent_results, \
+        with patch.object(self.app, 'get_recent_results_batch') as get_recent_results_batch, \
             patch.object(utils, 'get_user_email') as get_user_email, \
             patch.object(utils, 'payload_to_plain') as payload_to_plain, \
             patch.object(utils, 'payload_to_html') as payload_to_html, \
             patch.object(utils, 'send_email') as send_email, \
             patch.object(tasks.task_process_myads, 'apply_async') as rerun_task:
 
-            get_recent_results.return_value = ['2019arXiv190800829P', '2019arXiv190800678L']
+            get_recent_results_batch.side_effect = lambda user_id, queries, ndays: \
+                [['2019arXiv190800829P', '2019arXiv190800678L'] for q in queries]
             get_user_email.return_value = 'test@test.com'
             payload_to_plain.return_value = 'plain payload'
             payload_to_html.return_value = '<em>html payload</em>'
@@ -362,13 +364,14 @@ class TestmyADSCelery(unittest.TestCase):
                                                     "bibstem": ["JSpRo"]}]}})
         )
 
-        with patch.object(self.app, 'get_recent_results') as get_recent_results, \
+        with patch.object(self.app, 'get_recent_results_batch') as get_recent_results_batch, \
             patch.object(utils, 'get_user_email') as get_user_email, \
             patch.object(utils, 'payload_to_plain') as payload_to_plain, \
             patch.object(utils, 'payload_to_html') as payload_to_html, \
             patch.object(utils, 'send_email') as send_email:
 
-            get_recent_results.return_value = ['2019arXiv190800829P', '2019arXiv190800678L']
+            get_recent_results_batch.side_effect = lambda user_id, queries, ndays: \
+                [['2019arXiv190800829P', '2019arXiv190800678L'] for q in queries]
             get_user_email.return_value = 'test@test.com'
             payload_to_plain.return_value = 'plain payload'
             payload_to_html.return_value = '<em>html payload</em>'
@@ -510,3 +513,193 @@ class TestmyADSCelery(unittest.TestCase):
                 tasks.task_process_myads(msg)
                 logger.assert_called_with(u"No payload for user {0} for the {1} email. No email was sent.".format(msg['userid'], msg['frequency']))
 
+
+    def test_process_users_concurrently(self):
+        messages = [{'userid': u, 'frequency': 'daily'} for u in range(1, 6)]
+
+        def process(message):
+            if message['userid'] == 3:
+                raise Exception('processing error')
+
+        with patch.object(tasks, 'task_process_myads', side_effect=process) as task_process_myads:
+            failed = tasks.process_users_concurrently(messages)
+
+            # every user is processed, and a failure doesn't affect the others
+            self.assertEqual(task_process_myads.call_count, 5)
+            self.assertEqual(sorted(c[0][0]['userid'] for c in task_process_myads.call_args_list), [1, 2, 3, 4, 5])
+            self.assertEqual(failed, 1)
+
+    def test_task_process_myads_batch(self):
+        messages = [{'userid': u, 'frequency': 'daily', 'force': False} for u in range(1, 6)]
+        messages.append({'frequency': 'daily'})
+        today = adsputils.get_date()
+        with tasks.app.session_scope() as session:
+            session.add(AuthorInfo(id=1, created=today, last_sent_daily=today))
+            session.add(AuthorInfo(id=2, created=today, last_sent_daily=today - datetime.timedelta(days=1)))
+            session.commit()
+
+        blocks = [({'id': 1, 'qid': '1234567890abcdefghijklmnopqrstu1', 'stateful': True}, 'general',
+                   {'results': [{'bibcode': 'bib1'}]})]
+
+        def get_query_results(message, last_sent):
+            if message['userid'] == 2:
+                self.assertEqual(last_sent, today - datetime.timedelta(days=1))
+            if message['userid'] == 3:
+                raise Exception('query error')
+            return blocks
+
+        def send_notification(message, blocks, new_bibcodes, cost=None):
+            self.assertEqual(new_bibcodes, [['bib1']])
+            if message['userid'] == 4:
+                raise Exception('sending error')
+            return True
+
+        with patch.object(tasks, '_get_query_results', side_effect=get_query_results) as _get_query_results, \
+            patch.object(tasks.app, 'get_recent_results_users') as get_recent_results_users, \
+            patch.object(tasks, '_send_notification', side_effect=send_notification), \
+            patch.object(tasks.task_process_myads, 'apply_async') as rerun_task:
+
+            get_recent_results_users.side_effect = lambda user_queries, ndays: \
+                dict((u, [['bib1']]) for u in user_queries)
+            tasks.task_process_myads_batch(messages)
+
+            # user 1 was already sent today; the history of all other users is read at once
+            self.assertEqual(sorted(c[0][0]['userid'] for c in _get_query_results.call_args_list), [2, 3, 4, 5])
+            self.assertEqual(get_recent_results_users.call_count, 1)
+            self.assertEqual(sorted(get_recent_results_users.call_args[0][0].keys()), [2, 4, 5])
+
+            # failed users are re-enqueued on their own
+            self.assertEqual(sorted(c[1]['args'][0]['userid'] for c in rerun_task.call_args_list), [3, 4])
+
+        with tasks.app.session_scope() as session:
+            authors = dict((q.id, q.last_sent_daily) for q in session.query(AuthorInfo).all())
+            self.assertEqual(sorted(authors.keys()), [1, 2, 3, 4, 5])
+            self.assertTrue(authors[2] >= today)
+            self.assertTrue(authors[5] >= today)
+            self.assertIsNone(authors[3])
+            self.assertIsNone(authors[4])
+
+            # the cost of each user that got results is recorded
+            costs = dict((q.user_id, q) for q in session.query(UserCost).filter_by(frequency='daily'))
+            self.assertEqual(sorted(costs.keys()), [2, 4, 5])
+            self.assertEqual((costs[2].num_queries, costs[2].num_rows), (1, 1))
+
+    def test_task_options(self):
+        # by default, everything goes to the process queue
+        self.assertEqual(tasks.task_options('daily'), {})
+        self.assertEqual(tasks.task_options('weekly', retry=True, heavy=True), {})
+        self.assertEqual([q.name for q in tasks.app.conf.CELERY_QUEUES], ['process'])
+        with patch.object(tasks.task_process_myads, 'apply_async') as rerun_task:
+            tasks.retry_later({'userid': 123, 'frequency': 'daily'}, 60)
+            rerun_task.assert_called_with(args=({'userid': 123, 'frequency': 'daily'},), countdown=60)
+
+        queues = dict((k, tasks.app.conf.get(k)) for k in ('MYADS_QUEUES', 'MYADS_RETRY_QUEUES'))
+        self.addCleanup(tasks.app.conf.update, queues)
+        tasks.app.conf['MYADS_QUEUES'] = {'daily': 'process_daily', 'weekly': 'process_weekly'}
+        tasks.app.conf['MYADS_RETRY_QUEUES'] = {'daily': 'retry_daily', 'weekly': 'retry_weekly'}
+
+        self.assertEqual(tasks.task_options('daily'), {'queue': 'process_daily', 'priority': 9})
+        self.assertEqual(tasks.task_options('weekly', retry=True), {'queue': 'retry_weekly', 'priority': 3})
+        self.assertEqual(tasks.task_options(None), {})
+        self.assertEqual(tasks.task_options('weekly', heavy=True), {'queue': 'process_heavy', 'priority': 3})
+
+        # retries go to the retry queue of their frequency, and heavy users stay on their queue
+        with patch.object(tasks.task_process_myads, 'apply_async') as rerun_task:
+            tasks.retry_later({'userid': 123, 'frequency': 'daily'}, 60)
+            rerun_task.assert_called_with(args=({'userid': 123, 'frequency': 'daily'},), countdown=60,
+                                          queue='retry_daily', priority=9)
+            tasks.retry_later({'userid': 123, 'frequency': 'daily', 'heavy': True}, 60)
+            rerun_task.assert_called_with(args=({'userid': 123, 'frequency': 'daily', 'heavy': True},), countdown=60,
+                                          queue='process_heavy', priority=9)
+
+    def test_searcher_gate(self):
+        msg = {'userid': 123, 'frequency': 'daily', 'force': False, 'test_bibcode': '2012.14424',
+               'setup': []}
+        checked = (adsputils.get_date() - datetime.timedelta(seconds=60)).isoformat()
+        window = tasks.app.conf.get('MYADS_SOLR_RESEND_WINDOW', 3600)
+
+        # users parked by the same check are rescheduled for when it's due again
+        with patch.object(tasks.app, 'searcher_ready', return_value={'ready': False, 'checked': checked}) as gate, \
+                patch.object(tasks, 'retry_later') as retry_later:
+            self.assertIsNone(tasks._get_query_results(msg, None))
+            gate.assert_called_with('2012.14424')
+            self.assertEqual(retry_later.call_args[0][0]['solr_retries'], 1)
+            self.assertAlmostEqual(retry_later.call_args[0][1], window - 60, delta=5)
+
+        with patch.object(tasks.app, 'searcher_ready', return_value={'ready': True, 'checked': checked}), \
+                patch.object(tasks, 'retry_later') as retry_later:
+            self.assertEqual(tasks._get_query_results(msg, None), [])
+            self.assertFalse(retry_later.called)
+
+        # while another worker checks Solr for the first time, the user is retried shortly, without counting a retry
+        msg.pop('solr_retries')
+        with patch.object(tasks.app, 'searcher_ready', return_value={'ready': False, 'checked': checked,
+                                                                     'pending': True}), \
+                patch.object(tasks, 'retry_later') as retry_later:
+            self.assertIsNone(tasks._get_query_results(msg, None))
+            self.assertEqual(retry_later.call_args[0][1], tasks.app.conf.get('SOLR_READY_PENDING_DELAY', 30))
+            self.assertNotIn('solr_retries', retry_later.call_args[0][0])
+
+    def test_use_prefetched(self):
+        sent = adsputils.get_date('2020-01-01')
+        msgs = [{'userid': 1, 'frequency': 'daily'},
+                {'userid': 2, 'frequency': 'weekly', 'setup': [{'id': 3}]},
+                {'userid': 3, 'frequency': 'daily'}]
+        prefetched = {'daily': {1: {'setup': [{'id': 1}], 'email': 'user1@example.com'}},
+                      'weekly': {2: {'setup': [{'id': 2}], 'email': 'user2@example.com'}}}
+
+        prefetch_users = tasks.app.conf.get('PREFETCH_USERS', False)
+        self.addCleanup(tasks.app.conf.update, {'PREFETCH_USERS': prefetch_users})
+        tasks.app.conf['PREFETCH_USERS'] = True
+        with patch.object(tasks.app, 'get_prefetched', side_effect=lambda last_sent, frequency:
+                          prefetched[frequency]) as get_prefetched:
+            tasks._use_prefetched(msgs, {1: sent, 2: None, 3: None})
+
+        get_prefetched.assert_any_call({1: sent, 3: None}, 'daily')
+        get_prefetched.assert_any_call({2: None}, 'weekly')
+        self.assertEqual(msgs, [{'userid': 1, 'frequency': 'daily', 'setup': [{'id': 1}], 'email': 'user1@example.com'},
+                                {'userid': 2, 'frequency': 'weekly', 'setup': [{'id': 3}],
+                                 'email': 'user2@example.com'},
+                                {'userid': 3, 'frequency': 'daily'}])
+
+        # the prefetched email address is used instead of fetching it
+        blocks = [({'id': 1, 'stateful': False}, 'general',
+                   {'name': 'Query 1', 'query_url': 'url', 'query': 'q', 'results': [{'bibcode': 'bib1'}]})]
+        with patch.object(utils, 'get_user_email') as get_user_email, \
+                patch.object(utils, 'payload_to_html', return_value='html'), \
+                patch.object(utils, 'send_email', return_value='msg') as send_email:
+            self.assertTrue(tasks._send_notification(msgs[0], blocks, []))
+        self.assertFalse(get_user_email.called)
+        self.assertEqual(send_email.call_args[1]['email_addr'], 'user1@example.com')
+
+        # not used unless enabled
+        tasks.app.conf['PREFETCH_USERS'] = False
+        with patch.object(tasks.app, 'get_prefetched') as get_prefetched:
+            tasks._use_prefetched([{'userid': 3, 'frequency': 'daily'}], {3: None})
+        self.assertFalse(get_prefetched.called)
+
+    def test_stage_metrics(self):
+        registry = Metrics()
+        msg = {'userid': 123, 'frequency': 'daily', 'force': False, 'setup': [
+            {'id': 1, 'frequency': 'daily', 'type': 'template', 'template': 'arxiv', 'stateful': False}]}
+        block = {'name': 'Query 1', 'query_url': 'url', 'query': 'q', 'results': [{'bibcode': 'bib1'}]}
+
+        with patch.object(tasks, 'metrics', registry), \
+                patch.object(utils, 'set_query_options'), \
+                patch.object(utils, 'get_template_query_results', return_value=[block]), \
+                patch.object(utils, 'get_user_email', return_value='user@example.com'), \
+                patch.object(utils, 'payload_to_html', return_value='html'), \
+                patch.object(utils, 'send_email', return_value='msg'):
+            blocks = tasks._get_query_results(msg, None)
+            self.assertTrue(tasks._send_notification(msg, blocks, []))
+
+        text = registry.render()
+        for stage in ('stage="email_lookup"', 'stage="render"', 'stage="send"',
+                      'stage="query",template="arxiv"'):
+            self.assertIn('myads_stage_seconds_count{{frequency="daily",{0}}} 1'.format(stage), text)
+        # the setup came with the message: not fetched
+        self.assertNotIn('stage="setup"', text)
+        self.assertIn('myads_emails_total{frequency="daily",outcome="sent"} 1', text)
+
+        # disabled by default
+        self.assertFalse(tasks.metrics.enabled)
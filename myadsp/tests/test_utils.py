@@ -2,6 +2,7 @@ from future import standard_library
 standard_library.install_aliases()
 import unittest
 import os
+import threading
 import httpretty
 from mock import patch
 try:
@@ -13,6 +14,7 @@ import datetime
 
 import adsputils
 from myadsp import app, utils
+from myadsp.cache import MemoryCache
 from myadsp.models import Base
 from ..emails import myADSTemplate
 
@@ -89,6 +91,10 @@ class TestmyADSCelery(unittest.TestCase):
         payload_plain = 'plain test'
         payload_html = '<em>html test</em>'
         with patch('smtplib.SMTP') as mock_smtp:
+            # the pool sends the MAIL, RCPT, and DATA commands itself
+            conn = mock_smtp.return_value
+            conn.does_esmtp = False
+            conn.mail.return_value = conn.rcpt.return_value = conn.data.return_value = (250, b'OK')
             msg = utils.send_email(email_addr,
                                    email_template=myADSTemplate,
                                    payload_plain=payload_plain,
@@ -183,6 +189,51 @@ class TestmyADSCelery(unittest.TestCase):
                                     "query": 'author:Kurtz entdate:["{0}Z00:00" TO "{1}Z23:59"] pubdate:[{2}-00 TO *]'.format(start, end, start_year)
                                     }])
 
+    @httpretty.activate
+    def test_get_query_results_cached(self):
+        myADSsetup = {'name': 'Test Query',
+                      'qid': 1,
+                      'active': True,
+                      'stateful': False,
+                      'frequency': 'weekly',
+                      'type': 'query',
+                      'template': None,
+                      'query': [{'q': 'author:Kurtz', 'sort': 'score desc'}],
+                      'rows': 5,
+                      'fields': 'bibcode,title,author_norm,identifier'}
+
+        solr_requests = []
+
+        def solr_response(request, uri, response_headers):
+            solr_requests.append(uri)
+            return [200, response_headers,
+                    json.dumps({"response": {"numFound": 1,
+                                             "start": 0,
+                                             "docs": [{"bibcode": "1971JVST....8..324K",
+                                                       "identifier": ["1971JVST....8..324K"],
+                                                       "title": ["High-Capacity Lead Tin Barrel Dome Production Evaporator"],
+                                                       "author_norm": ["Kurtz, J"]}]}})]
+
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            body=solr_response
+        )
+
+        with patch.object(utils, 'query_cache', MemoryCache()) as query_cache:
+            results = utils.get_template_query_results(myADSsetup, run_id='daily:run1')
+            self.assertEqual(len(solr_requests), 1)
+
+            # identical query in the same run is served from the cache
+            cached_results = utils.get_template_query_results(myADSsetup, run_id='daily:run1')
+            self.assertEqual(len(solr_requests), 1)
+            self.assertEqual(results, cached_results)
+            self.assertEqual(query_cache.stats('daily:run1'), {'hits': 1, 'misses': 1})
+
+            # a new run queries solr again
+            utils.get_template_query_results(myADSsetup, run_id='daily:run2')
+            self.assertEqual(len(solr_requests), 2)
+
     @httpretty.activate
     def test_get_template_query_results(self):
         # test arxiv query
@@ -561,6 +612,48 @@ class TestmyADSCelery(unittest.TestCase):
                                                  u"bibstem": [u"JVST"]}]}
                                    ])
 
+    def test_map_concurrent(self):
+        # results are returned in the input order
+        self.assertEqual(utils.map_concurrent(lambda x: x * 2, [3, 1, 2], threads=3), [6, 2, 4])
+        self.assertEqual(utils.map_concurrent(lambda x: x * 2, [3, 1, 2], threads=1), [6, 2, 4])
+
+        def fail(x):
+            if x == 2:
+                raise RuntimeError('solr error')
+            return x
+
+        # failures are raised to the caller
+        with self.assertRaises(RuntimeError):
+            utils.map_concurrent(fail, [1, 2, 3], threads=3)
+
+    def test_map_concurrent_stages(self):
+        # pools sized for this test
+        with patch.dict(utils.config, {'MYADS_USER_CONCURRENCY': 2, 'SETUP_QUERY_THREADS': 3,
+                                       'SOLR_QUERY_THREADS': 2, 'PLANNER_THREADS': 5}), \
+                patch.object(utils, '_stage_pools', {}), patch.object(utils, '_stage_pools_pid', None):
+            # each stage has a thread for each item in flight in the stages above it
+            self.assertEqual([utils.stage_threads(s) for s in ('users', 'setups', 'solr', 'planner')], [2, 6, 12, 5])
+            with patch.dict(utils.config, {'SETUP_QUERY_THREADS': 1}):
+                self.assertEqual([utils.stage_threads(s) for s in ('users', 'setups', 'solr')], [2, 1, 4])
+
+            threads = set()
+
+            def query(x):
+                threads.add(threading.current_thread().name)
+                return x * 2
+
+            def setup(x):
+                # a stage nested in itself runs in the calling thread
+                return sum(utils.map_concurrent(query, [x, x + 1], stage='solr')) + \
+                    sum(utils.map_concurrent(lambda y: y, [x, x], stage='setups'))
+
+            self.assertEqual(utils.map_concurrent(setup, [1, 2, 3], stage='setups'), [8, 14, 20])
+            # each stage's pool is shared by all its calls
+            solr_pool = utils._stage_pools['solr']
+            self.assertEqual(utils.map_concurrent(query, list(range(20)), stage='solr'), [2 * x for x in range(20)])
+            self.assertIs(utils._stage_pools['solr'], solr_pool)
+            self.assertLessEqual(len(threads), 12)
+
     def test_get_first_author_formatted(self):
         results_dict = {"bibcode": "2012ApJS..199...26H",
                         "title": ["The 2MASS Redshift Survey: Description and Data Release"],
@@ -3,9 +3,10 @@ standard_library.install_aliases()
 from builtins import range
 from adsputils import get_date, setup_logging, load_config
 from .emails import Email
+from .cache import get_query_cache, normalize_query
+from .mailer import SMTPPool
 from myadsp import app as app_module
 
-import smtplib, ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 try:
@@ -14,7 +15,10 @@ except ImportError:
     from urllib import urlencode, quote_plus
 import json
 import os
+import threading
 from jinja2 import Environment, PackageLoader, select_autoescape
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 import datetime
 
 # ============================= INITIALIZATION ==================================== #
@@ -36,8 +40,124 @@ env = Environment(
                                  default_for_string=True)
 )
 
+query_cache = get_query_cache(config)
+
+# SMTP connection pool, created on first use by each worker process
+_smtp_pool = None
+_smtp_pool_pid = None
+
+# Thread pools shared by all the calls of each processing stage, created on first use by each worker process
+_stage_pools = {}
+_stage_pools_pid = None
+_stage_pools_lock = threading.Lock()
+# stage of the pool the current thread belongs to
+_stage_thread = threading.local()
+
+# Number of items of each stage processed at once for one item of the stage above it
+_STAGE_FANOUT = (('users', 'MYADS_USER_CONCURRENCY'), ('setups', 'SETUP_QUERY_THREADS'), ('solr', 'SOLR_QUERY_THREADS'))
+
 # =============================== FUNCTIONS ======================================= #
 
+def stage_threads(stage):
+    """
+    Size of the shared thread pool of a processing stage: users, the setups of each user, and the Solr queries of each
+    setup are nested stages, so the pool of a stage has a thread for each item of the stages above it times its own
+    fan-out (MYADS_USER_CONCURRENCY, SETUP_QUERY_THREADS, SOLR_QUERY_THREADS); the planner stage has PLANNER_THREADS
+    :param stage: string; 'users', 'setups', 'solr', or 'planner'
+    :return: int; number of threads; 1 if the stage is sequential
+    """
+    if stage == 'planner':
+        return config.get('PLANNER_THREADS', 8)
+    threads = 1
+    for name, key in _STAGE_FANOUT:
+        fanout = max(config.get(key, 1), 1)
+        if name == stage:
+            return threads * fanout if fanout > 1 else 1
+        threads *= fanout
+    raise ValueError('Unknown stage {0}'.format(stage))
+
+
+def _stage_pool(stage, threads):
+    global _stage_pools, _stage_pools_pid
+    with _stage_pools_lock:
+        # threads aren't inherited by forked worker processes
+        if _stage_pools_pid != os.getpid():
+            _stage_pools = {}
+            _stage_pools_pid = os.getpid()
+        if stage not in _stage_pools:
+            if threads > config.get('MAX_CONNECTIONS_PER_HOST', 16):
+                logger.warning('{0} {1} threads share {2} connections per host; the others wait for a connection'.
+                               format(threads, stage, config.get('MAX_CONNECTIONS_PER_HOST', 16)))
+            _stage_pools[stage] = ThreadPool(threads)
+        return _stage_pools[stage]
+
+
+def map_concurrent(func, items, threads=None, stage=None):
+    """
+    Applies a function to each item on a bounded thread pool: the pool of the stage, shared by all its calls in this
+    process, or, without a stage, a pool for this call
+    :param func: function taking a single item
+    :param items: list of items
+    :param threads: int; number of threads of the pool (default: stage_threads(stage), or 1 without a stage); if 1 or
+        less, items are processed sequentially. A stage's pool is sized by the call that creates it
+    :param stage: string; processing stage of func (see stage_threads)
+    :return: list of results, in the same order as items; the first exception raised by func is re-raised
+    """
+    items = list(items)
+    if threads is None:
+        threads = stage_threads(stage) if stage else 1
+    # a thread of the stage's pool waiting on the same pool could wait forever
+    if threads <= 1 or len(items) <= 1 or stage and getattr(_stage_thread, 'stage', None) == stage:
+        return [func(i) for i in items]
+
+    if stage:
+        def call(item):
+            _stage_thread.stage = stage
+            return func(item)
+        return _stage_pool(stage, threads).map(call, items)
+
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def limit_host_connections(client, max_per_host=10):
+    """
+    Caps the number of concurrent connections an HTTP client opens to any single host; further requests
+    wait for a free connection instead of opening a new one
+    :param client: requests.Session
+    :param max_per_host: int; maximum number of connections per host
+    :return: no return
+    """
+    for prefix in ('http://', 'https://'):
+        client.mount(prefix, HTTPAdapter(pool_maxsize=max_per_host, pool_block=True))
+
+
+limit_host_connections(app.client, config.get('MAX_CONNECTIONS_PER_HOST', 16))
+
+
+def get_smtp_pool():
+    """
+    Returns the SMTP connection pool of the current process, creating it if needed
+    :return: mailer.SMTPPool
+    """
+    global _smtp_pool, _smtp_pool_pid
+    # connections can't be shared with forked worker processes
+    if _smtp_pool is None or _smtp_pool_pid != os.getpid():
+        _smtp_pool = SMTPPool(config.get('MAIL_SERVER'), config.get('MAIL_PORT'),
+                              use_tls=config.get('MAIL_USE_TLS', False),
+                              username=config.get('MAIL_USERNAME', None),
+                              password=config.get('MAIL_PASSWORD', None),
+                              max_connections=config.get('MAIL_POOL_MAX_CONNECTIONS', 2),
+                              max_messages=config.get('MAIL_POOL_MAX_MESSAGES', 100),
+                              idle_check=config.get('MAIL_POOL_IDLE_CHECK', 30))
+        _smtp_pool_pid = os.getpid()
+    return _smtp_pool
+
+
 def send_email(email_addr='', email_template=Email, payload_plain=None, payload_html=None, subject=None):
     """
     Encrypts a payload using itsDangerous.TimeSerializer, adding it along with a base
@@ -71,22 +191,16 @@ def send_email(email_addr='', email_template=Email, payload_plain=None, payload_
     msg.attach(html)
 
     try:
-        server = smtplib.SMTP(config.get('MAIL_SERVER'), config.get('MAIL_PORT'))
-        if config.get('MAIL_USE_TLS', False):
-            server.starttls()
-        if config.get('MAIL_USERNAME', None) and config.get('MAIL_PASSWORD', None):
-            server.login(config.get('MAIL_USERNAME'),
-                         config.get('MAIL_PASSWORD'))
-        server.sendmail(config.get('MAIL_DEFAULT_SENDER'),
-                        email_addr,
-                        msg.as_string())
-        server.quit()
+        get_smtp_pool().sendmail(config.get('MAIL_DEFAULT_SENDER'),
+                                 email_addr,
+                                 msg.as_string())
     except Exception as e:
         logger.error('Error sending email to {0} with payload: {1} with error {2}'.format(email_addr, plain, e))
         return None
 
     logger.info('Email sent to {0}'.format(email_addr))
     logger.debug('Email sent to {0} with payload: {1}'.format(email_addr, plain))
+    logger.debug('SMTP pool health: {0}'.format(get_smtp_pool().health()))
     return msg
 
 
@@ -114,10 +228,56 @@ def get_user_email(userid=None):
         return None
 
 
-def get_template_query_results(myADSsetup):
+def get_myads_setup(userid=None, start_date=None):
+    """
+    Fetches the myADS setup for a user from vault
+
+    :param userid: str, system user ID
+    :param start_date: datetime; if given, queries are constructed to return results since this date
+
+    :return: list of myADS setups, or None if the request failed
+    """
+    if start_date:
+        r = app.client.get(config.get('API_VAULT_MYADS_SETUP_DATE') % (userid, start_date),
+                           headers={'Accept': 'application/json',
+                                    'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+    else:
+        r = app.client.get(config.get('API_VAULT_MYADS_SETUP') % userid,
+                           headers={'Accept': 'application/json',
+                                    'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+
+    if r.status_code != 200:
+        logger.warning('Error getting myADS setup for user {0} from the API ({1})'.format(userid, r.status_code))
+        return None
+
+    return r.json()
+
+
+def set_query_options(myADSsetup):
+    """
+    Sets the number of rows, the fields, and the default sort for a single myADS setup
+    :param myADSsetup: dict containing query terms, params, and metadata
+    :return: myADSsetup, updated in place
+    """
+    # only return 5 results, unless it's the daily arXiv posting, then return max
+    # TODO should all stateful queries return all results or will this be overwhelming for some? well-cited
+    # users can get 40+ new cites in one weekly astro update
+    if myADSsetup['frequency'] == 'daily':
+        myADSsetup['rows'] = config.get('MAX_NUM_ROWS_DAILY', 2000)
+    else:
+        myADSsetup['rows'] = config.get('MAX_NUM_ROWS_WEEKLY', 5)
+    myADSsetup['fields'] = 'bibcode,title,author_norm,identifier,year,bibstem'
+    if myADSsetup.get('query') and 'sort' not in myADSsetup['query'][0]:
+        myADSsetup['query'][0]['sort'] = 'date desc, bibcode desc'
+
+    return myADSsetup
+
+
+def get_template_query_results(myADSsetup, run_id=None):
     """
     Retrieves results for a templated query
     :param myADSsetup: dict containing query terms, params, and metadata
+    :param run_id: basestring; ID of the current processing run, used to share query results between users
     :return: payload: list of dicts containing query name, query url, raw search results
     """
 
@@ -159,6 +319,20 @@ def get_template_query_results(myADSsetup):
             else:
                 name.append('{0} - Recent Papers'.format(raw_name))
 
+    def run_query(params):
+        if params is None:
+            # get the number of citations
+            return get_citation_count(myADSsetup['data'], run_id=run_id)
+        return get_query_docs(params, myADSsetup['fields'], myADSsetup['rows'], run_id=run_id)
+
+    # all sub-queries of the setup, plus the citations count, are sent concurrently
+    jobs = list(myADSsetup['query'])
+    if myADSsetup['template'] == 'citations':
+        jobs.append(None)
+    all_docs = map_concurrent(run_query, jobs, stage='solr')
+    if myADSsetup['template'] == 'citations':
+        num_cites = all_docs.pop()
+
     payload = []
 
     for i in range(len(myADSsetup['query'])):
@@ -166,37 +340,81 @@ def get_template_query_results(myADSsetup):
                          format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
                                 arguments=urlencode(myADSsetup['query'][i], doseq=True))
 
-        r = app.client.get('{query_url}&fl={fields}&rows={rows}'.
-                           format(query_url=query,
-                                  fields=myADSsetup['fields'],
-                                  rows=myADSsetup['rows']),
-                           headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
-
-        if r.status_code != 200:
-            logger.error('Failed getting results for query {0} from our own API'.format(myADSsetup['query'][i]))
-            raise RuntimeError(r.text)
-        else:
-            docs = json.loads(r.text)['response']['docs']
-            for doc in docs:
-                arxiv_ids = [j for j in doc['identifier'] if j.startswith('arXiv:')]
-                if len(arxiv_ids) > 0:
-                    doc['arxiv_id'] = arxiv_ids[0]
-            if myADSsetup['template'] == 'citations':
-                # get the number of citations
-                cites_query = '{endpoint}?q={query}&rows=1&stats=true&stats.field=citation_count'. \
-                               format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
-                                      query=quote_plus(myADSsetup['data']))
-                cites_r = app.client.get(cites_query,
-                                         headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
-                name[i] = name[i] % int(cites_r.json()['stats']['stats_fields']['citation_count']['sum'])
+        if myADSsetup['template'] == 'citations':
+            name[i] = name[i] % num_cites
 
         query_url = query.replace(config.get('API_SOLR_QUERY_ENDPOINT') + '?', config.get('UI_ENDPOINT') + '/search/') \
                     + '?utm_source=myads&utm_medium=email&utm_campaign=type:{0}&utm_term={1}&utm_content=queryurl'
-        payload.append({'name': name[i], 'query_url': query_url, 'query': myADSsetup['query'][i]['q'], 'results': docs})
+        payload.append({'name': name[i], 'query_url': query_url, 'query': myADSsetup['query'][i]['q'],
+                        'results': all_docs[i]})
 
     return payload
 
 
+def get_query_docs(query_params, fields, rows, run_id=None):
+    """
+    Executes a single Solr query, using the run-scoped query cache if it's enabled
+    :param query_params: dict of Solr query parameters (q, sort)
+    :param fields: basestring; comma-delimited list of fields to return
+    :param rows: int; number of rows to return
+    :param run_id: basestring; ID of the current processing run - results are only cached within a run
+    :return: list of docs
+    """
+    if query_cache is not None and run_id:
+        key = normalize_query(query_params, fields=fields, rows=rows)
+        docs = query_cache.get(run_id, key)
+        if docs is not None:
+            return docs
+
+    r = app.client.get('{endpoint}?{arguments}&fl={fields}&rows={rows}'.
+                       format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
+                              arguments=urlencode(query_params, doseq=True),
+                              fields=fields,
+                              rows=rows),
+                       headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+
+    if r.status_code != 200:
+        logger.error('Failed getting results for query {0} from our own API'.format(query_params))
+        raise RuntimeError(r.text)
+
+    docs = json.loads(r.text)['response']['docs']
+    for doc in docs:
+        arxiv_ids = [j for j in doc['identifier'] if j.startswith('arXiv:')]
+        if len(arxiv_ids) > 0:
+            doc['arxiv_id'] = arxiv_ids[0]
+
+    if query_cache is not None and run_id:
+        query_cache.set(run_id, key, docs)
+
+    return docs
+
+
+def get_citation_count(data, run_id=None):
+    """
+    Fetches the total number of citations to the papers matching a query, for the citations template
+    :param data: basestring; query for the papers to count citations to
+    :param run_id: basestring; ID of the current processing run - results are only cached within a run
+    :return: int; number of citations
+    """
+    if query_cache is not None and run_id:
+        key = normalize_query({'q': data, 'stats.field': 'citation_count'})
+        count = query_cache.get(run_id, key)
+        if count is not None:
+            return count
+
+    cites_query = '{endpoint}?q={query}&rows=1&stats=true&stats.field=citation_count'. \
+                   format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
+                          query=quote_plus(data))
+    cites_r = app.client.get(cites_query,
+                             headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+    count = int(cites_r.json()['stats']['stats_fields']['citation_count']['sum'])
+
+    if query_cache is not None and run_id:
+        query_cache.set(run_id, key, count)
+
+    return count
+
+
 def _get_first_author_formatted(result_dict=None, author_field='author_norm', num_authors=3):
     """
     Get the first author, format it correctly
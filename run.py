@@ -1,8 +1,9 @@
 from __future__ import print_function
 from past.builtins import basestring
 from adsputils import setup_logging, get_date, load_config
-from myadsp import tasks, utils
-from myadsp.models import KeyValue
+from myadsp import tasks, utils, planner, dispatch, ingest, prefetch
+from myadsp.app import user_shard
+from myadsp.models import KeyValue, UserCost
 
 import sys
 import os
@@ -12,8 +13,10 @@ import logging
 import warnings
 import datetime
 import gzip
-import random
 import json
+import itertools
+import contextlib
+import threading
 try:
     from urllib.parse import quote_plus
 except ImportError:
@@ -34,12 +37,28 @@ app = tasks.app
 
 # =============================== FUNCTIONS ======================================= #
 
-def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_email=None):
+def _solr_delays(sleep_delay, watch=False):
+    """
+    Delays between the checks of an ingest
+
+    :param sleep_delay: number of seconds to sleep between retries
+    :param watch: if True, delays start at INGEST_BACKOFF_START and double up to sleep_delay
+    :return: infinite iterator of delays, in seconds
+    """
+    if watch:
+        return ingest.backoff_delays(min(config.get('INGEST_BACKOFF_START', 5), sleep_delay), sleep_delay)
+    return itertools.repeat(sleep_delay)
+
+
+def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_email=None, watch=False):
     """
     Check if new arXiv records are in Solr - run before running myADS processing
     :param date: date to check arXiv records for; default is set by days-delta from today in config (times in local time)
     :param sleep_delay: number of seconds to sleep between retries
     :param sleep_timeout: number of seconds to retry in total before timing out completely
+    :param admin_email: if provided, email is sent to this address if the ingest fails
+    :param watch: if True, wait for the ingest file to be written instead of failing if it's missing, and query Solr
+        right away, then with increasing delays up to sleep_delay
     :return: test bibcode or None
     """
 
@@ -50,12 +69,24 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
 
     arxiv_file = os.path.join(config.get('ARXIV_INCOMING_ABS_DIR'), date, 'new_records.tsv')
 
-    arxiv_records = []
+    detect = {'mode': 'sleep'}
+    # the wait for the file and for Solr share the timeout
+    solr_timeout = sleep_timeout
+    if watch:
+        watcher = ingest.FileWatcher(arxiv_file)
+        detect['mode'] = watcher.mode
+        waited = watcher.wait(lambda path: bool(ingest.file_mtime(path) and os.path.getsize(path)), sleep_timeout,
+                              settle=True)
+        if waited is not None:
+            detect['file_lag'] = time.time() - ingest.file_mtime(arxiv_file)
+            solr_timeout -= waited
+        else:
+            solr_timeout = 0
+
     try:
-        with open(arxiv_file, 'rt') as flist:
-            for l in flist.readlines():
-                # sample line: 2012.14424	oai/arXiv.org/2012/14424
-                arxiv_records.append(l.split()[0])
+        # sample line: 2012.14424	oai/arXiv.org/2012/14424
+        # get most recent arXiv id to test ingest later
+        last_id = ingest.max_record(arxiv_file)
     except IOError:
         logger.warning('arXiv ingest file not found. Exiting.')
         if admin_email:
@@ -66,18 +97,21 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
                                    subject='arXiv ingest failed')
         return None
 
-    arxiv_records.sort()
-
-    # get most recent arXiv id to test ingest later
-    last_id = arxiv_records.pop()
+    if last_id is None:
+        logger.warning('arXiv ingest file is empty. Exiting.')
+        return None
 
+    delays = _solr_delays(sleep_delay, watch)
+    solr_start = time.time()
     total_delay = 0
-    while total_delay < sleep_timeout:
-        total_delay += sleep_delay
+    while total_delay < solr_timeout:
+        delay = next(delays)
+        total_delay += delay
+        detect['solr_probes'] = detect.get('solr_probes', 0) + 1
         r = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(config.get('API_SOLR_QUERY_ENDPOINT'), last_id),
                            headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
         if r.status_code != 200:
-            time.sleep(sleep_delay)
+            time.sleep(delay)
             logger.error('Error retrieving record for {0} from Solr ({1} {2}), retrying'.
                          format(last_id, r.status_code, r.text))
             continue
@@ -85,9 +119,9 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
         numfound = r.json()['response']['numFound']
         if numfound == 0:
             # nothing found, try again after a sleep
-            time.sleep(sleep_delay)
+            time.sleep(delay)
             logger.info('arXiv ingest not complete (test arXiv id: {0}). Sleeping {1}s, for a total delay of {2}s.'
-                        .format(last_id, sleep_delay, total_delay))
+                        .format(last_id, delay, total_delay))
             continue
         if numfound > 1:
             # returning this as true for now, since technically something was found
@@ -95,6 +129,8 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
 
         logger.info('Numfound: {0} for test id {1}. Response: {2}. URL: {3}'.format(numfound, last_id,
                                                                                     json.dumps(r.json()), r.url))
+        detect['solr_seconds'] = time.time() - solr_start
+        _record_detection('arxiv', detect)
 
         # check number of bibcodes from ingest
         if get_date().weekday() == 0:
@@ -108,6 +144,8 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
                            headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
         logger.info('Total number of arXiv bibcodes ingested: {}'.format(q.json()['response']['numFound']))
 
+        # the processing tasks of this run read the readiness of the searchers from the gate
+        app.set_searcher_ready(last_id, True)
         return last_id
 
     logger.warning('arXiv ingest did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
@@ -121,12 +159,15 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
     return None
 
 
-def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_email=None):
+def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_email=None, watch=False):
     """
     Check if new astronomy records are in Solr; run before weekly processing
     :param date: check to check against astronomy bibcode list last updated date
     :param sleep_delay: number of seconds to sleep between retries
     :param sleep_timeout: number of seconds to retry in total before timing out completely
+    :param admin_email: if provided, email is sent to this address if the ingest fails
+    :param watch: if True, check the ingest file as soon as it's written instead of sleeping between checks, and
+        query Solr right away, then with increasing delays up to sleep_delay
     :return: test bibcode or None
     """
 
@@ -143,19 +184,36 @@ def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
     except OSError:
         mod_date = None
 
-    # if the file is old or missing, sleep until the file is present and updated
-    if not mod_date or mod_date < date:
-        total_delay = 0
-        while total_delay < sleep_timeout:
-            total_delay += sleep_delay
-            time.sleep(sleep_delay)
-            try:
-                mod_date = datetime.datetime.fromtimestamp(os.path.getmtime(astro_file))
-            except OSError:
-                mod_date = None
-            if mod_date and mod_date > date:
-                break
+    def updated(path):
+        mtime = ingest.file_mtime(path)
+        return mtime is not None and datetime.datetime.fromtimestamp(mtime) > date
+
+    detect = {'mode': 'sleep'}
+    if watch:
+        watcher = ingest.FileWatcher(astro_file)
+        detect['mode'] = watcher.mode
+
+    # the wait for the file, and the checks of the file and of Solr share the timeout
+    check_timeout = sleep_timeout
+    stale = not mod_date or mod_date < date
+    # if the file is old or missing, sleep until the file is present and updated; when watching, also until it's no
+    # longer being written
+    if watch or stale:
+        if watch:
+            waited = watcher.wait(updated, sleep_timeout, settle=True)
+            complete = waited is not None
+            if complete:
+                check_timeout -= waited
         else:
+            complete = False
+            total_delay = 0
+            while total_delay < sleep_timeout:
+                total_delay += sleep_delay
+                time.sleep(sleep_delay)
+                if updated(astro_file):
+                    complete = True
+                    break
+        if not complete:
             # timeout reached before astronomy update completed
             logger.warning('Astronomy update did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
 
@@ -168,28 +226,31 @@ def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
                                        subject='Astronomy ingest failed')
 
             return None
+        if watch and stale:
+            detect['file_lag'] = time.time() - ingest.file_mtime(astro_file)
 
     # make sure the ingest file exists and has enough bibcodes
+    delays = _solr_delays(sleep_delay, watch)
     total_delay = 0
-    while total_delay < sleep_timeout:
-        astro_records = []
+    while total_delay < check_timeout:
         try:
-            with open(astro_file, 'rt') as flist:
-                for l in flist.readlines():
-                    # sample line: 2019A&A...632A..94J     K58-37447
-                    astro_records.append(l.split()[0])
+            # sample line: 2019A&A...632A..94J     K58-37447
+            # get several randomly selected bibcodes, in case one had ingest issues; an unchanged file isn't read again
+            num_records, sample = ingest.sample_records(astro_file, config.get('ASTRO_SAMPLE_SIZE'))
         except IOError:
-            time.sleep(sleep_delay)
-            total_delay += sleep_delay
+            delay = next(delays)
+            time.sleep(delay)
+            total_delay += delay
             logger.warning('Error opening astronomy ingest file. Sleeping {0}s, for a total delay of {1}s'.
-                           format(sleep_delay, total_delay))
+                           format(delay, total_delay))
             continue
 
-        if len(astro_records) < 10:
-            time.sleep(sleep_delay)
-            total_delay += sleep_delay
+        if num_records < 10:
+            delay = next(delays)
+            time.sleep(delay)
+            total_delay += delay
             logger.warning('Astronomy ingest file too small - ingest not complete. Sleeping {0}s, for a total delay of {1}s'.
-                           format(sleep_delay, total_delay))
+                           format(delay, total_delay))
             continue
         else:
             break
@@ -203,47 +264,40 @@ def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
                                    subject='Astronomy ingest failed')
         return None
 
-    # get several randomly selected bibcodes, in case one had ingest issues
-    sample = random.sample(astro_records, config.get('ASTRO_SAMPLE_SIZE'))
-
-    # check that the astronomy records have made it into solr
+    # check that the astronomy records have made it into solr; the whole sample is checked by one query
+    delays = _solr_delays(sleep_delay, watch)
+    solr_start = time.time()
     total_delay = 0
-    while total_delay < sleep_timeout:
-        num_sampled = 0
-        for s in sample:
-            num_sampled += 1
-            r = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(config.get('API_SOLR_QUERY_ENDPOINT'), s),
-                               headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
-            # if there's a solr error, sleep then move to the next bibcode
-            if r.status_code != 200:
-                time.sleep(sleep_delay)
-                total_delay += sleep_delay
-                logger.error('Error retrieving bibcode {0} from Solr ({1} {2}), sleeping {3}s, for a total delay of {4}s'.
-                             format(s, r.status_code, r.text, sleep_delay, total_delay))
-                continue
+    while total_delay < check_timeout:
+        detect['solr_probes'] = detect.get('solr_probes', 0) + 1
+        visible = ingest.visible_records(app.client, sample)
+        # if there's a solr error, sleep then try again
+        if visible is None:
+            delay = next(delays)
+            time.sleep(delay)
+            total_delay += delay
+            logger.error('Error retrieving the astronomy sample from Solr, sleeping {0}s, for a total delay of {1}s'.
+                         format(delay, total_delay))
+            continue
 
-            numfound = r.json()['response']['numFound']
-            if numfound == 0:
-                # nothing found - if all bibcodes in the sample were tried, sleep then start the while loop again
-                if num_sampled == config.get('ASTRO_SAMPLE_SIZE'):
-                    time.sleep(sleep_delay)
-                    total_delay += sleep_delay
-                    logger.warning('Astronomy ingest not complete for all in sample (sample: {0}). Sleeping {1}s, for a total delay of {2}s.'
-                                   .format(sample, sleep_delay, total_delay))
-                # if we haven't tried the others in the same, try the rest
-                else:
-                    logger.info(
-                        'Astronomy ingest not complete (test astro bibcode: {0}). Trying the next in the sample.'
-                        .format(s))
-                continue
-            elif numfound > 1:
-                # returning this as true for now, since technically something was found
-                logger.error('Too many records returned for bibcode {0}'.format(s))
+        fraction = len(visible) / float(len(sample))
+        if fraction < config.get('ASTRO_VISIBLE_FRACTION', 0.8):
+            delay = next(delays)
+            time.sleep(delay)
+            total_delay += delay
+            logger.warning('Astronomy ingest not complete: {0:.0%} of the sample is in Solr (sample: {1}). Sleeping '
+                           '{2}s, for a total delay of {3}s.'.format(fraction, sample, delay, total_delay))
+            continue
 
-            logger.info('Numfound: {0} for test bibcode {1}. Response: {2}. URL: {3}'.format(numfound, s,
-                                                                                             json.dumps(r.json()),
-                                                                                             r.url))
-            return s
+        # the first visible bibcode of the sample is the test bibcode of the run
+        s = [bibcode for bibcode in sample if bibcode in visible][0]
+        logger.info('{0} of {1} sampled bibcodes found in Solr ({2:.0%}); test bibcode {3}'.
+                    format(len(visible), len(sample), fraction, s))
+        detect['solr_seconds'] = time.time() - solr_start
+        detect['visible_fraction'] = fraction
+        _record_detection('astro', detect)
+        app.set_searcher_ready(s, True)
+        return s
 
     logger.warning('Astronomy ingest did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
 
@@ -257,8 +311,204 @@ def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200, admin_
     return None
 
 
+def _watermark_key(frequency, shard=None):
+    """
+    Key of the last processing date in the storage table; sharded runs keep one per shard
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    :return: basestring
+    """
+    if shard:
+        return 'last.process.{0}.shard.{1}/{2}'.format(frequency, shard[0], shard[1])
+    return 'last.process.{0}'.format(frequency)
+
+
+def _last_process_date(frequency, shard=None):
+    """
+    Timestamp of the last processing of a frequency, from the storage table
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    :return: basestring
+    """
+    with app.session_scope() as session:
+        kv = session.query(KeyValue).filter_by(key=_watermark_key(frequency, shard)).first()
+        if kv is None and shard:
+            # first sharded run
+            kv = session.query(KeyValue).filter_by(key=_watermark_key(frequency)).first()
+        if kv is not None:
+            return kv.value
+    return '1971-01-01T12:00:00Z'
+
+
+def _set_value(session, key, value):
+    kv = session.query(KeyValue).filter_by(key=key).first()
+    if kv is None:
+        session.add(KeyValue(key=key, value=value))
+    else:
+        kv.value = value
+
+
+def _record_detection(source, detect):
+    """
+    Logs and stores how long it took to detect the completion of an ingest, under ingest.detect.<source>
+
+    :param source: basestring; 'arxiv' or 'astro'
+    :param detect: dict; mode (inotify, poll or sleep), file_lag (seconds from the last write of the ingest file
+        to its detection, in watch mode), solr_seconds (seconds from the first Solr query to the records being
+        found), solr_probes (number of Solr queries) and, for the astronomy ingest, visible_fraction (fraction of
+        the sampled bibcodes found)
+    :return: no return
+    """
+    detect = dict(detect, detected=get_date().isoformat())
+    logger.info('{0} ingest detected ({1}): {2}'.format(source, detect['mode'], json.dumps(detect, sort_keys=True)))
+    with app.session_scope() as session:
+        _set_value(session, 'ingest.detect.{0}'.format(source), json.dumps(detect))
+        session.commit()
+
+
+def _makespan_key(frequency, shard=None):
+    """
+    Key of the predicted processing time of the last run in the storage table
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    :return: basestring
+    """
+    if shard:
+        return 'run.makespan.{0}.shard.{1}/{2}'.format(frequency, shard[0], shard[1])
+    return 'run.makespan.{0}'.format(frequency)
+
+
+def report_makespan(frequency, shard=None):
+    """
+    Compares the predicted processing time of the last run with the actual one: the time from its start until the
+    last of its (non heavy) users had its processing cost stored by a worker. Users that were rescheduled on errors
+    are left out of the actual time (they're processed MYADS_RESEND_WINDOW seconds later), and only counted
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    :return: dict; predicted and actual processing time, or None if there's no run to report
+    """
+    with app.session_scope() as session:
+        kv = session.query(KeyValue).filter_by(key=_makespan_key(frequency, shard)).first()
+        if kv is None:
+            return None
+        record = json.loads(kv.value)
+        started = get_date(record['started'])
+        heavy_users = set(record['heavy_users'])
+
+        completed = 0
+        retried = 0
+        finished = None
+        for q in session.query(UserCost.user_id, UserCost.retries, UserCost.updated).\
+                filter(UserCost.frequency == frequency, UserCost.updated >= started).\
+                yield_per(config.get('USERS_YIELD_PER', 10000)):
+            if q.user_id in heavy_users or shard and user_shard(q.user_id, shard[1]) != shard[0]:
+                continue
+            if q.retries:
+                retried += 1
+                continue
+            completed += 1
+            finished = max(finished, q.updated) if finished else q.updated
+
+        record['completed'] = completed
+        record['retried'] = retried
+        record['actual_seconds'] = (finished - started).total_seconds() if finished else None
+        kv.value = json.dumps(record)
+        session.commit()
+
+    logger.info('{0} run started {1}: predicted {2:.0f} s for {3} users, actual {4} s for {5} users ({6} users '
+                'retried)'.format(frequency, record['started'], record['predicted_seconds'], record['users'],
+                                  '{0:.0f}'.format(record['actual_seconds']) if finished else 'unknown', completed,
+                                  retried))
+    return record
+
+
+def merge_shard_summaries(frequency, shard, summary):
+    """
+    Stores the summary of a shard's run. Once every shard has stored its summary for the same run date, the merged
+    summary of the run is stored as well, and the global last processing date is advanced to the earliest of the
+    shards' (so an unsharded run can follow a sharded one)
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    :param summary: dict; summary of the shard's run
+    :return: dict; merged summary, or None if some shards haven't finished yet
+    """
+    key = 'run.summary.{0}.shard.{1}/{2}'
+    with app.session_scope() as session:
+        _set_value(session, key.format(frequency, shard[0], shard[1]), json.dumps(summary))
+        session.commit()
+
+    with app.session_scope() as session:
+        summaries = [json.loads(kv.value) for kv in session.query(KeyValue).
+                     filter(KeyValue.key.in_([key.format(frequency, i, shard[1]) for i in range(shard[1])]))]
+        summaries = [s for s in summaries if s['date'] == summary['date']]
+        if len(summaries) < shard[1]:
+            return None
+
+        merged = {'date': summary['date'],
+                  'shards': shard[1],
+                  'users': sum(s['users'] for s in summaries),
+                  'published': sum(s['published'] or 0 for s in summaries),
+                  'started': min(s['started'] for s in summaries),
+                  'finished': max(s['finished'] for s in summaries)}
+        merged['seconds'] = (get_date(merged['finished']) - get_date(merged['started'])).total_seconds()
+        _set_value(session, 'run.summary.{0}'.format(frequency), json.dumps(merged))
+        _set_value(session, _watermark_key(frequency), min(s['last_process_date'] for s in summaries))
+        session.commit()
+
+    return merged
+
+
+def prefetch_users(frequency, shard=None, stop=None):
+    """
+    Fetches the myADS setups and email addresses of the users due for processing, and stores them for the
+    processing tasks; run while waiting for the ingest
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    :param stop: threading.Event; once set, prefetching stops after the current batch of users
+    :return: no return
+    """
+    try:
+        users = app.iter_users(get_date(_last_process_date(frequency, shard)).isoformat(), frequency=frequency,
+                               shard=shard)
+        prefetch.prefetch_users(app, users, frequency, threads=config.get('PLANNER_THREADS', 8),
+                                batch_size=config.get('PREFETCH_BATCH_SIZE', 100), stop=stop)
+    except Exception as e:
+        # the processing tasks fetch whatever wasn't prefetched
+        logger.exception('Prefetch of {0} users failed: {1}'.format(frequency, e))
+
+
+@contextlib.contextmanager
+def prefetching(frequency, shard=None):
+    """
+    Prefetches the setups and email addresses of the due users in the background while the block runs, if
+    PREFETCH_USERS is set; the prefetch is stopped when the block exits
+
+    :param frequency: basestring; 'daily' or 'weekly'
+    :param shard: tuple; (shard index, number of shards)
+    """
+    if not config.get('PREFETCH_USERS', False):
+        yield
+        return
+    stop = threading.Event()
+    thread = threading.Thread(target=prefetch_users, args=(frequency,), kwargs={'shard': shard, 'stop': stop})
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
 def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None, admin_email=None, force=False,
-                  frequency='daily', test_bibcode=None, **kwargs):
+                  frequency='daily', test_bibcode=None, plan=False, local=False, batch_size=None, shard=None,
+                  longest_first=None, **kwargs):
     """
     Processes myADS mailings
 
@@ -271,12 +521,27 @@ def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None
     :param force: if True, will force processing of emails even if sent for a given user already that day
     :param frequency: basestring; 'daily' or 'weekly'
     :param test_bibcode: bibcode to query to test if Solr searcher has been updated
+    :param plan: if True, the distinct queries of all users are executed once before the per-user tasks are dispatched
+    :param local: if True, users are processed concurrently in this process instead of being dispatched to workers
+    :param batch_size: number of users dispatched per task; if more than 1, users are dispatched in chunks to
+        task_process_myads_batch (default MYADS_BATCH_SIZE)
+    :param shard: tuple; (shard index, number of shards), to only process the users of one shard, with its own
+        last processing date; several nodes can each run one shard of the same run
+    :param longest_first: if True, users are dispatched longest processing time first (default DISPATCH_LONGEST_FIRST)
     :return: no return
     """
+    # identifies this run, so that workers can share the results of identical queries; the shards of a run
+    # share it too
+    if shard:
+        run_id = '{0}:{1}'.format(frequency, get_date().date().isoformat())
+    else:
+        run_id = '{0}:{1}'.format(frequency, get_date().isoformat())
+
     if user_ids:
         for u in user_ids:
             tasks.task_process_myads({'userid': u, 'frequency': frequency, 'force': True,
-                                      'test_send_to': test_send_to, 'test_bibcode': test_bibcode})
+                                      'test_send_to': test_send_to, 'test_bibcode': test_bibcode,
+                                      'run_id': run_id})
 
         logger.info('Done (just the supplied user IDs)')
         return
@@ -294,7 +559,8 @@ def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None
                 continue
 
             tasks.task_process_myads({'userid': user_id, 'frequency': frequency, 'force': True,
-                                      'test_send_to': test_send_to, 'test_bibcode': test_bibcode})
+                                      'test_send_to': test_send_to, 'test_bibcode': test_bibcode,
+                                      'run_id': run_id})
 
         logger.info('Done (just the supplied user IDs)')
         return
@@ -309,50 +575,114 @@ def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None
 
     # if since keyword not provided, since is set to timestamp of last processing
     if not since or isinstance(since, basestring) and since.strip() == "":
-        with app.session_scope() as session:
-            if frequency == 'daily':
-                kv = session.query(KeyValue).filter_by(key='last.process.daily').first()
-            else:
-                kv = session.query(KeyValue).filter_by(key='last.process.weekly').first()
-            if kv is not None:
-                since = kv.value
-            else:
-                since = '1971-01-01T12:00:00Z'
+        since = _last_process_date(frequency, shard)
 
     users_since_date = get_date(since)
     logger.info('Processing {0} myADS queries since: {1}'.format(frequency, users_since_date.isoformat()))
 
     last_process_date = get_date()
-    all_users = app.get_users(users_since_date.isoformat(), frequency=frequency)
-
-    for user in all_users:
-        try:
-            tasks.task_process_myads.delay({'userid': user, 'frequency': frequency, 'force': force,
-                                            'test_bibcode': test_bibcode})
-        except:  # potential backpressure (we are too fast)
-            time.sleep(2)
-            print('Conn problem, retrying...', user)
-            tasks.task_process_myads.delay({'userid': user, 'frequency': frequency, 'force': force,
-                                            'test_bibcode': test_bibcode})
+    # the previous run of this frequency is done by now
+    report_makespan(frequency, shard=shard)
+
+    # users are streamed from the database and dispatched as they arrive, unless they're all needed up front
+    if longest_first is None:
+        longest_first = config.get('DISPATCH_LONGEST_FIRST', False)
+    all_users = app.iter_users(users_since_date.isoformat(), frequency=frequency, shard=shard, by_cost=True,
+                               longest_first=longest_first)
+    if plan or local:
+        all_users = list(all_users)
+
+    query_plan = None
+    if plan:
+        query_plan = planner.plan_run(app, [user for user, seconds in all_users], frequency, run_id,
+                                      threads=config.get('PLANNER_THREADS', 8))
+
+    # users that were expensive to process in their last run are dispatched last, one per task, to their own queue;
+    # without a heavy users queue, they stay in the main stream
+    heavy_queue = tasks.task_options(frequency, heavy=True).get('queue')
+    if local or not heavy_queue or heavy_queue == tasks.task_options(frequency).get('queue'):
+        heavy_users = set()
+    else:
+        heavy_users = app.get_heavy_users(frequency)
+    heavy = []
+    # predicted time for the workers to process the other users, in dispatch order
+    estimate = dispatch.MakespanEstimate(config.get('DISPATCH_WORKER_SLOTS', 16))
+    num_users = [0]
+
+    def user_messages():
+        for user, seconds in all_users:
+            num_users[0] += 1
+            message = {'userid': user, 'frequency': frequency, 'force': force, 'test_bibcode': test_bibcode,
+                       'run_id': run_id}
+            if query_plan and user in query_plan.setups:
+                message['setup'] = query_plan.setups[user]
+            if user in heavy_users:
+                # retries stay on the heavy users queue
+                message['heavy'] = True
+                heavy.append(message)
+                continue
+            estimate.add(seconds if seconds is not None else config.get('USER_SECONDS_DEFAULT', 2.))
+            yield message
+
+    if local:
+        failed = tasks.process_users_concurrently(list(user_messages()))
+        logger.info('Done processing {0} myADS notifications locally for {1} users; {2} failed.'.
+                    format(frequency, num_users[0], failed))
+        tasks.metrics.export(force=True)
+    else:
+        if batch_size is None:
+            batch_size = config.get('MYADS_BATCH_SIZE', 1)
+        dispatcher = dispatch.Dispatcher(app)
+        # each frequency has its own queue; each shard can also have its own queue, consumed by its own workers
+        options = tasks.task_options(frequency)
+        if shard and config.get('SHARD_QUEUES', False):
+            options['queue'] = '{0}_shard{1}'.format(options.get('queue', 'process'), shard[0])
+
+        if batch_size > 1:
+            stats = dispatcher.dispatch(tasks.task_process_myads_batch, dispatch.chunked(user_messages(), batch_size),
+                                        **options)
+        else:
+            stats = dispatcher.dispatch(tasks.task_process_myads, user_messages(), **options)
+        if heavy:
+            heavy_stats = dispatcher.dispatch(tasks.task_process_myads, heavy,
+                                              **tasks.task_options(frequency, heavy=True))
+            logger.info('Dispatched {0} heavy users to their own queue'.format(heavy_stats['published']))
+            stats['published'] += heavy_stats['published']
+            stats['seconds'] += heavy_stats['seconds']
+            stats['rate'] = stats['published'] / stats['seconds'] if stats['seconds'] else 0.
+        print('Published {0} tasks in {1:.1f} s ({2:.0f} tasks/s)'.format(stats['published'], stats['seconds'],
+                                                                         stats['rate']))
+
+    logger.info('Predicted {0} processing time: {1:.0f} s for {2} users on {3} worker slots ({4} heavy users '
+                'excluded)'.format(frequency, estimate.makespan, estimate.jobs, len(estimate.loads), len(heavy)))
+    with app.session_scope() as session:
+        _set_value(session, _makespan_key(frequency, shard),
+                   json.dumps({'started': last_process_date.isoformat(),
+                               'predicted_seconds': estimate.makespan,
+                               'users': estimate.jobs,
+                               'heavy_users': [m['userid'] for m in heavy]}))
+        session.commit()
 
     # update last processed timestamp
     with app.session_scope() as session:
-        if frequency == 'daily':
-            kv = session.query(KeyValue).filter_by(key='last.process.daily').first()
-        else:
-            kv = session.query(KeyValue).filter_by(key='last.process.weekly').first()
-        if kv is None:
-            if frequency == 'daily':
-                kv = KeyValue(key='last.process.daily', value=last_process_date.isoformat())
-            else:
-                kv = KeyValue(key='last.process.weekly', value=last_process_date.isoformat())
-            session.add(kv)
-        else:
-            kv.value = last_process_date.isoformat()
+        _set_value(session, _watermark_key(frequency, shard), last_process_date.isoformat())
         session.commit()
 
-    print('Done submitting {0} myADS processing tasks for {1} users.'.format(frequency, len(all_users)))
-    logger.info('Done submitting {0} myADS processing tasks for {1} users.'.format(frequency, len(all_users)))
+    if shard:
+        summary = {'date': last_process_date.date().isoformat(),
+                   'shard': '{0}/{1}'.format(*shard),
+                   'users': num_users[0],
+                   'published': None if local else stats['published'],
+                   'started': last_process_date.isoformat(),
+                   'finished': get_date().isoformat(),
+                   'last_process_date': last_process_date.isoformat()}
+        merged = merge_shard_summaries(frequency, shard, summary)
+        if merged:
+            logger.info('All {0} shards of the {1} run done: {2} users in {3:.0f} s'.
+                        format(merged['shards'], frequency, merged['users'], merged['seconds']))
+
+    print('Done submitting {0} myADS processing tasks for {1} users.'.format(frequency, num_users[0]))
+    logger.info('Done submitting {0} myADS processing tasks for {1} users.'.format(frequency, num_users[0]))
 
 
 if __name__ == '__main__':
@@ -419,6 +749,13 @@ if __name__ == '__main__':
                        default=0,
                        help='Wait these many seconds after ingest to allow SOLR searchers to be in sync')
 
+    parser.add_argument('--watch',
+                        dest='watch',
+                        action='store_true',
+                        default=False,
+                        help='Detect ingest completion as soon as the ingest file is written (with inotify if '
+                             'available, by polling otherwise), and query Solr with increasing delays')
+
     parser.add_argument('-m',
                         '--manual',
                         dest='manual',
@@ -426,6 +763,55 @@ if __name__ == '__main__':
                         default=False,
                         help='Manually force processing, skipping the arxiv/astronomy completion check')
 
+    parser.add_argument('-p',
+                        '--plan',
+                        dest='plan',
+                        action='store_true',
+                        default=False,
+                        help='Execute the distinct queries of all users once before dispatching the per-user tasks '
+                             '(requires QUERY_CACHE_BACKEND)')
+
+    parser.add_argument('-l',
+                        '--local',
+                        dest='local',
+                        action='store_true',
+                        default=False,
+                        help='Process users concurrently in this process instead of dispatching them to workers')
+
+    parser.add_argument('--shard',
+                        dest='shard',
+                        action='store',
+                        default=None,
+                        help='Only process one shard of the users, given as i/N (0 <= i < N), e.g. 0/4; each shard '
+                             'has its own last processing date, and shards can run on different nodes')
+
+    parser.add_argument('--longest-first',
+                        dest='longest_first',
+                        action='store_true',
+                        default=None,
+                        help='Dispatch users longest processing time first, as of their last run (default '
+                             'DISPATCH_LONGEST_FIRST); users are sorted before the first one is dispatched')
+
+    parser.add_argument('--report',
+                        dest='report',
+                        action='store_true',
+                        default=False,
+                        help='Report the predicted and actual processing time of the last daily (-d) and/or '
+                             'weekly (-w) run')
+
+    parser.add_argument('--compact',
+                        dest='compact',
+                        action='store_true',
+                        default=False,
+                        help='Merge stored results older than STATEFUL_RESULTS_DAYS into one row per user query')
+
+    parser.add_argument('--backfill-results',
+                        dest='backfill_results',
+                        action='store_true',
+                        default=False,
+                        help='Copy the stored results to the normalized store; run it before and after turning on '
+                             'STATEFUL_RESULTS_NORMALIZED')
+
     args = parser.parse_args()
 
     if args.user_ids:
@@ -434,15 +820,38 @@ if __name__ == '__main__':
     if args.user_emails:
         args.user_emails = [x.strip() for x in args.user_emails.split(',')]
 
+    if args.shard:
+        try:
+            args.shard = tuple(int(x) for x in args.shard.split('/'))
+            if len(args.shard) != 2 or not 0 <= args.shard[0] < args.shard[1]:
+                raise ValueError
+        except ValueError:
+            parser.error('--shard must be given as i/N, with 0 <= i < N')
+
+    if args.report:
+        for frequency, selected in (('daily', args.daily_update), ('weekly', args.weekly_update)):
+            if selected:
+                report_makespan(frequency, shard=args.shard)
+        sys.exit(0)
+
+    if args.compact:
+        app.compact_results(ndays=config.get('STATEFUL_RESULTS_DAYS', 7))
+
+    if args.backfill_results:
+        app.backfill_result_bibcodes()
+
     if args.daily_update:
         if args.manual:
             logger.info('Manual processing on; skipping arXiv ingest completion check')
             process_myads(args.since_date, args.user_ids, args.user_emails, args.test_send_to, args.admin_email,
-                          args.force, frequency='daily', test_bibcode=None)
+                          args.force, frequency='daily', test_bibcode=None, plan=args.plan, local=args.local, shard=args.shard,
+                          longest_first=args.longest_first)
         else:
             arxiv_complete = False
             try:
-                arxiv_complete = _arxiv_ingest_complete(sleep_delay=300, sleep_timeout=36000, admin_email=args.admin_email)
+                with prefetching('daily', shard=args.shard):
+                    arxiv_complete = _arxiv_ingest_complete(sleep_delay=300, sleep_timeout=36000,
+                                                            admin_email=args.admin_email, watch=args.watch)
             except Exception as e:
                 logger.warning('arXiv ingest: code failed with an exception: {0}'.format(e))
                 sys.exit(1)
@@ -453,7 +862,8 @@ if __name__ == '__main__':
                     time.sleep(args.wait_send)
                 logger.info('arxiv ingest: starting processing')
                 process_myads(args.since_date, args.user_ids, args.user_emails, args.test_send_to, args.admin_email, args.force,
-                              frequency='daily', test_bibcode=arxiv_complete)
+                              frequency='daily', test_bibcode=arxiv_complete, plan=args.plan, local=args.local, shard=args.shard,
+                              longest_first=args.longest_first)
             else:
                 logger.warning('arXiv ingest: failed.')
                 sys.exit(1)
@@ -462,11 +872,14 @@ if __name__ == '__main__':
         if args.manual:
             logger.info('Manual processing on; skipping astronomy ingest completion check')
             process_myads(args.since_date, args.user_ids, args.user_emails, args.test_send_to, args.admin_email,
-                          args.force, frequency='weekly', test_bibcode=None)
+                          args.force, frequency='weekly', test_bibcode=None, plan=args.plan, local=args.local, shard=args.shard,
+                          longest_first=args.longest_first)
         else:
             astro_complete = False
             try:
-                astro_complete = _astro_ingest_complete(sleep_delay=300, sleep_timeout=36000, admin_email=args.admin_email)
+                with prefetching('weekly', shard=args.shard):
+                    astro_complete = _astro_ingest_complete(sleep_delay=300, sleep_timeout=36000,
+                                                            admin_email=args.admin_email, watch=args.watch)
             except Exception as e:
                 logger.warning('astro ingest: code failed with an exception: {0}'.format(e))
                 sys.exit(1)
@@ -477,7 +890,8 @@ if __name__ == '__main__':
                     time.sleep(args.wait_send)
                 logger.info('astro ingest: starting processing now')
                 process_myads(args.since_date, args.user_ids, args.user_emails, args.test_send_to, args.admin_email, args.force,
-                              frequency='weekly', test_bibcode=astro_complete)
+                              frequency='weekly', test_bibcode=astro_complete, plan=args.plan, local=args.local, shard=args.shard,
+                              longest_first=args.longest_first)
             else:
                 logger.warning('astro ingest: failed.')
                 sys.exit(1)